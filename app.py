@@ -10,12 +10,25 @@ import subprocess
 import datetime
 import sqlite3
 import base64
+import csv
 import hashlib
+import unicodedata
+import zlib
 import math
+import random
 import tempfile
+import asyncio
+import threading
+import queue
+import uuid
+import functools
+import contextlib
+import concurrent.futures
+from collections import OrderedDict, deque
+from collections.abc import Mapping
 from pathlib import Path
 from typing import Optional, Union, Tuple, Dict, List
-from flask import Flask, render_template, request, jsonify, Response, send_file
+from flask import Flask, render_template, request, jsonify, Response, send_file, stream_with_context, g
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
@@ -36,21 +49,41 @@ except ImportError:
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain.agents import AgentExecutor, create_react_agent
-from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps as lc_dumps, loads as lc_loads
+from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 from langchain import hub
 from langchain.tools import BaseTool
 from langchain_core.tools import Tool
 from config import Config
+from http_client import (
+    http_get, http_post, http_stream, http_get_async, http_post_async, http_stream_async,
+    CircuitoAbiertoError, StreamIncompletoError, obtener_circuito, estado_circuitos,
+    PeticionCanceladaError, TokenCancelacion, token_actual, con_cancelacion, activar_cancelacion,
+    desactivar_cancelacion, comprobar_cancelacion, al_cancelar_peticion, abortar_respuesta,
+    esperar_resultado, esperar_resultado_async
+)
+from database import (
+    get_connection, transaccion, crear_escritor, aplicar_migraciones,
+    sql_historial_sesion, sql_sesiones_recientes, sql_busqueda_historial, CAMPOS_CONVERSACION,
+    SQL_RESUMEN_SESION, SQL_TURNOS_RANGO, SQL_GUARDAR_RESUMEN
+)
 
 # Definir ChatLMStudio directamente aquí para evitar problemas de importación
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
-from langchain_core.outputs import ChatGeneration, ChatResult
-from langchain_core.callbacks import CallbackManagerForLLMRun
-from typing import Any, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, BaseCallbackHandler, CallbackManagerForLLMRun
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, List, Optional
 from pydantic import Field
 import requests
+import httpx
+
+# Circuito compartido por todas las generaciones contra LM Studio (ver http_client)
+CIRCUITO_LMSTUDIO = 'lmstudio-chat'
 
 class ChatLMStudio(BaseChatModel):
     """Chat model wrapper for LM Studio API."""
@@ -60,97 +93,323 @@ class ChatLMStudio(BaseChatModel):
     base_url: str = Field(default="http://localhost:1234", description="URL base del servidor LM Studio")
     temperature: float = Field(default=0.7, description="Temperatura para generación")
     max_tokens: int = Field(default=1000, description="Máximo número de tokens")
+    system_nativo: bool = Field(default=True, description="Enviar las instrucciones con el rol 'system' nativo")
     
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self._last_response = None  # Para almacenar la última respuesta con reasoning_content
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model": self.model, "base_url": self.base_url, "temperature": self.temperature,
+                "max_tokens": self.max_tokens, "system_nativo": self.system_nativo}
     
-    def _generate(
-        self,
-        messages: List[BaseMessage],
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any,
-    ) -> ChatResult:
-        """Generate chat completion."""
-        # Convert messages to API format
+    def _convertir_mensajes(self, messages: List[BaseMessage]) -> List[Dict]:
+        """Convierte los mensajes de LangChain al formato de la API de LM Studio"""
         api_messages = []
         
-        # Combinar mensajes del sistema con el primer mensaje del usuario
+        # Los mensajes del sistema se agrupan en un único bloque al principio; el resto de turnos
+        # (historial incluido) conserva su orden original
         system_content = ""
-        user_messages = []
         
         for msg in messages:
+            # Asegurarnos de que el contenido sea string
+            content = msg.content if isinstance(msg.content, str) else str(msg.content)
             if isinstance(msg, SystemMessage):
-                # Acumular contenido del sistema, asegurándonos de que sea string
-                content = msg.content if isinstance(msg.content, str) else str(msg.content)
                 system_content += content + "\n\n"
             elif isinstance(msg, HumanMessage):
-                user_messages.append(msg)
+                api_messages.append({"role": "user", "content": content})
             elif isinstance(msg, AIMessage):
-                content = msg.content if isinstance(msg.content, str) else str(msg.content)
                 api_messages.append({"role": "assistant", "content": content})
         
-        # Si hay contenido del sistema, combinarlo con el primer mensaje del usuario
-        if system_content and user_messages:
-            first_user_msg = user_messages[0]
-            first_content = first_user_msg.content if isinstance(first_user_msg.content, str) else str(first_user_msg.content)
-            combined_content = f"{system_content.strip()}\n\nUsuario: {first_content}"
-            api_messages.insert(0, {"role": "user", "content": combined_content})
-            
-            # Agregar los mensajes restantes del usuario
-            for msg in user_messages[1:]:
-                user_content = msg.content if isinstance(msg.content, str) else str(msg.content)
-                api_messages.append({"role": "user", "content": user_content})
-        else:
-            # Si no hay sistema, agregar mensajes del usuario normalmente
-            for msg in user_messages:
-                user_content = msg.content if isinstance(msg.content, str) else str(msg.content)
-                api_messages.append({"role": "user", "content": user_content})
+        # Con rol 'system' nativo el prefijo del prompt es idéntico byte a byte entre peticiones y el
+        # servidor puede reutilizar su caché KV; si no, se combina con el primer mensaje del usuario
+        if system_content and self.system_nativo:
+            api_messages.insert(0, {"role": "system", "content": system_content.strip()})
+        elif system_content:
+            primer_usuario = next((m for m in api_messages if m["role"] == "user"), None)
+            if primer_usuario is not None:
+                primer_usuario["content"] = f"{system_content.strip()}\n\nUsuario: {primer_usuario['content']}"
+            else:
+                api_messages.insert(0, {"role": "user", "content": system_content.strip()})
         
         # Asegurar que no hay mensajes vacíos
         if not api_messages:
             api_messages = [{"role": "user", "content": "Hola"}]
         
+        return api_messages
+    
+    def _construir_payload(self, api_messages: List[Dict], stream: bool = False, stop: Optional[List[str]] = None) -> Dict:
+        """Construye el cuerpo de la petición /v1/chat/completions"""
+        payload = {
+            "model": self.model,
+            "messages": api_messages,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "stream": stream
+        }
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        # Secuencias de parada (p. ej. el agente ReAct corta en "\nObservation"): las aplica el servidor
+        if stop:
+            payload["stop"] = stop
+        return payload
+    
+    def _crear_resultado(self, result: Dict, tiempo_inicio: float) -> ChatResult:
+        """Convierte la respuesta JSON de la API en un ChatResult"""
+        choice = result["choices"][0]
+        content = choice["message"]["content"]
+        tiempo_generacion = round(time.time() - tiempo_inicio, 3)
+        
+        # Capturar reasoning_content si está disponible (para modelos de razonamiento como DeepSeek R1).
+        # Todo viaja en el mensaje devuelto: la instancia no guarda estado entre peticiones.
+        reasoning_content = choice["message"].get("reasoning_content")
+        usage = result.get("usage") or {}
+        
+        response_metadata = {
+            "model_name": result.get("model", self.model),
+            "finish_reason": choice.get("finish_reason"),
+            "usage": usage,
+            "tiempo_generacion": tiempo_generacion
+        }
+        
+        # Return result
+        message = AIMessage(
+            content=content,
+            additional_kwargs={"reasoning_content": reasoning_content} if reasoning_content else {},
+            response_metadata=response_metadata
+        )
+        if usage:
+            message.usage_metadata = self._crear_usage_metadata(usage, result.get("timings"))
+            
+        generation = ChatGeneration(message=message, generation_info={"finish_reason": choice.get("finish_reason")})
+        return ChatResult(generations=[generation], llm_output={"token_usage": usage, "model_name": self.model})
+    
+    @staticmethod
+    def _extraer_datos_sse(line: str) -> Optional[str]:
+        """Devuelve el contenido de una línea 'data:' del stream SSE, o None si no aplica"""
+        line = line.strip() if line else ''
+        if not line.startswith('data:'):
+            return None
+        return line[len('data:'):].strip()
+    
+    @staticmethod
+    def _crear_usage_metadata(usage: Dict, timings: Optional[Dict] = None) -> Dict:
+        """Uso de tokens en formato LangChain, incluidos los tokens servidos desde la caché de prefijo"""
+        usage_metadata = {
+            "input_tokens": usage.get("prompt_tokens", 0),
+            "output_tokens": usage.get("completion_tokens", 0),
+            "total_tokens": usage.get("total_tokens", 0)
+        }
+        # Formato OpenAI (LM Studio) o, en su defecto, timings de llama.cpp
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached_tokens is None and timings:
+            cached_tokens = timings.get("cache_n")
+        if cached_tokens is not None:
+            usage_metadata["input_token_details"] = {"cache_read": cached_tokens}
+        return usage_metadata
+    
+    @staticmethod
+    def _crear_chunk(payload: str) -> Optional[ChatGenerationChunk]:
+        """Convierte un evento SSE de la API en un ChatGenerationChunk (None si no aporta nada)"""
+        try:
+            evento = json.loads(payload)
+        except json.JSONDecodeError:
+            return None
+        
+        choices = evento.get("choices") or []
+        delta = choices[0].get("delta", {}) if choices else {}
+        finish_reason = choices[0].get("finish_reason") if choices else None
+        
+        contenido = delta.get("content") or ""
+        reasoning_delta = delta.get("reasoning_content") or ""
+        usage = evento.get("usage")
+        
+        if not contenido and not reasoning_delta and not usage and not finish_reason:
+            return None
+        
+        additional_kwargs = {"reasoning_content": reasoning_delta} if reasoning_delta else {}
+        message_chunk = AIMessageChunk(content=contenido, additional_kwargs=additional_kwargs)
+        
+        generation_info = {}
+        if finish_reason:
+            generation_info["finish_reason"] = finish_reason
+        if usage:
+            generation_info["usage"] = usage
+            message_chunk.usage_metadata = ChatLMStudio._crear_usage_metadata(usage, evento.get("timings"))
+        
+        return ChatGenerationChunk(message=message_chunk, generation_info=generation_info or None)
+    
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Generate chat completion."""
+        # Dentro de una petición cancelable se lee en streaming: una respuesta completa no llega
+        # hasta el final y su conexión no se podría cortar si el cliente se va
+        if token_actual() is not None:
+            return self._generar_en_stream(messages, stop, run_manager, **kwargs)
+        
+        # Convert messages to API format
+        api_messages = self._convertir_mensajes(messages)
+        tiempo_inicio = time.time()
+        
         # Make API request
-        response = requests.post(
+        response = http_post(
             f"{self.base_url}/v1/chat/completions",
-            json={
-                "model": self.model,
-                "messages": api_messages,
-                "temperature": self.temperature,
-                "max_tokens": self.max_tokens,
-                "stream": False
-            },
+            json=self._construir_payload(api_messages, stop=stop),
             headers={"Content-Type": "application/json"},
-            timeout=300  # Aumentar timeout a 5 minutos para modelos lentos
+            circuito=CIRCUITO_LMSTUDIO,
+            timeout_minimo=Config.LMSTUDIO_MIN_TIMEOUT,
+            timeout=Config.LMSTUDIO_TIMEOUT  # Tope para modelos lentos; se adapta a la latencia observada
         )
         
         if response.status_code != 200:
             raise ValueError(f"LM Studio API error: {response.status_code} {response.text}")
         
-        result = response.json()
-        content = result["choices"][0]["message"]["content"]
+        return self._crear_resultado(response.json(), tiempo_inicio)
+    
+    def _generar_en_stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Generación completa a partir del stream, con la misma metadata que _crear_resultado"""
+        tiempo_inicio = time.time()
+        resultado = generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+        generacion = resultado.generations[0]
+        generacion.message.response_metadata.update({
+            "model_name": self.model,
+            "finish_reason": (generacion.generation_info or {}).get("finish_reason"),
+            "usage": (generacion.generation_info or {}).get("usage") or {},
+            "tiempo_generacion": round(time.time() - tiempo_inicio, 3)
+        })
+        return resultado
+    
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Generate chat completion sin bloquear el event loop (cliente HTTP asíncrono)."""
+        api_messages = self._convertir_mensajes(messages)
+        tiempo_inicio = time.time()
+        
+        response = await http_post_async(
+            f"{self.base_url}/v1/chat/completions",
+            json=self._construir_payload(api_messages, stop=stop),
+            headers={"Content-Type": "application/json"},
+            circuito=CIRCUITO_LMSTUDIO,
+            timeout_minimo=Config.LMSTUDIO_MIN_TIMEOUT,
+            timeout=httpx.Timeout(Config.LMSTUDIO_TIMEOUT, connect=10)
+        )
         
-        # Almacenar la respuesta completa para acceso posterior (reasoning_content, etc.)
-        self._last_response = result
+        if response.status_code != 200:
+            raise ValueError(f"LM Studio API error: {response.status_code} {response.text}")
         
-        # Capturar reasoning_content si está disponible (para modelos de razonamiento como DeepSeek R1)
-        reasoning_content = None
-        if "choices" in result and len(result["choices"]) > 0:
-            choice = result["choices"][0]
-            if "message" in choice and "reasoning_content" in choice["message"]:
-                reasoning_content = choice["message"]["reasoning_content"]
+        return self._crear_resultado(response.json(), tiempo_inicio)
+    
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        """Stream chat completion token a token usando SSE (protocolo compatible con OpenAI)."""
+        api_messages = self._convertir_mensajes(messages)
         
-        # Return result
-        message = AIMessage(content=content)
+        # El circuito juzga el stream completo: latencia hasta el final y fallo si se corta a mitad
+        with http_stream(
+            "POST",
+            f"{self.base_url}/v1/chat/completions",
+            json=self._construir_payload(api_messages, stream=True, stop=stop),
+            headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+            circuito=CIRCUITO_LMSTUDIO,
+            timeout_minimo=Config.LMSTUDIO_MIN_TIMEOUT,
+            timeout=(10, Config.LMSTUDIO_TIMEOUT)  # 10s para conectar; entre tokens, como mucho una generación completa
+        ) as response:
+            # Si se cancela la petición, cortar la conexión: LM Studio deja de generar al perder al cliente
+            quitar_aborto = al_cancelar_peticion(lambda: abortar_respuesta(response))
+            completo = False
+            try:
+                if response.status_code != 200:
+                    raise ValueError(f"LM Studio API error: {response.status_code} {response.text}")
+                
+                for raw_line in response.iter_lines():
+                    # Plazo agotado entre tokens: no seguir leyendo
+                    comprobar_cancelacion()
+                    # Las líneas SSE llegan como bytes; decodificar siempre en UTF-8
+                    payload = self._extraer_datos_sse(raw_line.decode('utf-8') if raw_line else '')
+                    if payload is None:
+                        continue
+                    if payload == '[DONE]':
+                        completo = True
+                        break
+                    
+                    chunk = self._crear_chunk(payload)
+                    if chunk is None:
+                        continue
+                    if run_manager and chunk.message.content:
+                        run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+                    yield chunk
+                # Una conexión cortada al cancelar termina como un stream sin [DONE]: no darlo por bueno,
+                # y si no se canceló es que LM Studio se cortó a mitad de la respuesta
+                if not completo:
+                    comprobar_cancelacion()
+                    raise StreamIncompletoError("LM Studio cerró el stream sin [DONE]")
+            except requests.RequestException:
+                comprobar_cancelacion()
+                raise
+            finally:
+                quitar_aborto()
+    
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """Stream asíncrono token a token usando SSE (protocolo compatible con OpenAI)."""
+        api_messages = self._convertir_mensajes(messages)
         
-        # Añadir reasoning_content como metadata si está disponible
-        if reasoning_content:
-            message.additional_kwargs = {"reasoning_content": reasoning_content}
+        # Como en _stream, el circuito juzga el stream completo
+        async with http_stream_async(
+            "POST",
+            f"{self.base_url}/v1/chat/completions",
+            json=self._construir_payload(api_messages, stream=True, stop=stop),
+            headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+            circuito=CIRCUITO_LMSTUDIO,
+            timeout_minimo=Config.LMSTUDIO_MIN_TIMEOUT,
+            timeout=httpx.Timeout(Config.LMSTUDIO_TIMEOUT, connect=10)
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise ValueError(f"LM Studio API error: {response.status_code} {response.text}")
             
-        generation = ChatGeneration(message=message)
-        return ChatResult(generations=[generation])
+            completo = False
+            async for line in response.aiter_lines():
+                comprobar_cancelacion()
+                payload = self._extraer_datos_sse(line)
+                if payload is None:
+                    continue
+                if payload == '[DONE]':
+                    completo = True
+                    break
+                
+                chunk = self._crear_chunk(payload)
+                if chunk is None:
+                    continue
+                if run_manager and chunk.message.content:
+                    await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+                yield chunk
+            if not completo:
+                comprobar_cancelacion()
+                raise StreamIncompletoError("LM Studio cerró el stream sin [DONE]")
     
     @property
     def _llm_type(self) -> str:
@@ -198,83 +457,893 @@ os.makedirs('static/plots', exist_ok=True)
 # ================================
 
 def init_database():
-    """Inicializa la base de datos para el historial de conversaciones"""
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            user_message TEXT NOT NULL,
-            ai_response TEXT NOT NULL,
-            model_used TEXT NOT NULL,
-            reasoning_content TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            metadata TEXT
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            session_id TEXT PRIMARY KEY,
-            title TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_activity DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Inicializa la base de datos para el historial de conversaciones (aplica las migraciones pendientes)"""
+    aplicar_migraciones(get_connection())
 
-def save_conversation(session_id: str, user_message: str, ai_response: str, 
-                     model_used: str, reasoning_content: Optional[str] = None, metadata: Optional[Dict] = None):
-    """Guarda una conversación en la base de datos"""
-    conn = sqlite3.connect('chat_history.db')
+def guardar_conversaciones(conn: sqlite3.Connection, filas: List[Tuple]):
+    """Inserta un lote de conversaciones (y actualiza sus sesiones) en la transacción dada"""
     cursor = conn.cursor()
     
     # Actualizar o crear sesión
-    cursor.execute('''
+    cursor.executemany('''
         INSERT OR REPLACE INTO sessions (session_id, last_activity, title)
         VALUES (?, ?, ?)
-    ''', (session_id, datetime.datetime.now(), user_message[:50] + "..."))
+    ''', [(fila[0], fila[6], fila[1][:50] + "...") for fila in filas])
     
     # Guardar conversación
-    cursor.execute('''
+    cursor.executemany('''
         INSERT INTO conversations 
         (session_id, user_message, ai_response, model_used, reasoning_content, metadata)
         VALUES (?, ?, ?, ?, ?, ?)
-    ''', (session_id, user_message, ai_response, model_used, reasoning_content, 
-          json.dumps(metadata) if metadata else None))
+    ''', [fila[:6] for fila in filas])
+
+# Escritor en segundo plano opcional: las respuestas no esperan al fsync del historial
+escritor_historial = crear_escritor('historial', guardar_conversaciones) if Config.HISTORY_ASYNC_WRITES else None
+
+def save_conversation(session_id: str, user_message: str, ai_response: str, 
+                     model_used: str, reasoning_content: Optional[str] = None, metadata: Optional[Dict] = None):
+    """Guarda una conversación en la base de datos"""
+    fila = (session_id, user_message, ai_response, model_used, reasoning_content,
+            json.dumps(metadata) if metadata else None, datetime.datetime.now())
+    
+    if escritor_historial is not None:
+        escritor_historial.encolar(fila)
+        return
     
-    conn.commit()
-    conn.close()
+    with transaccion() as conn:
+        guardar_conversaciones(conn, [fila])
+
+# Campos devueltos por defecto (los mismos que antes de existir la proyección)
+CAMPOS_HISTORIAL_POR_DEFECTO = ('user_message', 'ai_response', 'model_used', 'reasoning_content', 'timestamp', 'metadata')
+MAX_LIMITE_PAGINA = 500
 
-def get_conversation_history(session_id: str, limit: int = 50) -> List[Dict]:
+def codificar_cursor(*valores) -> str:
+    """Cursor opaco para la paginación por keyset"""
+    return base64.urlsafe_b64encode(json.dumps(valores).encode('utf-8')).decode('ascii')
+
+def decodificar_cursor(cursor: str) -> List:
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Cursor inválido')
+    if not isinstance(valores, list) or len(valores) != 2:
+        raise ValueError('Cursor inválido')
+    return valores
+
+def parsear_campos(parametro: Optional[str]) -> Tuple[str, ...]:
+    """Convierte ?campos=a,b,c en una tupla validada de columnas"""
+    if not parametro:
+        return CAMPOS_HISTORIAL_POR_DEFECTO
+    campos = tuple(c.strip() for c in parametro.split(',') if c.strip())
+    invalidos = [c for c in campos if c not in CAMPOS_CONVERSACION]
+    if invalidos or not campos:
+        raise ValueError(f"Campos no válidos: {', '.join(invalidos)}. Disponibles: {', '.join(CAMPOS_CONVERSACION)}")
+    return campos
+
+def get_conversation_page(session_id: str, limit: int = 50, cursor: Optional[str] = None,
+                          campos: Tuple[str, ...] = CAMPOS_HISTORIAL_POR_DEFECTO,
+                          parsear_metadata: bool = True) -> Tuple[List[Dict], Optional[str]]:
+    """Obtiene una página del historial de una sesión y el cursor de la siguiente (None si no hay más)"""
+    # timestamp e id se leen siempre porque forman el cursor, aunque no se devuelvan
+    columnas = list(campos) + [c for c in ('timestamp', 'id') if c not in campos]
+    parametros = [session_id] + (decodificar_cursor(cursor) if cursor else []) + [limit]
+    
+    rows = get_connection().execute(sql_historial_sesion(columnas, bool(cursor)), parametros).fetchall()
+    
+    conversaciones = []
+    for row in rows:
+        conversacion = {campo: row[i] for i, campo in enumerate(campos)}
+        if parsear_metadata and 'metadata' in conversacion:
+            conversacion['metadata'] = json.loads(conversacion['metadata']) if conversacion['metadata'] else {}
+        conversaciones.append(conversacion)
+    
+    siguiente_cursor = None
+    if len(rows) == limit:
+        ultima = rows[-1]
+        siguiente_cursor = codificar_cursor(ultima[columnas.index('timestamp')], ultima[columnas.index('id')])
+    return conversaciones, siguiente_cursor
+
+def get_conversation_history(session_id: str, limit: int = 50, cursor: Optional[str] = None,
+                             campos: Tuple[str, ...] = CAMPOS_HISTORIAL_POR_DEFECTO) -> List[Dict]:
     """Obtiene el historial de conversaciones de una sesión"""
-    conn = sqlite3.connect('chat_history.db')
-    cursor = conn.cursor()
+    return get_conversation_page(session_id, limit, cursor, campos)[0]
+
+def iterar_conversaciones(session_id: str, campos: Tuple[str, ...] = CAMPOS_HISTORIAL_POR_DEFECTO,
+                          tamano_lote: int = MAX_LIMITE_PAGINA, parsear_metadata: bool = True) -> Iterator[Dict]:
+    """Recorre todo el historial de una sesión página a página, sin cargarlo entero en memoria"""
+    cursor = None
+    while True:
+        conversaciones, cursor = get_conversation_page(session_id, tamano_lote, cursor, campos, parsear_metadata)
+        yield from conversaciones
+        if cursor is None:
+            return
+
+def construir_consulta_fts(texto: str) -> str:
+    """Convierte el texto del usuario en una consulta FTS5 segura.
     
-    cursor.execute('''
-        SELECT user_message, ai_response, model_used, reasoning_content, timestamp, metadata
-        FROM conversations 
-        WHERE session_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    ''', (session_id, limit))
+    Cada palabra se entrecomilla (así comillas, guiones o paréntesis no rompen la sintaxis de MATCH)
+    y todas deben aparecer; una palabra terminada en * busca por prefijo.
+    """
+    terminos = []
+    for palabra in re.findall(r'[\w]+\*?', texto, flags=re.UNICODE):
+        prefijo = palabra.endswith('*')
+        palabra = palabra.rstrip('*')
+        if palabra:
+            terminos.append(f'"{palabra}"' + ('*' if prefijo else ''))
+    if not terminos:
+        raise ValueError('La búsqueda no contiene palabras')
+    return ' '.join(terminos)
+
+def buscar_conversaciones(texto: str, limit: int = 20, pagina: int = 1, modelo: Optional[str] = None,
+                          desde: Optional[str] = None, hasta: Optional[str] = None) -> List[Dict]:
+    """Búsqueda de texto completo en el historial, ordenada por relevancia"""
+    # Una fecha sin hora en 'hasta' incluye todo ese día
+    if hasta and len(hasta) == 10:
+        hasta = f'{hasta} 23:59:59'
     
-    rows = cursor.fetchall()
-    conn.close()
+    filtros = [valor for valor in (modelo, desde, hasta) if valor]
+    sql = sql_busqueda_historial(bool(modelo), bool(desde), bool(hasta))
+    parametros = [construir_consulta_fts(texto)] + filtros + [limit, (pagina - 1) * limit]
+    rows = get_connection().execute(sql, parametros).fetchall()
     
     return [{
-        'user_message': row[0],
-        'ai_response': row[1],
+        'id': row[0],
+        'session_id': row[1],
         'model_used': row[2],
-        'reasoning_content': row[3],
-        'timestamp': row[4],
-        'metadata': json.loads(row[5]) if row[5] else {}
+        'timestamp': row[3],
+        'fragmentos': {
+            'user_message': row[4],
+            'ai_response': row[5],
+            'reasoning_content': row[6]
+        },
+        'relevancia': round(-row[7], 4)
     } for row in rows]
 
+def get_sessions_page(limit: int = 100, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Obtiene una página de sesiones (más recientes primero) y el cursor de la siguiente"""
+    parametros = (decodificar_cursor(cursor) if cursor else []) + [limit]
+    rows = get_connection().execute(sql_sesiones_recientes(bool(cursor)), parametros).fetchall()
+    
+    sesiones = [{
+        'session_id': row[0],
+        'title': row[1],
+        'created_at': row[2],
+        'last_activity': row[3]
+    } for row in rows]
+    
+    siguiente_cursor = codificar_cursor(rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+    return sesiones, siguiente_cursor
+
+# ================================
+# CACHÉ DE RESPUESTAS
+# ================================
+
+class AlmacenCache:
+    """Caché clave-valor de dos niveles: LRU en memoria + tabla SQLite con TTL y tamaño máximo.
+    
+    Los valores se guardan como texto (JSON). Cada almacén usa su propia tabla, de modo que
+    distintas cachés pueden compartir el archivo de base de datos. Con ttl_obsoleto las entradas
+    caducadas se conservan ese tiempo extra para servirlas mientras se revalidan, y con
+    persistente=False solo se usa la memoria.
+    """
+    
+    def __init__(self, tabla: str, max_memoria: int, ttl: int, max_entradas: int,
+                 ttl_obsoleto: int = 0, persistente: bool = True):
+        self.tabla = tabla
+        self.max_memoria = max_memoria
+        self.ttl = ttl
+        self.ttl_obsoleto = ttl_obsoleto
+        self.max_entradas = max_entradas
+        self.persistente = persistente
+        self._memoria = OrderedDict()
+        self._lock = threading.Lock()
+        self.estadisticas = {'hits_memoria': 0, 'hits_sqlite': 0, 'misses': 0, 'escrituras': 0, 'expulsiones': 0}
+        
+        if self.persistente:
+            with transaccion() as conn:
+                conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {self.tabla} (
+                        clave TEXT PRIMARY KEY,
+                        valor TEXT NOT NULL,
+                        creado REAL NOT NULL,
+                        ultimo_acceso REAL NOT NULL
+                    )
+                ''')
+    
+    def _guardar_en_memoria(self, clave: str, valor: str, creado: float):
+        self._memoria[clave] = (valor, creado)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_memoria:
+            self._memoria.popitem(last=False)
+    
+    def obtener_entrada(self, clave: str) -> Optional[Tuple[str, float]]:
+        """Devuelve (valor, creado) si la entrada existe y no ha superado ttl + ttl_obsoleto"""
+        ahora = time.time()
+        retencion = self.ttl + self.ttl_obsoleto
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada is not None:
+                if entrada[1] + retencion > ahora:
+                    self._memoria.move_to_end(clave)
+                    self.estadisticas['hits_memoria'] += 1
+                    return entrada
+                del self._memoria[clave]
+        
+        fila = None
+        if self.persistente:
+            with transaccion() as conn:
+                fila = conn.execute(
+                    f'SELECT valor, creado FROM {self.tabla} WHERE clave = ? AND creado > ?',
+                    (clave, ahora - retencion)
+                ).fetchone()
+                if fila:
+                    conn.execute(f'UPDATE {self.tabla} SET ultimo_acceso = ? WHERE clave = ?', (ahora, clave))
+        
+        with self._lock:
+            if fila is None:
+                self.estadisticas['misses'] += 1
+                return None
+            self.estadisticas['hits_sqlite'] += 1
+            self._guardar_en_memoria(clave, fila[0], fila[1])
+        return fila[0], fila[1]
+    
+    def obtener(self, clave: str) -> Optional[str]:
+        """Devuelve el valor si existe y no ha caducado"""
+        entrada = self.obtener_entrada(clave)
+        if entrada is None or entrada[1] + self.ttl <= time.time():
+            return None
+        return entrada[0]
+    
+    def guardar(self, clave: str, valor: str):
+        """Guarda un valor en ambos niveles y aplica la expulsión por TTL y tamaño"""
+        ahora = time.time()
+        with self._lock:
+            self._guardar_en_memoria(clave, valor, ahora)
+            self.estadisticas['escrituras'] += 1
+        
+        if not self.persistente:
+            return
+        
+        with transaccion() as conn:
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.tabla} (clave, valor, creado, ultimo_acceso) VALUES (?, ?, ?, ?)',
+                (clave, valor, ahora, ahora)
+            )
+            # Expulsar caducadas y, si se supera el tamaño, las menos usadas recientemente
+            expulsadas = conn.execute(
+                f'DELETE FROM {self.tabla} WHERE creado <= ?', (ahora - self.ttl - self.ttl_obsoleto,)
+            ).rowcount
+            expulsadas += conn.execute(f'''
+                DELETE FROM {self.tabla} WHERE clave IN (
+                    SELECT clave FROM {self.tabla} ORDER BY ultimo_acceso DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entradas,)).rowcount
+        
+        if expulsadas:
+            with self._lock:
+                self.estadisticas['expulsiones'] += expulsadas
+    
+    def limpiar(self):
+        """Vacía ambos niveles de la caché"""
+        with self._lock:
+            self._memoria.clear()
+        if self.persistente:
+            with transaccion() as conn:
+                conn.execute(f'DELETE FROM {self.tabla}')
+    
+    def resumen(self) -> Dict:
+        """Contadores de aciertos y fallos junto con el tamaño de cada nivel"""
+        entradas_sqlite = (get_connection().execute(f'SELECT COUNT(*) FROM {self.tabla}').fetchone()[0]
+                           if self.persistente else 0)
+        
+        with self._lock:
+            estadisticas = dict(self.estadisticas)
+            entradas_memoria = len(self._memoria)
+        hits = estadisticas['hits_memoria'] + estadisticas['hits_sqlite']
+        consultas = hits + estadisticas['misses']
+        estadisticas.update({
+            'hits': hits,
+            'tasa_aciertos': round(hits / consultas, 3) if consultas else 0.0,
+            'entradas_memoria': entradas_memoria,
+            'entradas_sqlite': entradas_sqlite,
+            'ttl': self.ttl,
+            'max_memoria': self.max_memoria,
+            'max_entradas': self.max_entradas
+        })
+        return estadisticas
+
+class CacheRespuestas(BaseCache):
+    """Caché de LangChain para un modelo concreto.
+    
+    La clave combina el modelo, el prompt ya renderizado, los parámetros del modelo y la
+    temperatura y max_tokens efectivos, así dos configuraciones distintas nunca comparten respuesta.
+    """
+    
+    def __init__(self, model_key: str, temperatura: float, max_tokens: Optional[int], almacen: AlmacenCache):
+        self.model_key = model_key
+        self.temperatura = temperatura
+        self.max_tokens = max_tokens
+        self.almacen = almacen
+    
+    def _clave(self, prompt: str, llm_string: str) -> str:
+        datos = json.dumps([self.model_key, prompt, llm_string, self.temperatura, self.max_tokens], ensure_ascii=False)
+        return hashlib.sha256(datos.encode('utf-8')).hexdigest()
+    
+    def lookup(self, prompt: str, llm_string: str):
+        valor = self.almacen.obtener(self._clave(prompt, llm_string))
+        if valor is None:
+            return None
+        try:
+            generaciones = lc_loads(valor)
+        except Exception as e:
+            print(f"⚠️ Entrada de caché ilegible para {self.model_key}: {e}")
+            return None
+        for generacion in generaciones:
+            mensaje = getattr(generacion, 'message', None)
+            if mensaje is not None:
+                mensaje.response_metadata['cache_hit'] = True
+        return generaciones
+    
+    def update(self, prompt: str, llm_string: str, return_val) -> None:
+        self.almacen.guardar(self._clave(prompt, llm_string), lc_dumps(return_val))
+    
+    def clear(self, **kwargs) -> None:
+        self.almacen.limpiar()
+
+almacen_respuestas = AlmacenCache(
+    'response_cache',
+    max_memoria=Config.RESPONSE_CACHE_MEMORY_SIZE,
+    ttl=Config.RESPONSE_CACHE_TTL,
+    max_entradas=Config.RESPONSE_CACHE_MAX_ENTRIES
+) if Config.RESPONSE_CACHE_ENABLED else None
+
+def configurar_cache_modelo(model_key: str, modelo) -> None:
+    """Activa la caché de respuestas en el modelo si está habilitada y su temperatura lo permite"""
+    if almacen_respuestas is None:
+        return
+    
+    temperatura = getattr(modelo, 'temperature', None)
+    if temperatura is None:
+        temperatura = Config.DEFAULT_TEMPERATURE
+    # Con temperatura alta cada respuesta es distinta: no tiene sentido reutilizarla
+    if temperatura > Config.RESPONSE_CACHE_MAX_TEMPERATURE:
+        return
+    
+    max_tokens = getattr(modelo, 'max_tokens', None) or getattr(modelo, 'num_predict', None)
+    modelo.cache = CacheRespuestas(model_key, temperatura, max_tokens, almacen_respuestas)
+    print(f"💾 Caché de respuestas activa para {model_key} (temperatura {temperatura})")
+
+# ================================
+# CACHÉ SEMÁNTICA
+# ================================
+
+# Palabras que no cambian el tema de una pregunta ("qué es python" ≈ "explica python")
+PALABRAS_VACIAS_PREGUNTA = {
+    'que', 'es', 'son', 'un', 'una', 'unos', 'unas', 'el', 'la', 'los', 'las', 'lo', 'de', 'del', 'al',
+    'a', 'en', 'y', 'o', 'me', 'te', 'por', 'favor', 'sobre', 'acerca', 'explica', 'explicame',
+    'explicar', 'define', 'definir', 'definicion', 'dime', 'describe', 'describeme', 'cual', 'cuales',
+    'significa', 'significado', 'concepto', 'puedes', 'podrias', 'quiero', 'saber', 'breve', 'brevemente'
+}
+
+def quitar_tildes(texto: str) -> str:
+    """Minúsculas y sin tildes ni diacríticos"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+def normalizar_pregunta(pregunta: str) -> str:
+    """Minúsculas, sin tildes ni signos de puntuación y sin palabras vacías"""
+    texto = quitar_tildes(pregunta)
+    palabras = re.findall(r'[a-z0-9+#]+', texto)
+    return ' '.join(p for p in palabras if p not in PALABRAS_VACIAS_PREGUNTA)
+
+def vectorizar_pregunta(texto_normalizado: str, dimension: int) -> np.ndarray:
+    """Vector local por hashing de palabras y trigramas de caracteres (normalizado L2)"""
+    vector = np.zeros(dimension, dtype=np.float32)
+    for palabra in texto_normalizado.split():
+        # Las palabras completas pesan más que los trigramas para no confundir "java" con "javascript"
+        vector[zlib.crc32(f'p:{palabra}'.encode('utf-8')) % dimension] += 2.0
+        relleno = f' {palabra} '
+        for i in range(len(relleno) - 2):
+            vector[zlib.crc32(f't:{relleno[i:i + 3]}'.encode('utf-8')) % dimension] += 1.0
+    norma = np.linalg.norm(vector)
+    return vector / norma if norma else vector
+
+class CacheSemantica:
+    """Reutiliza respuestas de preguntas parecidas usando similitud coseno sobre un índice NumPy.
+    
+    Mantiene un índice por modelo, con TTL y expulsión de la entrada menos usada recientemente
+    cuando se alcanza el máximo de entradas. Cada entrada guarda el contexto en que se generó
+    (huella del historial de la conversación) y solo se reutiliza con el mismo contexto.
+    """
+    
+    def __init__(self, dimension: int, max_entradas: int, ttl: int, umbral: float, umbrales_modelo: Dict[str, float]):
+        self.dimension = dimension
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.umbral = umbral
+        self.umbrales_modelo = umbrales_modelo
+        self._indices = {}
+        self._lock = threading.Lock()
+        self.estadisticas = {'hits': 0, 'misses': 0, 'escrituras': 0, 'expulsiones': 0}
+    
+    def umbral_para(self, model_key: str) -> float:
+        return self.umbrales_modelo.get(model_key, self.umbral)
+    
+    def _eliminar(self, indice: Dict, posiciones: List[int]):
+        indice['vectores'] = np.delete(indice['vectores'], posiciones, axis=0)
+        for posicion in sorted(posiciones, reverse=True):
+            del indice['entradas'][posicion]
+        self.estadisticas['expulsiones'] += len(posiciones)
+    
+    def buscar(self, model_key: str, pregunta: str, contexto: Optional[str] = None) -> Optional[Dict]:
+        """Devuelve la entrada más parecida con el mismo contexto si supera el umbral del modelo"""
+        normalizada = normalizar_pregunta(pregunta)
+        if not normalizada:
+            return None
+        vector = vectorizar_pregunta(normalizada, self.dimension)
+        ahora = time.time()
+        
+        with self._lock:
+            indice = self._indices.get(model_key)
+            if not indice or not indice['entradas']:
+                self.estadisticas['misses'] += 1
+                return None
+            
+            caducadas = [i for i, entrada in enumerate(indice['entradas']) if ahora - entrada['creado'] > self.ttl]
+            if caducadas:
+                self._eliminar(indice, caducadas)
+                if not indice['entradas']:
+                    self.estadisticas['misses'] += 1
+                    return None
+            
+            similitudes = indice['vectores'] @ vector
+            otro_contexto = [entrada['contexto'] != contexto for entrada in indice['entradas']]
+            similitudes[otro_contexto] = -1.0
+            mejor = int(np.argmax(similitudes))
+            similitud = float(similitudes[mejor])
+            if similitud < self.umbral_para(model_key):
+                self.estadisticas['misses'] += 1
+                return None
+            
+            entrada = indice['entradas'][mejor]
+            entrada['ultimo_acceso'] = ahora
+            entrada['hits'] += 1
+            self.estadisticas['hits'] += 1
+            return {**entrada, 'similitud': round(similitud, 4)}
+    
+    def guardar(self, model_key: str, pregunta: str, respuesta: str, info_generacion: Optional[Dict] = None,
+                contexto: Optional[str] = None):
+        """Añade una respuesta al índice del modelo"""
+        normalizada = normalizar_pregunta(pregunta)
+        if not normalizada or not respuesta:
+            return
+        vector = vectorizar_pregunta(normalizada, self.dimension)
+        ahora = time.time()
+        entrada = {
+            'pregunta': pregunta,
+            'respuesta': respuesta,
+            'reasoning_content': (info_generacion or {}).get('reasoning_content'),
+            'contexto': contexto,
+            'creado': ahora,
+            'ultimo_acceso': ahora,
+            'hits': 0
+        }
+        
+        with self._lock:
+            indice = self._indices.setdefault(model_key, {
+                'vectores': np.zeros((0, self.dimension), dtype=np.float32),
+                'entradas': []
+            })
+            
+            # Una pregunta equivalente ya indexada (en el mismo contexto) se sustituye en lugar de duplicarse
+            if indice['entradas']:
+                similitudes = indice['vectores'] @ vector
+                similitudes[[e['contexto'] != contexto for e in indice['entradas']]] = -1.0
+                mejor = int(np.argmax(similitudes))
+                if similitudes[mejor] >= 0.999:
+                    indice['vectores'][mejor] = vector
+                    indice['entradas'][mejor] = entrada
+                    self.estadisticas['escrituras'] += 1
+                    return
+            
+            if len(indice['entradas']) >= self.max_entradas:
+                menos_usada = min(range(len(indice['entradas'])), key=lambda i: indice['entradas'][i]['ultimo_acceso'])
+                self._eliminar(indice, [menos_usada])
+            
+            indice['vectores'] = np.vstack([indice['vectores'], vector[np.newaxis, :]])
+            indice['entradas'].append(entrada)
+            self.estadisticas['escrituras'] += 1
+    
+    def limpiar(self, model_key: Optional[str] = None):
+        with self._lock:
+            if model_key is None:
+                self._indices.clear()
+            else:
+                self._indices.pop(model_key, None)
+    
+    def resumen(self) -> Dict:
+        with self._lock:
+            estadisticas = dict(self.estadisticas)
+            entradas = {model_key: len(indice['entradas']) for model_key, indice in self._indices.items()}
+        consultas = estadisticas['hits'] + estadisticas['misses']
+        estadisticas.update({
+            'tasa_aciertos': round(estadisticas['hits'] / consultas, 3) if consultas else 0.0,
+            'entradas_por_modelo': entradas,
+            'umbral': self.umbral,
+            'umbrales_modelo': self.umbrales_modelo,
+            'ttl': self.ttl,
+            'max_entradas': self.max_entradas
+        })
+        return estadisticas
+
+cache_semantica = CacheSemantica(
+    dimension=Config.SEMANTIC_CACHE_DIMENSION,
+    max_entradas=Config.SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl=Config.SEMANTIC_CACHE_TTL,
+    umbral=Config.SEMANTIC_CACHE_THRESHOLD,
+    umbrales_modelo=Config.SEMANTIC_CACHE_THRESHOLDS
+) if Config.SEMANTIC_CACHE_ENABLED else None
+
+def huella_historial(historial: Optional[List[BaseMessage]]) -> Optional[str]:
+    """Huella del historial que acompaña a la pregunta (None sin historial).
+    
+    Forma parte de la clave de la caché semántica: la misma pregunta con otro contexto
+    de conversación puede necesitar otra respuesta.
+    """
+    if not historial:
+        return None
+    datos = json.dumps([[mensaje.type, mensaje.content] for mensaje in historial], ensure_ascii=False)
+    return hashlib.sha256(datos.encode('utf-8')).hexdigest()[:32]
+
+def buscar_en_cache_semantica(model_key: str, pregunta: str, omitir_cache: bool = False,
+                              contexto: Optional[str] = None) -> Optional[Tuple[str, Dict]]:
+    """Busca una respuesta reutilizable; devuelve (texto, info_generacion) o None"""
+    if cache_semantica is None or omitir_cache:
+        return None
+    entrada = cache_semantica.buscar(model_key, pregunta, contexto)
+    if entrada is None:
+        return None
+    
+    print(f"⚡ Caché semántica: '{pregunta[:50]}' ≈ '{entrada['pregunta'][:50]}' (similitud {entrada['similitud']})")
+    info = {'cache_semantica': {'similitud': entrada['similitud'], 'pregunta_original': entrada['pregunta']}}
+    if entrada.get('reasoning_content'):
+        info['reasoning_content'] = entrada['reasoning_content']
+    return entrada['respuesta'], info
+
+def guardar_en_cache_semantica(model_key: str, pregunta: str, respuesta: str, info_generacion: Optional[Dict] = None,
+                               omitir_cache: bool = False, contexto: Optional[str] = None):
+    if cache_semantica is None or omitir_cache:
+        return
+    cache_semantica.guardar(model_key, pregunta, respuesta, info_generacion, contexto)
+
+# ================================
+# CACHÉ DE RESULTADOS DE HERRAMIENTAS
+# ================================
+
+def normalizar_consulta(consulta: str) -> str:
+    """Clave de caché de una consulta: minúsculas, sin tildes, sin puntuación y espacios colapsados"""
+    return ' '.join(re.findall(r'\w+', quitar_tildes(consulta)))
+
+class CacheResultados:
+    """Caché de resultados de fuentes externas (búsqueda web, clima) sobre un AlmacenCache.
+    
+    - Entrada fresca: se devuelve sin consultar la fuente.
+    - Entrada obsoleta (dentro de ttl_obsoleto): se devuelve y se revalida en segundo plano.
+    - Sin entrada: se consulta la fuente; las consultas idénticas simultáneas esperan a la misma
+      carga en vuelo en lugar de repetirla.
+    Con almacen=None no se guarda nada, pero las cargas simultáneas se siguen agrupando.
+    """
+    
+    def __init__(self, nombre: str, almacen: Optional[AlmacenCache]):
+        self.nombre = nombre
+        self.almacen = almacen
+        self._en_vuelo: Dict[str, concurrent.futures.Future] = {}
+        self._tareas = set()
+        self._lock = threading.Lock()
+        self.estadisticas = {'frescos': 0, 'obsoletos': 0, 'cargas': 0, 'agrupadas': 0, 'revalidaciones': 0, 'errores': 0}
+    
+    def _buscar(self, clave: str) -> Optional[Tuple[Any, bool]]:
+        """Devuelve (valor, fresco) de la entrada guardada, o None"""
+        if self.almacen is None:
+            return None
+        entrada = self.almacen.obtener_entrada(clave)
+        if entrada is None:
+            return None
+        valor, creado = entrada
+        fresco = creado + self.almacen.ttl > time.time()
+        with self._lock:
+            self.estadisticas['frescos' if fresco else 'obsoletos'] += 1
+        return json.loads(valor), fresco
+    
+    def _reservar(self, clave: str, revalidacion: bool = False) -> Tuple[Optional[concurrent.futures.Future], bool]:
+        """Devuelve (futuro, propio): la carga en vuelo de la clave o una nueva si no la hay.
+        
+        En una revalidación no se agrupa: si ya hay una carga en vuelo se devuelve (None, False).
+        """
+        with self._lock:
+            futuro = self._en_vuelo.get(clave)
+            if futuro is not None:
+                if revalidacion:
+                    return None, False
+                self.estadisticas['agrupadas'] += 1
+                return futuro, False
+            futuro = concurrent.futures.Future()
+            self._en_vuelo[clave] = futuro
+            self.estadisticas['revalidaciones' if revalidacion else 'cargas'] += 1
+            return futuro, True
+    
+    def _completar(self, clave: str, futuro: concurrent.futures.Future, valor=None,
+                   error: Optional[Exception] = None, cacheable: Optional[Callable[[Any], bool]] = None):
+        """Guarda el resultado (si procede) y despierta a quienes esperaban la carga"""
+        if error is None and self.almacen is not None and (cacheable is None or cacheable(valor)):
+            try:
+                self.almacen.guardar(clave, json.dumps(valor, ensure_ascii=False))
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar en la caché de {self.nombre}: {e}")
+        with self._lock:
+            self._en_vuelo.pop(clave, None)
+            if error is not None and not isinstance(error, PeticionCanceladaError):
+                self.estadisticas['errores'] += 1
+        if error is None:
+            futuro.set_result(valor)
+        else:
+            futuro.set_exception(error)
+    
+    def _cargar(self, clave: str, futuro: concurrent.futures.Future, cargar: Callable[[], Any], cacheable):
+        try:
+            valor = cargar()
+        except Exception as e:
+            self._completar(clave, futuro, error=e)
+            return
+        except BaseException:
+            # Quien espera la carga nunca se queda colgado: si se interrumpe, la repite por su cuenta
+            self._completar(clave, futuro, error=PeticionCanceladaError('carga interrumpida'))
+            raise
+        self._completar(clave, futuro, valor, cacheable=cacheable)
+    
+    def _revalidar(self, clave: str, futuro: concurrent.futures.Future, cargar: Callable[[], Any], cacheable):
+        # La revalidación no pertenece a la petición que la disparó: sin su token de cancelación
+        with con_cancelacion(None):
+            self._cargar(clave, futuro, cargar, cacheable)
+    
+    async def _cargar_async(self, clave: str, futuro: concurrent.futures.Future, cargar, cacheable):
+        try:
+            valor = await cargar()
+        except Exception as e:
+            await asyncio.to_thread(self._completar, clave, futuro, None, e)
+            return
+        except BaseException:
+            # Tarea cancelada (p. ej. el cliente se desconectó): se libera a quienes esperaban
+            self._completar(clave, futuro, error=PeticionCanceladaError('carga cancelada'))
+            raise
+        # El guardado en SQLite es bloqueante: fuera del event loop
+        await asyncio.to_thread(self._completar, clave, futuro, valor, None, cacheable)
+    
+    def obtener(self, clave: str, cargar: Callable[[], Any], cacheable: Optional[Callable[[Any], bool]] = None):
+        """Devuelve el valor de la clave; cargar() se llama solo si no hay entrada válida.
+        
+        cacheable(valor) decide si un resultado se guarda (p. ej. no guardar errores).
+        """
+        entrada = self._buscar(clave)
+        if entrada is not None:
+            valor, fresco = entrada
+            if not fresco:
+                futuro, propio = self._reservar(clave, revalidacion=True)
+                if propio:
+                    threading.Thread(target=self._revalidar, args=(clave, futuro, cargar, cacheable),
+                                     name=f'revalidar-{self.nombre}', daemon=True).start()
+            return valor
+        
+        futuro, propio = self._reservar(clave)
+        if propio:
+            self._cargar(clave, futuro, cargar, cacheable)
+        try:
+            # Quien espera la carga de otra petición no pasa de su propio plazo
+            return esperar_resultado(futuro)
+        except PeticionCanceladaError:
+            if propio:
+                raise
+            # Se canceló la petición que cargaba, no esta: cargar por cuenta propia
+            comprobar_cancelacion()
+            return self.obtener(clave, cargar, cacheable)
+    
+    async def obtener_async(self, clave: str, cargar: Callable[[], Awaitable[Any]],
+                            cacheable: Optional[Callable[[Any], bool]] = None):
+        """Versión asíncrona de obtener: cargar es una corutina y las esperas no ocupan hilos"""
+        entrada = await asyncio.to_thread(self._buscar, clave)
+        if entrada is not None:
+            valor, fresco = entrada
+            if not fresco:
+                futuro, propio = self._reservar(clave, revalidacion=True)
+                if propio:
+                    # La tarea copia el contexto al crearse: se crea sin el token de esta petición para
+                    # que su cancelación no corte la revalidación. Se guarda la referencia para que la
+                    # tarea no se recolecte antes de terminar
+                    with con_cancelacion(None):
+                        tarea = asyncio.create_task(self._cargar_async(clave, futuro, cargar, cacheable))
+                    self._tareas.add(tarea)
+                    tarea.add_done_callback(self._tareas.discard)
+            return valor
+        
+        futuro, propio = self._reservar(clave)
+        if propio:
+            await self._cargar_async(clave, futuro, cargar, cacheable)
+        try:
+            return await esperar_resultado_async(futuro)
+        except PeticionCanceladaError:
+            if propio:
+                raise
+            comprobar_cancelacion()
+            return await self.obtener_async(clave, cargar, cacheable)
+    
+    def limpiar(self):
+        if self.almacen is not None:
+            self.almacen.limpiar()
+    
+    def resumen(self) -> Dict:
+        with self._lock:
+            estadisticas = dict(self.estadisticas)
+            estadisticas['en_vuelo'] = len(self._en_vuelo)
+        estadisticas['habilitada'] = self.almacen is not None
+        if self.almacen is not None:
+            almacen = self.almacen.resumen()
+            estadisticas.update({
+                'entradas_memoria': almacen['entradas_memoria'],
+                'entradas_sqlite': almacen['entradas_sqlite'],
+                'persistente': self.almacen.persistente,
+                'ttl': self.almacen.ttl,
+                'ttl_obsoleto': self.almacen.ttl_obsoleto
+            })
+        return estadisticas
+
+def _crear_almacen_herramienta(tabla: str, ttl: int, ttl_obsoleto: int) -> Optional[AlmacenCache]:
+    if not Config.TOOL_CACHE_ENABLED:
+        return None
+    return AlmacenCache(
+        tabla,
+        max_memoria=Config.TOOL_CACHE_MEMORY_SIZE,
+        ttl=ttl,
+        max_entradas=Config.TOOL_CACHE_MAX_ENTRIES,
+        ttl_obsoleto=ttl_obsoleto,
+        persistente=Config.TOOL_CACHE_PERSIST
+    )
+
+# Un TTL por fuente: el clima cambia en minutos, los resultados de búsqueda en horas
+cache_busqueda = CacheResultados(
+    'busqueda', _crear_almacen_herramienta('search_cache', Config.SEARCH_CACHE_TTL, Config.SEARCH_CACHE_STALE_TTL)
+)
+cache_clima = CacheResultados(
+    'clima', _crear_almacen_herramienta('weather_cache', Config.WEATHER_CACHE_TTL, Config.WEATHER_CACHE_STALE_TTL)
+)
+
+# ================================
+# MEMORIA DE CONVERSACIÓN
+# ================================
+
+def estimar_tokens(texto: Optional[str]) -> int:
+    """Estimación rápida de tokens (~4 caracteres por token) sin cargar un tokenizador"""
+    return len(texto or '') // 4 + 1
+
+def presupuesto_memoria(model_key: str) -> int:
+    return Config.MEMORY_TOKEN_BUDGETS.get(model_key, Config.MEMORY_TOKEN_BUDGET)
+
+def _primera_frase(texto: str, max_caracteres: int) -> str:
+    texto = ' '.join((texto or '').split())
+    fin = re.search(r'[.!?](\s|$)', texto)
+    frase = texto[:fin.end()].strip() if fin else texto
+    return frase if len(frase) <= max_caracteres else frase[:max_caracteres].rstrip() + '…'
+
+def resumir_turnos_extractivo(resumen_previo: Optional[str], turnos: List[Dict], max_tokens: int) -> str:
+    """Resumen sin LLM: una línea por turno (pregunta + primera frase de la respuesta).
+    
+    Si no cabe en max_tokens se descartan las líneas más antiguas.
+    """
+    lineas = resumen_previo.splitlines() if resumen_previo else []
+    for turno in turnos:
+        lineas.append(f"- Usuario: {_primera_frase(turno['user_message'], 150)} → IA: {_primera_frase(turno['ai_response'], 200)}")
+    while len(lineas) > 1 and estimar_tokens('\n'.join(lineas)) > max_tokens:
+        lineas.pop(0)
+    return '\n'.join(lineas)
+
+def resumir_turnos_con_modelo(model_key: str, resumen_previo: Optional[str], turnos: List[Dict], max_tokens: int) -> str:
+    """Resumen con el propio modelo; si falla se usa el resumen extractivo"""
+    modelo = models.get(model_key)
+    if modelo is None:
+        return resumir_turnos_extractivo(resumen_previo, turnos, max_tokens)
+    
+    conversacion = '\n'.join(f"Usuario: {t['user_message']}\nIA: {t['ai_response']}" for t in turnos)
+    prompt = (
+        f"Resume en español, en menos de {max_tokens * 3 // 4} palabras, los datos y decisiones importantes "
+        f"de esta conversación para poder continuarla.\n\n"
+        f"{'Resumen previo:' + chr(10) + resumen_previo + chr(10) + chr(10) if resumen_previo else ''}"
+        f"Conversación:\n{conversacion}\n\nResumen:"
+    )
+    try:
+        respuesta = modelo.invoke(prompt)
+        return respuesta.content if isinstance(respuesta.content, str) else str(respuesta.content)
+    except Exception as e:
+        print(f"⚠️ Error resumiendo la conversación con {model_key}: {e}")
+        return resumir_turnos_extractivo(resumen_previo, turnos, max_tokens)
+
+def obtener_resumen(session_id: str, model_key: str, limite_id: int) -> Optional[str]:
+    """Resumen de los turnos de la sesión con id < limite_id, cacheado en SQLite.
+    
+    Si el resumen guardado cubre menos turnos se amplía solo con los nuevos; si cubre más
+    (por ejemplo, un modelo con menos presupuesto) se vuelve a generar desde el principio.
+    """
+    conn = get_connection()
+    guardado = conn.execute(SQL_RESUMEN_SESION, (session_id,)).fetchone()
+    if guardado and guardado[0] == limite_id:
+        return guardado[1]
+    
+    desde_id, resumen_previo = (guardado[0], guardado[1]) if guardado and guardado[0] < limite_id else (0, None)
+    filas = conn.execute(SQL_TURNOS_RANGO, (session_id, desde_id, limite_id)).fetchall()
+    turnos = [{'user_message': fila[1], 'ai_response': fila[2]} for fila in filas]
+    if not turnos:
+        return resumen_previo
+    
+    if Config.MEMORY_SUMMARY_MODE == 'modelo':
+        resumen = resumir_turnos_con_modelo(model_key, resumen_previo, turnos, Config.MEMORY_SUMMARY_TOKENS)
+    else:
+        resumen = resumir_turnos_extractivo(resumen_previo, turnos, Config.MEMORY_SUMMARY_TOKENS)
+    
+    with transaccion() as conn:
+        conn.execute(SQL_GUARDAR_RESUMEN, (session_id, limite_id, resumen, datetime.datetime.now()))
+    return resumen
+
+def preparar_memoria(model_key: str, session_id: Optional[str], usar_memoria: bool = True) -> Tuple[List[BaseMessage], Dict]:
+    """Carga los turnos recientes de la sesión que caben en el presupuesto de tokens del modelo.
+    
+    Los turnos más antiguos se compactan en un resumen (SystemMessage) para que el prompt,
+    y con él el tiempo de prefill, no crezca con la longitud de la sesión.
+    """
+    if not Config.MEMORY_ENABLED or not usar_memoria or not session_id:
+        return [], {}
+    
+    turnos = list(reversed(get_conversation_page(
+        session_id, Config.MEMORY_MAX_TURNS, campos=('id', 'user_message', 'ai_response'), parsear_metadata=False
+    )[0]))
+    if not turnos:
+        return [], {}
+    
+    presupuesto = presupuesto_memoria(model_key)
+    seleccionados = []
+    tokens_usados = 0
+    for turno in reversed(turnos):
+        coste = estimar_tokens(turno['user_message']) + estimar_tokens(turno['ai_response'])
+        if tokens_usados + coste > presupuesto:
+            break
+        seleccionados.insert(0, turno)
+        tokens_usados += coste
+    
+    resumen = None
+    hay_turnos_antiguos = len(seleccionados) < len(turnos) or len(turnos) == Config.MEMORY_MAX_TURNS
+    if hay_turnos_antiguos:
+        # El resumen comparte el presupuesto: se le reserva su tamaño máximo descartando turnos
+        # antiguos *antes* de fijar el límite, para que el resumen cubra también los descartados
+        reserva = min(Config.MEMORY_SUMMARY_TOKENS, presupuesto)
+        while seleccionados and tokens_usados + reserva > presupuesto:
+            turno = seleccionados.pop(0)
+            tokens_usados -= estimar_tokens(turno['user_message']) + estimar_tokens(turno['ai_response'])
+        limite_id = seleccionados[0]['id'] if seleccionados else turnos[-1]['id'] + 1
+        resumen = obtener_resumen(session_id, model_key, limite_id)
+        if resumen:
+            tokens_usados += estimar_tokens(resumen)
+    
+    historial = []
+    if resumen:
+        historial.append(SystemMessage(content=f"Resumen de la conversación anterior:\n{resumen}"))
+    for turno in seleccionados:
+        historial.append(HumanMessage(content=turno['user_message']))
+        historial.append(AIMessage(content=turno['ai_response']))
+    
+    return historial, {
+        'turnos': len(seleccionados),
+        'tokens_estimados': tokens_usados,
+        'presupuesto': presupuesto,
+        'resumen': resumen is not None
+    }
+
 # ================================
 # ANALIZADOR DE CÓDIGO AVANZADO
 # ================================
@@ -605,12 +1674,72 @@ def formatear_duracion(segundos):
         else:
             return f"{minutos}m {segundos_restantes}s"
 
-print("🤖 Configurando modelos de IA...")
-
-# Configurar modelos de IA
-models = {}
+# ================================
+# REGISTRO PEREZOSO DE MODELOS
+# ================================
 
-# Configurar modelos de Ollama (locales)
+class RegistroPerezoso(Mapping):
+    """Diccionario de solo lectura que construye cada valor en su primer acceso.
+    
+    La construcción es thread-safe: cada clave tiene su propio lock, así dos peticiones
+    simultáneas no crean dos veces el mismo modelo, chain o agente. Si la fábrica devuelve
+    None (o falla) se devuelve None, igual que en los diccionarios originales, pero no se
+    guarda: el siguiente acceso lo vuelve a intentar (p. ej. LM Studio arrancado más tarde).
+    
+    Con incluir_nulos=False, `clave in registro` solo es verdadero si el valor no es None
+    (semántica de simple_chains, que solo contenía modelos disponibles).
+    """
+    
+    def __init__(self, nombre: str, claves: List[str], fabrica, incluir_nulos: bool = True):
+        self.nombre = nombre
+        self._claves = list(claves)
+        self._fabrica = fabrica
+        self._incluir_nulos = incluir_nulos
+        self._valores = {}
+        self._locks = {clave: threading.Lock() for clave in self._claves}
+    
+    def __getitem__(self, clave):
+        if clave not in self._locks:
+            raise KeyError(clave)
+        if clave in self._valores:
+            return self._valores[clave]
+        
+        with self._locks[clave]:
+            if clave in self._valores:
+                return self._valores[clave]
+            try:
+                valor = self._fabrica(clave)
+            except Exception as e:
+                print(f"⚠️ Error construyendo {self.nombre} '{clave}': {e}")
+                return None
+            if valor is not None:
+                self._valores[clave] = valor
+            return valor
+    
+    def __contains__(self, clave) -> bool:
+        if clave not in self._locks:
+            return False
+        return self._incluir_nulos or self[clave] is not None
+    
+    def __iter__(self):
+        return (clave for clave in self._claves if clave in self)
+    
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+    
+    def construido(self, clave) -> bool:
+        """Indica si el valor ya fue construido (sin forzar su construcción)"""
+        return clave in self._valores
+    
+    def invalidar(self, clave=None):
+        """Descarta el valor construido para que se vuelva a crear en el próximo acceso"""
+        claves = [clave] if clave is not None else list(self._claves)
+        for c in claves:
+            if c in self._locks:
+                with self._locks[c]:
+                    self._valores.pop(c, None)
+
+# Modelos de Ollama (locales)
 ollama_models = [
     ('llama3', 'Llama3 8B'),
     ('deepseek-coder', 'DeepSeek Coder'),
@@ -619,73 +1748,112 @@ ollama_models = [
     ('gemma3:4b', 'Google Gemma3 4B')
 ]
 
-for model_key, model_name in ollama_models:
-    try:
-        models[model_key] = ChatOllama(
-            model=model_key
-        )
-        print(f"✅ {model_name} configurado correctamente")
-    except Exception as e:
-        print(f"⚠️ {model_name} no disponible: {e}")
-        models[model_key] = None
+# Modelos de LM Studio (API local)
+lmstudio_models = {
+    # Google Gemma 3-12B
+    'lmstudio-gemma': ('Gemma 3-12B', dict(
+        model=Config.LMSTUDIO_MODEL,
+        base_url=Config.LMSTUDIO_BASE_URL,
+        temperature=Config.DEFAULT_TEMPERATURE,
+        max_tokens=Config.MAX_TOKENS,
+        system_nativo=Config.LMSTUDIO_NATIVE_SYSTEM_ROLE
+    )),
+    # Mistral 7B
+    'lmstudio-mistral': ('Mistral 7B', dict(
+        model=Config.LMSTUDIO_MODEL_MISTRAL,
+        base_url=Config.LMSTUDIO_BASE_URL,
+        temperature=Config.DEFAULT_TEMPERATURE,
+        max_tokens=Config.MAX_TOKENS,
+        system_nativo=Config.LMSTUDIO_NATIVE_SYSTEM_ROLE
+    )),
+    # DeepSeek Coder
+    'lmstudio-deepseek': ('DeepSeek Coder', dict(
+        model=Config.LMSTUDIO_MODEL_DEEPSEEK,
+        base_url=Config.LMSTUDIO_BASE_URL,
+        temperature=0.3,  # Temperatura más baja para respuestas más rápidas y directas
+        max_tokens=800,   # Reducir tokens para respuestas más concisas
+        system_nativo=Config.LMSTUDIO_NATIVE_SYSTEM_ROLE
+    ))
+}
+
+# Último estado conocido de LM Studio (None = aún sin comprobar)
+estado_lmstudio = {'disponible': None, 'comprobado': 0.0}
+_estado_lmstudio_lock = threading.Lock()
+
+def registrar_estado_lmstudio(disponible: bool):
+    """Guarda el estado de LM Studio y ofrece o retira sus modelos cuando cambia"""
+    with _estado_lmstudio_lock:
+        anterior = estado_lmstudio['disponible']
+        estado_lmstudio.update(disponible=disponible, comprobado=time.monotonic())
+        if disponible == anterior:
+            return
+        if disponible:
+            # Se restaura el orden original de los modelos configurados
+            available_models[:] = [m for m in modelos_configurados if m in available_models or m in lmstudio_models]
+            if anterior is False:
+                print("✅ LM Studio vuelve a estar disponible")
+        else:
+            available_models[:] = [m for m in available_models if m not in lmstudio_models]
+            print("⚠️ LM Studio no disponible")
 
-# Configurar Google Gemini (API)
-try:
-    if Config.GOOGLE_API_KEY:
+def lmstudio_disponible() -> bool:
+    """Indica si el servidor de LM Studio responde.
+    
+    El resultado se reutiliza durante LMSTUDIO_CHECK_INTERVAL segundos; con el monitor de
+    backends activo, sus sondeos también lo actualizan.
+    """
+    if (estado_lmstudio['disponible'] is None
+            or time.monotonic() - estado_lmstudio['comprobado'] >= Config.LMSTUDIO_CHECK_INTERVAL):
+        registrar_estado_lmstudio(Config.validate_lmstudio())
+    return estado_lmstudio['disponible']
+
+def crear_modelo(model_key: str):
+    """Fábrica de modelos: se ejecuta la primera vez que se usa cada modelo"""
+    ollama_nombres = dict(ollama_models)
+    
+    if model_key in ollama_nombres:
+        modelo = ChatOllama(model=model_key)
+        print(f"✅ {ollama_nombres[model_key]} configurado correctamente")
+        return modelo
+    
+    if model_key == 'gemini-1.5-flash':
+        if not Config.GOOGLE_API_KEY:
+            print("⚠️ Google Gemini no disponible: No se encontró GOOGLE_API_KEY")
+            return None
         os.environ["GOOGLE_API_KEY"] = Config.GOOGLE_API_KEY
-        models['gemini-1.5-flash'] = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash"
-        )
+        modelo = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
         print("✅ Google Gemini 1.5 Flash configurado correctamente")
-    else:
-        print("⚠️ Google Gemini no disponible: No se encontró GOOGLE_API_KEY")
-        models['gemini-1.5-flash'] = None
-except Exception as e:
-    print(f"⚠️ Google Gemini no disponible: {e}")
-    models['gemini-1.5-flash'] = None
+        return modelo
+    
+    if model_key in lmstudio_models:
+        # Mientras el servidor no responda sus modelos no se ofrecen (ver registrar_estado_lmstudio)
+        if not lmstudio_disponible():
+            return None
+        nombre, parametros = lmstudio_models[model_key]
+        modelo = ChatLMStudio(**parametros)
+        print(f"✅ LM Studio ({nombre}) configurado correctamente")
+        return modelo
+    
+    return None
 
-# Configurar LM Studio (API local)
-try:
-    if Config.validate_lmstudio():
-        # Configurar Google Gemma 3-12B
-        models['lmstudio-gemma'] = ChatLMStudio(
-            model=Config.LMSTUDIO_MODEL,
-            base_url=Config.LMSTUDIO_BASE_URL,
-            temperature=Config.DEFAULT_TEMPERATURE,
-            max_tokens=Config.MAX_TOKENS
-        )
-        print("✅ LM Studio (Gemma 3-12B) configurado correctamente")
-        
-        # Configurar Mistral 7B
-        models['lmstudio-mistral'] = ChatLMStudio(
-            model=Config.LMSTUDIO_MODEL_MISTRAL,
-            base_url=Config.LMSTUDIO_BASE_URL,
-            temperature=Config.DEFAULT_TEMPERATURE,
-            max_tokens=Config.MAX_TOKENS
-        )
-        print("✅ LM Studio (Mistral 7B) configurado correctamente")
-        
-        # Configurar DeepSeek Coder
-        models['lmstudio-deepseek'] = ChatLMStudio(
-            model=Config.LMSTUDIO_MODEL_DEEPSEEK,
-            base_url=Config.LMSTUDIO_BASE_URL,
-            temperature=0.3,  # Temperatura más baja para respuestas más rápidas y directas
-            max_tokens=800    # Reducir tokens para respuestas más concisas
-        )
-        print("✅ LM Studio (DeepSeek Coder) configurado correctamente")
-    else:
-        print("⚠️ LM Studio no disponible")
-        models['lmstudio-gemma'] = None
-        models['lmstudio-mistral'] = None
-        models['lmstudio-deepseek'] = None
-except Exception as e:
-    print(f"⚠️ LM Studio no disponible: {e}")
-    models['lmstudio-gemma'] = None
-    models['lmstudio-mistral'] = None
-    models['lmstudio-deepseek'] = None
+# Modelos configurados: se construyen en su primer uso, no al importar la aplicación
+modelos_configurados = [model_key for model_key, _ in ollama_models]
+if Config.GOOGLE_API_KEY:
+    modelos_configurados.append('gemini-1.5-flash')
+else:
+    print("⚠️ Google Gemini no disponible: No se encontró GOOGLE_API_KEY")
+modelos_configurados.extend(lmstudio_models.keys())
+
+def crear_modelo_con_cache(model_key: str):
+    modelo = crear_modelo(model_key)
+    if modelo is not None:
+        configurar_cache_modelo(model_key, modelo)
+    return modelo
+
+models = RegistroPerezoso('modelo', modelos_configurados, crear_modelo_con_cache)
 
 # Verificar que al menos un modelo esté disponible
-available_models = [k for k, v in models.items() if v is not None]
+available_models = list(modelos_configurados)
 if not available_models:
     print("❌ Error: No hay modelos disponibles")
     print("💡 Asegúrate de que:")
@@ -694,47 +1862,870 @@ if not available_models:
     print("   - LM Studio esté ejecutándose con un modelo cargado")
     exit(1)
 
-print(f"🎯 Modelos disponibles: {', '.join(available_models)}")
+print(f"🎯 Modelos configurados (carga diferida): {', '.join(available_models)}")
+
+# ================================
+# PLANIFICADOR POR BACKEND
+# ================================
+
+class ColaSaturadaError(Exception):
+    """La petición no consiguió turno en el backend antes de su plazo"""
+    
+    def __init__(self, backend: str, espera: float, posicion: int):
+        super().__init__(f"El backend {backend} está saturado: sin turno tras {espera:.1f}s en la cola (posición {posicion})")
+        self.backend = backend
+        self.espera = espera
+        self.posicion = posicion
+
+class _TurnoPendiente:
+    __slots__ = ('despertar', 'concedido', 'cancelado')
+    
+    def __init__(self, despertar):
+        self.despertar = despertar
+        self.concedido = False
+        self.cancelado = False
+
+class PlanificadorBackend:
+    """Limita las generaciones simultáneas contra un backend con una cola FIFO justa y plazos.
+    
+    Cuando termina una generación, el turno pasa directamente a la primera petición de la cola,
+    así nadie se cuela. Sirve tanto a hilos (Flask) como a corutinas (ASGI).
+    """
+    
+    def __init__(self, nombre: str, max_en_vuelo: int, espera_maxima: float):
+        self.nombre = nombre
+        self.max_en_vuelo = max_en_vuelo
+        self.espera_maxima = espera_maxima
+        self.en_vuelo = 0
+        self._cola = deque()
+        self._lock = threading.Lock()
+        self.estadisticas = {'atendidas': 0, 'encoladas': 0, 'rechazadas': 0, 'espera_total': 0.0, 'espera_maxima_observada': 0.0}
+    
+    def _solicitar(self, despertar) -> Tuple[_TurnoPendiente, int]:
+        turno = _TurnoPendiente(despertar)
+        with self._lock:
+            if self.en_vuelo < self.max_en_vuelo and not self._cola:
+                self.en_vuelo += 1
+                turno.concedido = True
+                return turno, 0
+            self._cola.append(turno)
+            self.estadisticas['encoladas'] += 1
+            return turno, len(self._cola)
+    
+    def _abandonar(self, turno: _TurnoPendiente) -> bool:
+        """Saca de la cola un turno caducado; devuelve True si en realidad ya se había concedido"""
+        with self._lock:
+            if turno.concedido:
+                return True
+            turno.cancelado = True
+            try:
+                self._cola.remove(turno)
+            except ValueError:
+                pass
+            self.estadisticas['rechazadas'] += 1
+            return False
+    
+    def _liberar(self):
+        with self._lock:
+            while self._cola:
+                siguiente = self._cola.popleft()
+                if siguiente.cancelado:
+                    continue
+                # El hueco pasa al siguiente sin decrementar en_vuelo
+                siguiente.concedido = True
+                siguiente.despertar()
+                return
+            self.en_vuelo -= 1
+    
+    def _registrar_espera(self, posicion: int, inicio: float) -> Dict:
+        espera = time.time() - inicio
+        with self._lock:
+            self.estadisticas['atendidas'] += 1
+            self.estadisticas['espera_total'] += espera
+            self.estadisticas['espera_maxima_observada'] = max(self.estadisticas['espera_maxima_observada'], espera)
+        return {'backend': self.nombre, 'posicion': posicion, 'espera': round(espera, 3)}
+    
+    @contextlib.contextmanager
+    def turno(self, plazo: Optional[float] = None):
+        """Espera turno (bloqueando el hilo) y lo libera al salir del bloque.
+        
+        La espera termina también si la petición en curso se cancela o agota su plazo.
+        """
+        inicio = time.time()
+        evento = threading.Event()
+        turno, posicion = self._solicitar(evento.set)
+        if not turno.concedido:
+            token = token_actual()
+            espera = plazo or self.espera_maxima
+            quitar_aviso = lambda: None
+            if token is not None:
+                espera = token.acotar(espera)
+                quitar_aviso = token.al_cancelar(evento.set)
+            try:
+                evento.wait(espera)
+            finally:
+                quitar_aviso()
+            if not self._abandonar(turno):
+                comprobar_cancelacion()
+                raise ColaSaturadaError(self.nombre, time.time() - inicio, posicion)
+        
+        try:
+            yield self._registrar_espera(posicion, inicio)
+        finally:
+            self._liberar()
+    
+    @contextlib.asynccontextmanager
+    async def turno_async(self, plazo: Optional[float] = None):
+        """Versión asíncrona de turno(): espera sin ocupar un hilo"""
+        inicio = time.time()
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        
+        def despertar():
+            loop.call_soon_threadsafe(lambda: futuro.done() or futuro.set_result(True))
+        
+        turno, posicion = self._solicitar(despertar)
+        if not turno.concedido:
+            token = token_actual()
+            espera = plazo or self.espera_maxima
+            try:
+                await asyncio.wait_for(asyncio.shield(futuro), token.acotar(espera) if token is not None else espera)
+            except asyncio.TimeoutError:
+                if not self._abandonar(turno):
+                    comprobar_cancelacion()
+                    raise ColaSaturadaError(self.nombre, time.time() - inicio, posicion)
+            except asyncio.CancelledError:
+                # Si el turno llegó justo al cancelar hay que devolverlo
+                if self._abandonar(turno):
+                    self._liberar()
+                raise
+        
+        try:
+            yield self._registrar_espera(posicion, inicio)
+        finally:
+            self._liberar()
+    
+    def _pendientes(self) -> int:
+        return sum(1 for turno in self._cola if not turno.cancelado)
+    
+    def en_cola(self) -> int:
+        """Peticiones esperando turno (sin las que ya abandonaron la cola)"""
+        with self._lock:
+            return self._pendientes()
+    
+    def resumen(self) -> Dict:
+        with self._lock:
+            estadisticas = dict(self.estadisticas)
+            en_cola = self._pendientes()
+            en_vuelo = self.en_vuelo
+        espera_total = estadisticas.pop('espera_total')
+        estadisticas.update({
+            'en_vuelo': en_vuelo,
+            'en_cola': en_cola,
+            'max_en_vuelo': self.max_en_vuelo,
+            'espera_media': round(espera_total / estadisticas['atendidas'], 3) if estadisticas['atendidas'] else 0.0,
+            'espera_maxima_observada': round(estadisticas['espera_maxima_observada'], 3)
+        })
+        return estadisticas
+
+def backend_de_modelo(model_key: str) -> str:
+    if model_key.startswith('lmstudio-'):
+        return 'lmstudio'
+    if model_key.startswith('gemini'):
+        return 'gemini'
+    return 'ollama'
+
+def circuito_de_modelo(model_key: str) -> str:
+    """Circuito que protege las generaciones de un modelo.
+    
+    LM Studio se protege en la capa HTTP (distingue 5xx y errores de conexión de los 4xx), con un
+    circuito para todo el servidor. Ollama y Gemini van por sus propios clientes, donde no se puede
+    distinguir el tipo de fallo: su circuito es por modelo para que un modelo sin descargar no
+    bloquee al resto.
+    """
+    backend = backend_de_modelo(model_key)
+    return CIRCUITO_LMSTUDIO if backend == 'lmstudio' else f'{backend}:{model_key}'
+
+planificadores = {
+    backend: PlanificadorBackend(backend, Config.SCHEDULER_MAX_IN_FLIGHT.get(backend, 1), Config.SCHEDULER_QUEUE_TIMEOUT)
+    for backend in ('lmstudio', 'ollama', 'gemini')
+}
+
+class ModeloPlanificado(Runnable):
+    """Envuelve un modelo para que cada generación pase por el planificador de su backend.
+    
+    Las invocaciones idénticas que coinciden en el tiempo (mismo modelo y mismos mensajes) se
+    agrupan en una sola generación: los backends locales no aceptan lotes de prompts por petición,
+    así que es la forma de micro-batching que sí ahorra trabajo. El paralelismo dentro del servidor
+    (slots de llama.cpp / OLLAMA_NUM_PARALLEL) se aprovecha subiendo SCHEDULER_MAX_IN_FLIGHT.
+    """
+    
+    def __init__(self, modelo, model_key: str):
+        self.modelo = modelo
+        self.model_key = model_key
+        self.planificador = planificadores[backend_de_modelo(model_key)]
+        # LM Studio ya pasa por el circuito de http_client; el resto se protege aquí
+        self.circuito = (obtener_circuito(circuito_de_modelo(model_key))
+                         if Config.CIRCUIT_ENABLED and backend_de_modelo(model_key) != 'lmstudio' else None)
+        self._en_curso = {}
+        self._en_curso_lock = threading.Lock()
+    
+    def _clave(self, entrada, kwargs) -> Optional[str]:
+        if not Config.SCHEDULER_COALESCE:
+            return None
+        try:
+            return hashlib.sha256(lc_dumps([entrada, kwargs]).encode('utf-8')).hexdigest()
+        except Exception:
+            return None
+    
+    @staticmethod
+    def _anotar(mensaje, turno: Dict, agrupada: bool = False):
+        if isinstance(mensaje, BaseMessage):
+            mensaje.response_metadata['cola'] = {**turno, 'agrupada': agrupada} if agrupada else turno
+        return mensaje
+    
+    def _proteger(self):
+        return self.circuito.proteger() if self.circuito is not None else contextlib.nullcontext()
+    
+    def _lider_o_seguidor(self, clave: Optional[str]) -> Tuple[bool, Optional[concurrent.futures.Future]]:
+        if clave is None:
+            return True, None
+        with self._en_curso_lock:
+            futuro = self._en_curso.get(clave)
+            if futuro is not None:
+                return False, futuro
+            futuro = concurrent.futures.Future()
+            self._en_curso[clave] = futuro
+            return True, futuro
+    
+    def _terminar(self, clave: Optional[str], futuro: Optional[concurrent.futures.Future], resultado=None, error=None):
+        if futuro is None:
+            return
+        with self._en_curso_lock:
+            self._en_curso.pop(clave, None)
+        if error is not None:
+            futuro.set_exception(error)
+        else:
+            futuro.set_result(resultado)
+    
+    def invoke(self, input, config=None, **kwargs):
+        comprobar_cancelacion()
+        clave = self._clave(input, kwargs)
+        lider, futuro = self._lider_o_seguidor(clave)
+        if not lider:
+            try:
+                # La espera por la generación de otra petición no pasa del plazo de esta
+                mensaje, turno = esperar_resultado(futuro)
+                return self._anotar(mensaje.model_copy(deep=True), turno, agrupada=True)
+            except PeticionCanceladaError:
+                # Se canceló la petición que generaba, no esta: generar por cuenta propia
+                comprobar_cancelacion()
+                clave, futuro = None, None
+        
+        try:
+            with self.planificador.turno() as turno, self._proteger(), enrutador.medir(self.model_key) as medicion:
+                mensaje = self.modelo.invoke(input, config, **kwargs)
+                medicion['omitir'] = bool(mensaje.response_metadata.get('cache_hit'))
+        except BaseException as e:
+            # Los seguidores nunca se quedan colgados: con una interrupción la repiten por su cuenta
+            self._terminar(clave, futuro, error=e if isinstance(e, Exception) else PeticionCanceladaError('generación interrumpida'))
+            raise
+        self._terminar(clave, futuro, (mensaje, turno))
+        return self._anotar(mensaje, turno)
+    
+    async def ainvoke(self, input, config=None, **kwargs):
+        comprobar_cancelacion()
+        clave = self._clave(input, kwargs)
+        lider, futuro = self._lider_o_seguidor(clave)
+        if not lider:
+            try:
+                mensaje, turno = await esperar_resultado_async(futuro)
+                return self._anotar(mensaje.model_copy(deep=True), turno, agrupada=True)
+            except PeticionCanceladaError:
+                comprobar_cancelacion()
+                clave, futuro = None, None
+        
+        try:
+            async with self.planificador.turno_async() as turno:
+                with self._proteger(), enrutador.medir(self.model_key) as medicion:
+                    mensaje = await self.modelo.ainvoke(input, config, **kwargs)
+                    medicion['omitir'] = bool(mensaje.response_metadata.get('cache_hit'))
+        except BaseException as e:
+            # Los seguidores de una generación cancelada la repiten por su cuenta
+            self._terminar(clave, futuro, error=e if isinstance(e, Exception) else PeticionCanceladaError('generación cancelada'))
+            raise
+        self._terminar(clave, futuro, (mensaje, turno))
+        return self._anotar(mensaje, turno)
+    
+    def stream(self, input, config=None, **kwargs):
+        comprobar_cancelacion()
+        with self.planificador.turno() as turno, self._proteger(), enrutador.medir(self.model_key):
+            primero = True
+            for chunk in self.modelo.stream(input, config, **kwargs):
+                if primero:
+                    self._anotar(chunk, turno)
+                    primero = False
+                yield chunk
+    
+    async def astream(self, input, config=None, **kwargs):
+        comprobar_cancelacion()
+        async with self.planificador.turno_async() as turno:
+            with self._proteger(), enrutador.medir(self.model_key):
+                primero = True
+                async for chunk in self.modelo.astream(input, config, **kwargs):
+                    if primero:
+                        self._anotar(chunk, turno)
+                        primero = False
+                    yield chunk
+
+# ================================
+# ENRUTADOR DE MODELOS
+# ================================
+
+POLITICAS_ENRUTADO = ('preferido', 'rapido', 'barato', 'fijo')
+
+class SaludModelo:
+    """Ventana de las últimas generaciones de un modelo: latencias, resultados y fallos seguidos"""
+    
+    def __init__(self, ventana: int):
+        self.latencias = deque(maxlen=ventana)
+        self.resultados = deque(maxlen=ventana)  # True = éxito
+        self.fallos_seguidos = 0
+        self.ultimo_fallo = None
+        self.ultimo_error = None
+    
+    def percentil(self, p: float) -> Optional[float]:
+        return round(float(np.percentile(self.latencias, p)), 3) if self.latencias else None
+    
+    def tasa_error(self) -> float:
+        return round(1 - sum(self.resultados) / len(self.resultados), 3) if self.resultados else 0.0
+
+class EnrutadorModelos:
+    """Elige entre modelos equivalentes según su salud, latencia reciente y la política pedida.
+    
+    Un modelo está sano si su backend responde, no acumula ROUTER_MAX_FAILURES fallos seguidos y
+    su tasa de error no supera ROUTER_MAX_ERROR_RATE. Pasado ROUTER_COOLDOWN desde el último fallo
+    vuelve a ser candidato, así se detecta cuando el backend se recupera.
+    """
+    
+    def __init__(self, grupos: Dict[str, List[str]], costes: Dict[str, float], ventana: int):
+        self.grupos = grupos
+        self.costes = costes
+        self.ventana = ventana
+        self._salud = {}
+        self._lock = threading.Lock()
+    
+    def _salud_de(self, model_key: str) -> SaludModelo:
+        salud = self._salud.get(model_key)
+        if salud is None:
+            salud = self._salud.setdefault(model_key, SaludModelo(self.ventana))
+        return salud
+    
+    def registrar(self, model_key: str, duracion: float, exito: bool, error: Optional[Exception] = None):
+        with self._lock:
+            salud = self._salud_de(model_key)
+            salud.resultados.append(exito)
+            if exito:
+                salud.latencias.append(duracion)
+                salud.fallos_seguidos = 0
+            else:
+                salud.fallos_seguidos += 1
+                salud.ultimo_fallo = time.time()
+                salud.ultimo_error = str(error)[:200] if error is not None else None
+    
+    @contextlib.contextmanager
+    def medir(self, model_key: str):
+        """Mide una generación; el bloque puede marcar medicion['omitir'] (p. ej. aciertos de caché)"""
+        medicion = {'omitir': False}
+        inicio = time.time()
+        try:
+            yield medicion
+        except PeticionCanceladaError:
+            # Abandonada por el cliente: no cuenta para la salud del modelo
+            raise
+        except Exception as e:
+            self.registrar(model_key, time.time() - inicio, False, e)
+            raise
+        if not medicion['omitir']:
+            self.registrar(model_key, time.time() - inicio, True)
+    
+    def esta_sano(self, model_key: str) -> bool:
+        if model_key in lmstudio_models:
+            # Vuelve a sondear LM Studio pasado LMSTUDIO_CHECK_INTERVAL: detecta que arrancó o cayó
+            lmstudio_disponible()
+        if model_key not in available_models:
+            return False
+        # Con el circuito abierto la llamada fallaría al instante
+        if Config.CIRCUIT_ENABLED and not obtener_circuito(circuito_de_modelo(model_key)).disponible():
+            return False
+        salud = self._salud.get(model_key)
+        if salud is None or salud.ultimo_fallo is None:
+            return True
+        if time.time() - salud.ultimo_fallo >= Config.ROUTER_COOLDOWN:
+            return True
+        with self._lock:
+            if salud.fallos_seguidos >= Config.ROUTER_MAX_FAILURES:
+                return False
+            return len(salud.resultados) < Config.ROUTER_MIN_SAMPLES or salud.tasa_error() <= Config.ROUTER_MAX_ERROR_RATE
+    
+    def latencia_estimada(self, model_key: str) -> Optional[float]:
+        """p50 reciente, penalizado por la cola que tenga ahora su backend"""
+        salud = self._salud.get(model_key)
+        with self._lock:
+            p50 = salud.percentil(50) if salud else None
+        if p50 is None:
+            return None
+        planificador = planificadores[backend_de_modelo(model_key)]
+        return p50 * (1 + planificador.en_cola() / planificador.max_en_vuelo)
+    
+    def equivalentes(self, model_key: str) -> List[str]:
+        """El modelo pedido seguido de los de su grupo de equivalencia"""
+        resultado = [model_key]
+        for miembros in self.grupos.values():
+            if model_key in miembros:
+                resultado.extend(m for m in miembros if m not in resultado)
+        return resultado
+    
+    def candidatos(self, model_key: str, politica: Optional[str] = None) -> List[str]:
+        """Modelos a probar en orden según la política; nunca devuelve una lista vacía"""
+        politica = politica if politica in POLITICAS_ENRUTADO else Config.ROUTER_POLICY
+        if politica == 'fijo':
+            return [model_key]
+        
+        orden = self.equivalentes(model_key)
+        sanos = [m for m in orden if self.esta_sano(m) and models.get(m) is not None]
+        if not sanos:
+            # Ninguno responde: mantener el pedido para que su propio manejo de errores conteste
+            return [model_key]
+        
+        if politica == 'rapido':
+            latencias = {m: self.latencia_estimada(m) for m in sanos}
+            sanos.sort(key=lambda m: (latencias[m] is None, latencias[m] or 0.0, m != model_key, orden.index(m)))
+        elif politica == 'barato':
+            sanos.sort(key=lambda m: (self.costes.get(m, 1.0), m != model_key, orden.index(m)))
+        elif model_key in sanos:
+            # 'preferido': el pedido primero y el resto como reserva, del más rápido al más lento
+            latencias = {m: self.latencia_estimada(m) for m in sanos}
+            sanos.sort(key=lambda m: (m != model_key, latencias[m] is None, latencias[m] or 0.0, orden.index(m)))
+        return sanos
+    
+    def elegir(self, model_key: str, politica: Optional[str] = None) -> Tuple[List[str], Dict]:
+        """Devuelve los candidatos y la información de enrutado que viaja en la metadata"""
+        politica = politica if politica in POLITICAS_ENRUTADO else Config.ROUTER_POLICY
+        candidatos = self.candidatos(model_key, politica)
+        if candidatos[0] != model_key:
+            print(f"🔀 Enrutando {model_key} → {candidatos[0]} (política {politica})")
+        return candidatos, {'solicitado': model_key, 'usado': candidatos[0], 'politica': politica}
+    
+    def resumen(self) -> Dict:
+        resultado = {}
+        for model_key in modelos_configurados:
+            salud = self._salud.get(model_key)
+            with self._lock:
+                datos = {
+                    'p50': salud.percentil(50),
+                    'p95': salud.percentil(95),
+                    'tasa_error': salud.tasa_error(),
+                    'muestras': len(salud.resultados),
+                    'fallos_seguidos': salud.fallos_seguidos,
+                    'ultimo_error': salud.ultimo_error
+                } if salud else {'p50': None, 'p95': None, 'tasa_error': 0.0, 'muestras': 0, 'fallos_seguidos': 0, 'ultimo_error': None}
+            datos['sano'] = self.esta_sano(model_key)
+            datos['coste'] = self.costes.get(model_key, 1.0)
+            resultado[model_key] = datos
+        return resultado
+
+enrutador = EnrutadorModelos(Config.ROUTER_EQUIVALENTS, Config.ROUTER_COSTS, Config.ROUTER_WINDOW)
+
+# ================================
+# MONITOR DE BACKENDS
+# ================================
+
+def sondear_backends() -> Dict:
+    """Consulta el inventario de Ollama (/api/tags, /api/ps) y LM Studio (/v1/models)"""
+    inventario = {
+        'ollama': {'available': False, 'models': [], 'running': []},
+        'lmstudio': {'available': False, 'models': []},
+        'gemini': {'available': bool(Config.GOOGLE_API_KEY)}
+    }
+    
+    try:
+        response = http_get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=5)
+        if response.status_code == 200:
+            inventario['ollama']['available'] = True
+            inventario['ollama']['models'] = response.json().get('models', [])
+            response = http_get(f"{Config.OLLAMA_BASE_URL}/api/ps", timeout=5)
+            if response.status_code == 200:
+                inventario['ollama']['running'] = response.json().get('models', [])
+    except Exception:
+        pass
+    
+    try:
+        response = http_get(f"{Config.LMSTUDIO_BASE_URL}/v1/models", timeout=5)
+        if response.status_code == 200:
+            inventario['lmstudio']['available'] = True
+            inventario['lmstudio']['models'] = response.json().get('data', [])
+    except Exception:
+        pass
+    
+    return inventario
+
+class MonitorBackends:
+    """Hilo que sondea los backends cada HEALTH_MONITOR_INTERVAL segundos (con jitter).
+    
+    Guarda la última instantánea en memoria; `version` solo cambia cuando cambia el inventario,
+    y los suscriptores del canal SSE esperan ese cambio con esperar_cambio() (o
+    esperar_cambio_async() desde el event loop).
+    """
+    
+    def __init__(self, intervalo: float, jitter: float):
+        self.intervalo = intervalo
+        self.jitter = jitter
+        self.inventario = None
+        self.version = 0
+        self.cambiado = None
+        self.sondeado = None
+        self._huella = None
+        self._cambio = threading.Condition()
+        self._esperas_async = set()  # (loop, asyncio.Event) de quien espera desde asyncio
+        self._despertar = threading.Event()
+        self._hilo = None
+    
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._bucle, name='monitor-backends', daemon=True)
+            self._hilo.start()
+    
+    def activo(self) -> bool:
+        return self._hilo is not None
+    
+    def _bucle(self):
+        while True:
+            self.actualizar()
+            espera = self.intervalo * (1 + random.uniform(-self.jitter, self.jitter))
+            self._despertar.wait(espera)
+            self._despertar.clear()
+    
+    def actualizar(self):
+        try:
+            inventario = sondear_backends()
+        except Exception as e:
+            print(f"⚠️ Error en el monitor de backends: {e}")
+            return
+        registrar_estado_lmstudio(inventario['lmstudio']['available'])
+        huella = json.dumps(inventario, sort_keys=True, default=str)
+        with self._cambio:
+            self.sondeado = time.time()
+            if huella != self._huella:
+                self._huella = huella
+                self.inventario = inventario
+                self.version += 1
+                self.cambiado = self.sondeado
+                self._cambio.notify_all()
+                for loop, evento in self._esperas_async:
+                    loop.call_soon_threadsafe(evento.set)
+    
+    def refrescar(self):
+        """Adelanta el próximo sondeo (p. ej. tras arrancar o detener un backend)"""
+        self._despertar.set()
+    
+    def instantanea(self, espera_maxima: float = 10) -> Dict:
+        """Último inventario; sin monitor (o antes del primer sondeo) se consulta en el momento"""
+        if not self.activo():
+            return sondear_backends()
+        with self._cambio:
+            self._cambio.wait_for(lambda: self.inventario is not None, espera_maxima)
+            if self.inventario is not None:
+                return self.inventario
+        return sondear_backends()
+    
+    def esperar_cambio(self, version: int, timeout: float) -> bool:
+        """Bloquea hasta que haya una versión más nueva que `version` o pase el timeout"""
+        with self._cambio:
+            return self._cambio.wait_for(lambda: self.version > version, timeout)
+    
+    async def esperar_cambio_async(self, version: int, timeout: float) -> bool:
+        """Como esperar_cambio(), pero espera en el event loop sin ocupar un hilo"""
+        espera = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cambio:
+            if self.version > version:
+                return True
+            self._esperas_async.add(espera)
+        try:
+            await asyncio.wait_for(espera[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cambio:
+                self._esperas_async.discard(espera)
+        return self.version > version
+    
+    def resumen(self) -> Dict:
+        return {
+            'activo': self.activo(),
+            'version': self.version,
+            'cambiado': self.cambiado,
+            'intervalo': self.intervalo
+        }
+
+monitor_backends = MonitorBackends(Config.HEALTH_MONITOR_INTERVAL, Config.HEALTH_MONITOR_JITTER)
+if Config.HEALTH_MONITOR_ENABLED:
+    monitor_backends.iniciar()
+
+# ================================
+# CLASIFICACIÓN DE INTENCIÓN
+# ================================
+
+# Detección inteligente para forzar modo agente cuando se necesite información actual
+PALABRAS_ACTUALIDAD = [
+    'noticias', 'news', 'actualidad', 'hoy', 'today', 'actual', 'reciente', 
+    'precio', 'price', 'cotización', 'último', 'latest', 'breaking',
+    'eventos', 'acontecimiento', 'qué pasó', 'qué está pasando'
+]
+
+# Detección de comandos Ollama para activar modo agente
+PALABRAS_OLLAMA = [
+    'ollama ps', 'ollama list', 'ollama serve', 'ollama run', 'ollama stop', 
+    'ollama show', 'ollama pull', 'modelos ollama', 'ver modelos', 
+    'ejecutar modelo', 'detener modelo', 'instalar modelo', 'descargar modelo',
+    'estado ollama', 'servicio ollama', 'gestionar ollama', 'comandos ollama'
+]
+
+# Palabras clave por etiqueta de intención (se buscan como subcadenas, sin distinguir tildes)
+PALABRAS_INTENCION = {
+    'actualidad': PALABRAS_ACTUALIDAD,
+    'ollama': PALABRAS_OLLAMA,
+    'clima': ['clima', 'weather', 'temperatura', 'temperature', 'tiempo'],
+    'noticias': ['noticias', 'news', 'hoy', 'today', 'actualidad'],
+    # Temas con variantes de búsqueda propias en /busqueda-rapida
+    'precio': ['precio'],
+    'bitcoin': ['bitcoin'],
+    'openai': ['openai'],
+    'deportes': ['champions', 'deportes'],
+    'petroleo': ['petróleo', 'oil']
+}
+
+# Gazetteer de ciudades: nombre para la API de clima -> formas en que aparece en una pregunta.
+# Los alias se comparan como palabras completas y respetando tildes ("quitó" no es "quito"),
+# por eso se listan las variantes con y sin tilde. Config.INTENT_CITIES añade o reemplaza ciudades.
+CIUDADES = {
+    'Quito': ['quito'],
+    'Guayaquil': ['guayaquil'],
+    'Cuenca': ['cuenca'],
+    'Ambato': ['ambato'],
+    'Loja': ['loja'],
+    'Manta': ['manta'],
+    'Lima': ['lima'],
+    'Bogota': ['bogotá', 'bogota'],
+    'Medellin': ['medellín', 'medellin'],
+    'Caracas': ['caracas'],
+    'Santiago': ['santiago de chile'],
+    'Buenos Aires': ['buenos aires'],
+    'Mexico City': ['ciudad de méxico', 'ciudad de mexico', 'cdmx', 'mexico city'],
+    'Madrid': ['madrid'],
+    'Barcelona': ['barcelona'],
+    'Paris': ['parís', 'paris'],
+    'London': ['london', 'londres'],
+    'New York': ['new york', 'nueva york'],
+    'Miami': ['miami'],
+    'Tokyo': ['tokio', 'tokyo'],
+    **Config.INTENT_CITIES
+}
+
+class Intencion:
+    """Resultado de clasificar una pregunta: etiquetas, palabras que las activaron y ciudad.
+    
+    Se calcula una vez por pregunta y la comparten todas las rutas; no se modifica después.
+    """
+    
+    def __init__(self, etiquetas: Dict[str, List[str]], ciudad: Optional[str], modelo: Optional[Dict] = None):
+        self.etiquetas = etiquetas
+        self.ciudad = ciudad
+        self.modelo = modelo
+    
+    def tiene(self, etiqueta: str) -> bool:
+        return etiqueta in self.etiquetas
+    
+    @property
+    def actualidad(self) -> bool:
+        return self.tiene('actualidad')
+    
+    @property
+    def ollama(self) -> bool:
+        return self.tiene('ollama')
+    
+    @property
+    def clima(self) -> bool:
+        return self.tiene('clima')
+    
+    @property
+    def noticias(self) -> bool:
+        return self.tiene('noticias')
+    
+    @property
+    def necesita_agente(self) -> bool:
+        """Requiere búsqueda web o comandos Ollama (modo agente)"""
+        return self.actualidad or self.ollama
+    
+    def ciudad_o_defecto(self) -> str:
+        return self.ciudad or Config.INTENT_DEFAULT_CITY
+    
+    def a_dict(self) -> Dict:
+        return {'etiquetas': self.etiquetas, 'ciudad': self.ciudad, 'modelo': self.modelo}
+
+class ClasificadorReglas:
+    """Palabras clave y ciudades compiladas en una sola expresión regular cada una.
+    
+    Las palabras clave usan un lookahead en cada posición, así se encuentran todas las apariciones
+    aunque se solapen (igual que comprobar cada palabra con 'in'), en una sola pasada sobre el texto.
+    """
+    
+    def __init__(self, palabras: Dict[str, List[str]], ciudades: Dict[str, List[str]]):
+        self._etiquetas_de = {}
+        for etiqueta, lista in palabras.items():
+            for palabra in lista:
+                self._etiquetas_de.setdefault(quitar_tildes(palabra), set()).add(etiqueta)
+        # En cada posición el lookahead solo devuelve la alternativa más larga: esa palabra hereda
+        # las etiquetas de las que son prefijo suyo ('actualidad' también activa lo que activa 'actual')
+        for palabra, etiquetas in self._etiquetas_de.items():
+            for otra, otras_etiquetas in self._etiquetas_de.items():
+                if otra != palabra and palabra.startswith(otra):
+                    etiquetas |= otras_etiquetas
+        alternativas = sorted(self._etiquetas_de, key=len, reverse=True)
+        self._patron_palabras = re.compile('(?=(' + '|'.join(map(re.escape, alternativas)) + '))')
+        
+        self._ciudad_de = {alias.lower(): ciudad for ciudad, alias_ciudad in ciudades.items() for alias in alias_ciudad}
+        alias = sorted(self._ciudad_de, key=len, reverse=True)
+        self._patron_ciudades = re.compile(r'\b(' + '|'.join(map(re.escape, alias)) + r')\b')
+    
+    def etiquetar(self, texto: str) -> Dict[str, List[str]]:
+        """Etiquetas presentes en un texto ya normalizado, con las palabras que las activaron"""
+        etiquetas = {}
+        for coincidencia in self._patron_palabras.finditer(texto):
+            palabra = coincidencia.group(1)
+            for etiqueta in self._etiquetas_de[palabra]:
+                if palabra not in etiquetas.setdefault(etiqueta, []):
+                    etiquetas[etiqueta].append(palabra)
+        return etiquetas
+    
+    def ciudad(self, texto: str) -> Optional[str]:
+        """Primera ciudad del gazetteer que aparece en el texto (en minúsculas, con tildes)"""
+        coincidencia = self._patron_ciudades.search(texto)
+        return self._ciudad_de[coincidencia.group(1)] if coincidencia else None
+
+class ClasificadorCentroides:
+    """Clasificador local opcional: centroide por etiqueta sobre los vectores de la caché semántica.
+    
+    Se entrena al arrancar con un JSON {etiqueta: [ejemplos]} y devuelve la etiqueta más parecida
+    si su similitud coseno supera el umbral. Sirve para cubrir frases sin palabras clave.
+    """
+    
+    def __init__(self, ejemplos: Dict[str, List[str]], umbral: float, dimension: int):
+        self.umbral = umbral
+        self.dimension = dimension
+        self.etiquetas = list(ejemplos)
+        centroides = []
+        for etiqueta in self.etiquetas:
+            vectores = [vectorizar_pregunta(normalizar_pregunta(ejemplo), dimension) for ejemplo in ejemplos[etiqueta]]
+            centroide = np.mean(vectores, axis=0)
+            norma = np.linalg.norm(centroide)
+            centroides.append(centroide / norma if norma else centroide)
+        self._centroides = np.array(centroides, dtype=np.float32).reshape(len(self.etiquetas), dimension)
+    
+    @classmethod
+    def desde_archivo(cls, ruta: str, umbral: float, dimension: int) -> Optional['ClasificadorCentroides']:
+        try:
+            with open(ruta, encoding='utf-8') as archivo:
+                ejemplos = json.load(archivo)
+            clasificador = cls(ejemplos, umbral, dimension)
+            print(f"🧭 Clasificador de intención local cargado: {len(clasificador.etiquetas)} etiquetas")
+            return clasificador
+        except Exception as e:
+            print(f"⚠️ No se pudo cargar el clasificador de intención '{ruta}': {e}")
+            return None
+    
+    def predecir(self, pregunta: str) -> Optional[Tuple[str, float]]:
+        if not self.etiquetas:
+            return None
+        similitudes = self._centroides @ vectorizar_pregunta(normalizar_pregunta(pregunta), self.dimension)
+        mejor = int(np.argmax(similitudes))
+        similitud = float(similitudes[mejor])
+        return (self.etiquetas[mejor], round(similitud, 3)) if similitud >= self.umbral else None
+
+class ClasificadorIntencion:
+    """Etapa única de intención y entidades: reglas compiladas más el modelo local si está configurado"""
+    
+    def __init__(self, reglas: ClasificadorReglas, modelo: Optional[ClasificadorCentroides] = None):
+        self.reglas = reglas
+        self.modelo = modelo
+    
+    def clasificar(self, pregunta: str) -> Intencion:
+        texto = quitar_tildes(pregunta)
+        etiquetas = self.reglas.etiquetar(texto)
+        info_modelo = None
+        if self.modelo is not None:
+            prediccion = self.modelo.predecir(pregunta)
+            if prediccion:
+                etiqueta, similitud = prediccion
+                info_modelo = {'etiqueta': etiqueta, 'similitud': similitud}
+                etiquetas.setdefault(etiqueta, [])
+        return Intencion(etiquetas, self.reglas.ciudad(pregunta.lower()), info_modelo)
+
+clasificador_intencion = ClasificadorIntencion(
+    ClasificadorReglas(PALABRAS_INTENCION, CIUDADES),
+    ClasificadorCentroides.desde_archivo(
+        Config.INTENT_MODEL_PATH, Config.INTENT_MODEL_THRESHOLD, Config.SEMANTIC_CACHE_DIMENSION
+    ) if Config.INTENT_MODEL_PATH else None
+)
+
+@functools.lru_cache(maxsize=512)
+def clasificar_intencion(pregunta: str) -> Intencion:
+    """Intención de una pregunta (memorizada: ASGI, /chat y las herramientas reutilizan el resultado)"""
+    return clasificador_intencion.clasificar(pregunta)
 
 # Función para obtener el modelo según la selección
 def get_model(model_name: str) -> Optional[Union[ChatOllama, ChatGoogleGenerativeAI, ChatLMStudio]]:
-    """Obtiene el modelo solicitado o el primero disponible como fallback"""
-    if model_name in models and models[model_name] is not None:
-        return models[model_name]
+    """Obtiene el modelo solicitado o, si no está sano, el equivalente que indique el enrutador"""
+    for model_key in enrutador.candidatos(model_name):
+        if models.get(model_key) is not None:
+            if model_key != model_name:
+                print(f"⚠️ Usando {model_key} como fallback")
+            return models[model_key]
     
-    # Fallback al primer modelo disponible
-    for model_key, model_instance in models.items():
-        if model_instance is not None:
+    # Último recurso: cualquier modelo sano
+    for model_key in list(available_models):
+        if enrutador.esta_sano(model_key) and models[model_key] is not None:
             print(f"⚠️ Usando {model_key} como fallback")
-            return model_instance
+            return models[model_key]
     
     return None
 
+def _procesar_datos_clima(data: dict, ciudad: str) -> dict:
+    """Extrae la información relevante de la respuesta JSON de wttr.in"""
+    current = data.get('current_condition', [{}])[0]
+    return {
+        'temperatura': current.get('temp_C', 'N/A'),
+        'descripcion': current.get('weatherDesc', [{}])[0].get('value', 'N/A'),
+        'humedad': current.get('humidity', 'N/A'),
+        'sensacion_termica': current.get('FeelsLikeC', 'N/A'),
+        'velocidad_viento': current.get('windspeedKmph', 'N/A'),
+        'direccion_viento': current.get('winddir16Point', 'N/A'),
+        'hora_consulta': current.get('observation_time', 'N/A'),
+        'ciudad': ciudad
+    }
+
 # Función para obtener clima usando API gratuita
-def obtener_clima_api(ciudad: str = "Quito") -> dict:
+def _consultar_clima_api(ciudad: str) -> dict:
     """Obtiene información del clima usando API gratuita de wttr.in"""
     try:
         # API gratuita que no requiere clave
         url = f"https://wttr.in/{ciudad}?format=j1"
         
         print(f"🌐 Consultando API de clima para {ciudad}...")
-        response = requests.get(url, timeout=10)
+        response = http_get(url, timeout=10)
         
         if response.status_code == 200:
-            data = response.json()
-            
-            # Extraer información relevante
-            current = data.get('current_condition', [{}])[0]
-            weather_info = {
-                'temperatura': current.get('temp_C', 'N/A'),
-                'descripcion': current.get('weatherDesc', [{}])[0].get('value', 'N/A'),
-                'humedad': current.get('humidity', 'N/A'),
-                'sensacion_termica': current.get('FeelsLikeC', 'N/A'),
-                'velocidad_viento': current.get('windspeedKmph', 'N/A'),
-                'direccion_viento': current.get('winddir16Point', 'N/A'),
-                'hora_consulta': current.get('observation_time', 'N/A'),
-                'ciudad': ciudad
-            }
+            weather_info = _procesar_datos_clima(response.json(), ciudad)
             
             print(f"✅ Clima obtenido: {weather_info['temperatura']}°C en {ciudad}")
             return {'success': True, 'data': weather_info}
@@ -750,103 +2741,334 @@ def obtener_clima_api(ciudad: str = "Quito") -> dict:
         print(f"⚠️ Error consultando API de clima: {e}")
         return {'success': False, 'error': str(e)}
 
-# Función para búsqueda web avanzada usando múltiples APIs
-def busqueda_web_avanzada(query: str) -> str:
-    """Búsqueda web usando múltiples métodos para mayor confiabilidad"""
-    print(f"🔍 Búsqueda web avanzada: {query}")
+async def _consultar_clima_api_async(ciudad: str) -> dict:
+    """Versión asíncrona de _consultar_clima_api (no ocupa un hilo mientras espera)"""
+    try:
+        url = f"https://wttr.in/{ciudad}?format=j1"
+        
+        print(f"🌐 Consultando API de clima para {ciudad} (async)...")
+        response = await http_get_async(url, timeout=10)
+        
+        if response.status_code == 200:
+            weather_info = _procesar_datos_clima(response.json(), ciudad)
+            
+            print(f"✅ Clima obtenido: {weather_info['temperatura']}°C en {ciudad}")
+            return {'success': True, 'data': weather_info}
+            
+        else:
+            print(f"⚠️ Error API clima: {response.status_code}")
+            return {'success': False, 'error': f'Error de API: {response.status_code}'}
+            
+    except httpx.TimeoutException:
+        print("⚠️ Timeout al consultar API de clima")
+        return {'success': False, 'error': 'Timeout en consulta'}
+    except Exception as e:
+        print(f"⚠️ Error consultando API de clima: {e}")
+        return {'success': False, 'error': str(e)}
+
+def _clima_cacheable(resultado: dict) -> bool:
+    # Los errores (timeout, 5xx) no se guardan: la siguiente consulta vuelve a intentarlo
+    return bool(resultado.get('success'))
+
+def obtener_clima_api(ciudad: str = "Quito") -> dict:
+    """Clima de la ciudad, servido desde la caché de clima (WEATHER_CACHE_TTL) si está disponible"""
+    return cache_clima.obtener(f'clima:{normalizar_consulta(ciudad)}', lambda: _consultar_clima_api(ciudad),
+                               cacheable=_clima_cacheable)
+
+async def obtener_clima_api_async(ciudad: str = "Quito") -> dict:
+    """Versión asíncrona de obtener_clima_api"""
+    return await cache_clima.obtener_async(f'clima:{normalizar_consulta(ciudad)}',
+                                           lambda: _consultar_clima_api_async(ciudad), cacheable=_clima_cacheable)
+
+def _buscar_duckduckgo(query: str) -> Optional[str]:
+    """Método 1: DuckDuckGo (original)"""
+    try:
+        resultado_ddg = servicio_ddg.buscar(query)
+        if resultado_ddg and len(resultado_ddg.strip()) > 30:
+            print("✅ DuckDuckGo: Resultados obtenidos")
+            return f"[DuckDuckGo] {resultado_ddg}"
+        print("⚠️ DuckDuckGo: Sin resultados útiles")
+    except Exception as e:
+        print(f"⚠️ DuckDuckGo falló: {e}")
+    return None
+
+def _es_consulta_noticias(query: str) -> bool:
+    return clasificar_intencion(query).noticias
+
+# Método 2: para noticias, términos más específicos (se usa el primero, en este orden, que dé resultados)
+QUERIES_NOTICIAS = [
+    "noticias tecnología inteligencia artificial hoy",
+    "noticias Ecuador últimas",
+    "breaking news today",
+    "noticias mundo actualidad"
+]
+
+def _buscar_noticia(query_especifica: str) -> Optional[str]:
+    """Método 2: una de las consultas específicas de noticias"""
+    try:
+        resultado = servicio_ddg.buscar(query_especifica)
+        if resultado and len(resultado.strip()) > 30:
+            print(f"✅ Noticias encontradas para: {query_especifica}")
+            return f"[Noticias {query_especifica}] {resultado[:500]}..."
+    except Exception as e:
+        print(f"⚠️ Búsqueda de noticias '{query_especifica}' falló: {e}")
+    return None
+
+def _buscar_noticias(plazo: float) -> Optional[str]:
+    """Las consultas de noticias en orden, en un solo hilo, hasta la primera con resultados (o el plazo)"""
+    limite = time.monotonic() + plazo
+    for query_especifica in QUERIES_NOTICIAS:
+        comprobar_cancelacion()
+        if time.monotonic() >= limite:
+            break
+        resultado = _buscar_noticia(query_especifica)
+        if resultado:
+            return resultado
+    return None
+
+def _url_api_duckduckgo(query: str) -> str:
+    return f"https://api.duckduckgo.com/?q={query}&format=json&no_html=1&skip_disambig=1"
+
+def _procesar_api_duckduckgo(data: dict) -> List[str]:
+    """Método 3: Extraer resultados de la API de respuestas instantáneas de DuckDuckGo"""
+    resultados = []
+    abstract = data.get('Abstract', '')
+    answer = data.get('Answer', '')
+    
+    if abstract:
+        resultados.append(f"[API Abstract] {abstract}")
+        print("✅ API DuckDuckGo: Abstract obtenido")
+    
+    if answer:
+        resultados.append(f"[API Answer] {answer}")
+        print("✅ API DuckDuckGo: Answer obtenido")
+    return resultados
+
+def _ciudad_consulta_clima(query: str) -> Optional[str]:
+    """Devuelve la ciudad si la consulta es sobre clima, o None si no lo es"""
+    intencion = clasificar_intencion(query)
+    return intencion.ciudad_o_defecto() if intencion.clima else None
+
+def _formatear_clima_busqueda(ciudad: str, clima_data: dict) -> Optional[str]:
+    if not clima_data['success']:
+        return None
+    data = clima_data['data']
+    clima_info = f"Clima actual en {ciudad}: {data['temperatura']}°C, {data['descripcion']}, Humedad: {data['humedad']}%, Viento: {data['velocidad_viento']} km/h"
+    print(f"✅ Clima API: Datos obtenidos para {ciudad}")
+    return f"[Clima API] {clima_info}"
+
+def _consultar_api_duckduckgo(query: str) -> List[str]:
+    response = http_get(_url_api_duckduckgo(query), timeout=5)
+    response.raise_for_status()
+    return _procesar_api_duckduckgo(response.json())
+
+async def _consultar_api_duckduckgo_async(query: str) -> List[str]:
+    response = await http_get_async(_url_api_duckduckgo(query), timeout=5)
+    response.raise_for_status()
+    return _procesar_api_duckduckgo(response.json())
+
+def _buscar_api_duckduckgo(query: str) -> List[str]:
+    """Método 3: API de respuestas instantáneas de DuckDuckGo (los errores no se guardan en caché)"""
+    try:
+        return cache_busqueda.obtener(f'api:{normalizar_consulta(query)}', lambda: _consultar_api_duckduckgo(query))
+    except Exception as e:
+        print(f"⚠️ API DuckDuckGo falló: {e}")
+    return []
+
+async def _buscar_api_duckduckgo_async(query: str) -> List[str]:
+    try:
+        return await cache_busqueda.obtener_async(f'api:{normalizar_consulta(query)}',
+                                                  lambda: _consultar_api_duckduckgo_async(query))
+    except Exception as e:
+        print(f"⚠️ API DuckDuckGo falló: {e}")
+    return []
+
+def _como_lista(resultado: Optional[str]) -> List[str]:
+    return [resultado] if resultado else []
+
+# ================================
+# SERVICIO DE BÚSQUEDA DUCKDUCKGO
+# ================================
+
+# Ejecutor acotado para las búsquedas: varias búsquedas simultáneas no crean hilos sin límite.
+# Copia el contexto al enviar cada tarea, así las búsquedas ven el plazo de su petición.
+ejecutor_busquedas = ContextThreadPoolExecutor(
+    max_workers=Config.SEARCH_MAX_WORKERS, thread_name_prefix='busqueda'
+)
+
+def completadas_en_plazo(ejecutor: concurrent.futures.Executor, tareas: List[Callable[[], Any]], plazo: float,
+                         maximo: Optional[int] = None) -> Iterator[Tuple[int, concurrent.futures.Future]]:
+    """Ejecuta `tareas` y entrega (índice, futuro) de cada una según termina, hasta agotar `plazo`.
+    
+    Como mucho `maximo` tareas (SEARCH_MAX_PER_REQUEST) ocupan el ejecutor a la vez: una búsqueda con
+    muchas variantes no acapara los hilos que comparte con las demás. Al terminar el plazo, o si quien
+    itera deja de pedir, se cancelan las que no han empezado.
+    """
+    maximo = maximo or Config.SEARCH_MAX_PER_REQUEST
+    limite = time.monotonic() + plazo
+    por_lanzar = list(enumerate(tareas))
+    en_curso = {}
+    try:
+        while por_lanzar or en_curso:
+            while por_lanzar and len(en_curso) < maximo:
+                indice, tarea = por_lanzar.pop(0)
+                en_curso[ejecutor.submit(tarea)] = indice
+            hechos, _ = concurrent.futures.wait(en_curso, timeout=max(limite - time.monotonic(), 0),
+                                                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not hechos:
+                return
+            for futuro in hechos:
+                yield en_curso.pop(futuro), futuro
+    finally:
+        for futuro in en_curso:
+            futuro.cancel()
+
+def plazo_busqueda(plazo: Optional[float] = None) -> float:
+    """Plazo de una búsqueda (SEARCH_DEADLINE o el pedido), sin pasar del plazo de la petición"""
+    plazo = plazo or Config.SEARCH_DEADLINE
+    token = token_actual()
+    return token.acotar(plazo) if token is not None else plazo
+
+# Textos que delatan un resultado de búsqueda inútil aunque no venga vacío
+PALABRAS_IRRELEVANTES = [
+    "no se encontraron resultados",
+    "página no encontrada",
+    "error 404",
+    "no hay resultados",
+    "try again later"
+]
+
+def es_resultado_util(resultado: Optional[str]) -> bool:
+    """Un resultado es útil si tiene contenido suficiente y no contiene textos de error"""
+    if not resultado or len(resultado.strip()) <= 50:
+        return False
+    resultado_lower = resultado.lower()
+    return not any(palabra in resultado_lower for palabra in PALABRAS_IRRELEVANTES)
+
+class ServicioBusquedaDDG:
+    """Búsquedas de DuckDuckGo con clientes reutilizables, caché y variantes en paralelo.
     
-    resultados = []
+    Cada hilo conserva su propia instancia de DuckDuckGoSearchRun (se crea una vez por hilo, no
+    una por consulta) y todas las consultas pasan por la caché de búsqueda.
+    """
     
-    # Método 1: DuckDuckGo (original)
-    try:
-        ddg_search = DuckDuckGoSearchRun()
-        resultado_ddg = ddg_search.invoke(query)
-        if resultado_ddg and len(resultado_ddg.strip()) > 30:
-            resultados.append(f"[DuckDuckGo] {resultado_ddg}")
-            print("✅ DuckDuckGo: Resultados obtenidos")
-        else:
-            print("⚠️ DuckDuckGo: Sin resultados útiles")
-    except Exception as e:
-        print(f"⚠️ DuckDuckGo falló: {e}")
+    def __init__(self, cache: CacheResultados, ejecutor: concurrent.futures.ThreadPoolExecutor):
+        self.cache = cache
+        self.ejecutor = ejecutor
+        self._local = threading.local()
     
-    # Método 2: Para noticias específicas, usar términos más específicos
-    if any(palabra in query.lower() for palabra in ['noticias', 'news', 'hoy', 'today', 'actualidad']):
-        try:
-            # Buscar noticias más específicas
-            queries_noticias = [
-                "noticias tecnología inteligencia artificial hoy",
-                "noticias Ecuador últimas",
-                "breaking news today",
-                "noticias mundo actualidad"
-            ]
-            
-            for query_especifica in queries_noticias:
-                try:
-                    ddg_search = DuckDuckGoSearchRun()
-                    resultado = ddg_search.invoke(query_especifica)
-                    if resultado and len(resultado.strip()) > 30:
-                        resultados.append(f"[Noticias {query_especifica}] {resultado[:500]}...")
-                        print(f"✅ Noticias encontradas para: {query_especifica}")
-                        break  # Si encontramos algo, salir del loop
-                except:
-                    continue
-                    
-        except Exception as e:
-            print(f"⚠️ Búsqueda de noticias específicas falló: {e}")
+    def _cliente(self) -> DuckDuckGoSearchRun:
+        cliente = getattr(self._local, 'cliente', None)
+        if cliente is None:
+            cliente = DuckDuckGoSearchRun()
+            self._local.cliente = cliente
+        return cliente
     
-    # Método 3: API de búsqueda alternativa (usando scraping básico)
-    try:
-        # Usar una API pública de búsqueda o scraping básico
-        url = f"https://api.duckduckgo.com/?q={query}&format=json&no_html=1&skip_disambig=1"
-        response = requests.get(url, timeout=5)
+    def buscar(self, query: str) -> str:
+        """Una consulta; las que solo difieren en mayúsculas, tildes o espacios comparten entrada de caché"""
+        comprobar_cancelacion()
+        return self.cache.obtener(f'ddg:{normalizar_consulta(query)}', lambda: self._cliente().invoke(query),
+                                  cacheable=lambda resultado: bool(resultado and resultado.strip()))
+    
+    def _tareas(self, consultas: List[str]) -> List[Callable[[], str]]:
+        return [functools.partial(self.buscar, consulta) for consulta in consultas]
+    
+    def buscar_varias(self, consultas: List[str], plazo: Optional[float] = None) -> Dict[str, Optional[str]]:
+        """Ejecuta las consultas en paralelo; las que fallan o no terminan en el plazo quedan en None"""
+        resultados = {consulta: None for consulta in consultas}
+        for indice, futuro in completadas_en_plazo(self.ejecutor, self._tareas(consultas), plazo_busqueda(plazo)):
+            try:
+                resultados[consultas[indice]] = futuro.result()
+            except Exception as e:
+                print(f"⚠️ Error en búsqueda '{consultas[indice]}': {e}")
+        return resultados
+    
+    def primera_util(self, consultas: List[str], es_util: Callable[[Optional[str]], bool] = es_resultado_util,
+                     plazo: Optional[float] = None) -> Optional[Tuple[str, str]]:
+        """Lanza las variantes en paralelo y devuelve (consulta, resultado) de la primera útil en terminar.
         
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Extraer resultados de la API
-            abstract = data.get('Abstract', '')
-            answer = data.get('Answer', '')
-            
-            if abstract:
-                resultados.append(f"[API Abstract] {abstract}")
-                print("✅ API DuckDuckGo: Abstract obtenido")
-            
-            if answer:
-                resultados.append(f"[API Answer] {answer}")
-                print("✅ API DuckDuckGo: Answer obtenido")
-                
+        Las variantes que aún no han empezado se cancelan; las que ya están en curso terminan en
+        segundo plano y su resultado queda en la caché.
+        """
+        plazo = plazo_busqueda(plazo)
+        for indice, futuro in completadas_en_plazo(self.ejecutor, self._tareas(consultas), plazo):
+            consulta = consultas[indice]
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                print(f"⚠️ Error en búsqueda '{consulta}': {e}")
+                continue
+            if es_util(resultado):
+                print(f"✅ Búsqueda exitosa con: {consulta}")
+                return consulta, resultado
+            print(f"⚠️ Resultado irrelevante con: {consulta}")
+        print(f"⏱️ Ninguna variante útil en {plazo:.1f}s")
+        return None
+
+servicio_ddg = ServicioBusquedaDDG(cache_busqueda, ejecutor_busquedas)
+
+# ================================
+# BÚSQUEDA EN PARALELO (FAN-OUT)
+# ================================
+
+def _fuentes_busqueda(query: str) -> List[str]:
+    """Nombres de las fuentes a consultar, en el orden en que se combinan sus resultados"""
+    fuentes = ['duckduckgo']
+    if _es_consulta_noticias(query):
+        fuentes.append('noticias')
+    fuentes.append('api_duckduckgo')
+    if _ciudad_consulta_clima(query):
+        fuentes.append('clima')
+    return fuentes
+
+def _tarea_fuente(nombre: str, query: str, plazo: float):
+    """Función síncrona que consulta una fuente y devuelve su lista de resultados"""
+    if nombre == 'duckduckgo':
+        return lambda: _como_lista(_buscar_duckduckgo(query))
+    if nombre == 'noticias':
+        return lambda: _como_lista(_buscar_noticias(plazo))
+    if nombre == 'api_duckduckgo':
+        return lambda: _buscar_api_duckduckgo(query)
+    ciudad = _ciudad_consulta_clima(query)
+    return lambda: _como_lista(_formatear_clima_busqueda(ciudad, obtener_clima_api(ciudad)))
+
+async def _tarea_fuente_async(nombre: str, query: str, plazo: float) -> List[str]:
+    """Versión asíncrona: las APIs HTTP usan el cliente asíncrono y DuckDuckGoSearchRun un hilo"""
+    if nombre == 'api_duckduckgo':
+        return await _buscar_api_duckduckgo_async(query)
+    if nombre == 'clima':
+        ciudad = _ciudad_consulta_clima(query)
+        return _como_lista(_formatear_clima_busqueda(ciudad, await obtener_clima_api_async(ciudad)))
+    return await asyncio.to_thread(_tarea_fuente(nombre, query, plazo))
+
+def _medir(funcion, resultado_fuente: Dict):
+    """Ejecuta la fuente registrando su duración y estado en resultado_fuente"""
+    inicio = time.time()
+    try:
+        resultado_fuente['resultados'] = funcion()
+        resultado_fuente['estado'] = 'ok' if resultado_fuente['resultados'] else 'sin_resultados'
     except Exception as e:
-        print(f"⚠️ API DuckDuckGo falló: {e}")
-    
-    # Método 3: Para clima específico, usar nuestra API
-    if any(palabra in query.lower() for palabra in ['clima', 'weather', 'temperatura', 'temperature', 'tiempo']):
-        try:
-            # Extraer ciudad de la consulta
-            ciudad = 'Quito'  # Default
-            if 'quito' in query.lower():
-                ciudad = 'Quito'
-            elif 'guayaquil' in query.lower():
-                ciudad = 'Guayaquil'
-            elif 'cuenca' in query.lower():
-                ciudad = 'Cuenca'
-            elif 'new york' in query.lower() or 'nueva york' in query.lower():
-                ciudad = 'New York'
-            elif 'london' in query.lower() or 'londres' in query.lower():
-                ciudad = 'London'
-            elif 'madrid' in query.lower():
-                ciudad = 'Madrid'
-            
-            clima_data = obtener_clima_api(ciudad)
-            if clima_data['success']:
-                data = clima_data['data']
-                clima_info = f"Clima actual en {ciudad}: {data['temperatura']}°C, {data['descripcion']}, Humedad: {data['humedad']}%, Viento: {data['velocidad_viento']} km/h"
-                resultados.append(f"[Clima API] {clima_info}")
-                print(f"✅ Clima API: Datos obtenidos para {ciudad}")
-                
-        except Exception as e:
-            print(f"⚠️ API Clima falló: {e}")
+        print(f"⚠️ Fuente {resultado_fuente['fuente']} falló: {e}")
+        resultado_fuente['estado'] = 'error'
+    resultado_fuente['segundos'] = round(time.time() - inicio, 2)
+
+def _combinar_fuentes(query: str, fuentes: List[str], por_fuente: Dict[str, Dict], plazo: float) -> str:
+    """Une los resultados en el orden fijo de las fuentes (no en el de llegada) y añade los tiempos"""
+    resultados = []
+    for nombre in fuentes:
+        datos = por_fuente[nombre]
+        if 'segundos' in datos:
+            resultados.extend(datos.get('resultados') or [])
     
-    # Compilar resultados
+    tiempos = ', '.join(
+        f"{nombre} {datos['segundos']}s ({datos['estado']})" if 'segundos' in datos
+        else f"{nombre} >{plazo}s (sin_tiempo)"
+        for nombre, datos in ((n, por_fuente[n]) for n in fuentes)
+    )
+    print(f"⏱️ Fuentes de búsqueda: {tiempos}")
+    return f"{_compilar_resultados_busqueda(query, resultados)}\n\n[Fuentes consultadas] {tiempos}"
+
+def _compilar_resultados_busqueda(query: str, resultados: List[str]) -> str:
     if resultados:
         resultado_final = "\n\n".join(resultados)
         print(f"✅ Búsqueda completada con {len(resultados)} fuentes")
@@ -855,13 +3077,77 @@ def busqueda_web_avanzada(query: str) -> str:
         print("❌ No se obtuvieron resultados de ninguna fuente")
         return f"No se pudo obtener información actualizada sobre '{query}'. Se recomienda consultar fuentes directas como Google, sitios web oficiales o aplicaciones especializadas."
 
+# Función para búsqueda web avanzada usando múltiples APIs
+def busqueda_web_avanzada(query: str) -> str:
+    """Búsqueda web usando múltiples métodos a la vez, con un plazo global (SEARCH_DEADLINE).
+    
+    Las fuentes que no terminan a tiempo se descartan; las que sí, se combinan en orden fijo.
+    """
+    print(f"🔍 Búsqueda web avanzada: {query}")
+    comprobar_cancelacion()
+    
+    plazo = plazo_busqueda()
+    fuentes = _fuentes_busqueda(query)
+    por_fuente = {nombre: {'fuente': nombre} for nombre in fuentes}
+    tareas = [
+        functools.partial(_medir, _tarea_fuente(nombre, query, plazo), por_fuente[nombre])
+        for nombre in fuentes
+    ]
+    for _ in completadas_en_plazo(ejecutor_busquedas, tareas, plazo):
+        pass
+    # Si la petición se canceló mientras tanto, el agente no debe seguir con estos resultados
+    comprobar_cancelacion()
+    
+    # Copia: una fuente que termine después del plazo no debe alterar el resultado ya combinado
+    return _combinar_fuentes(query, fuentes, {n: dict(d) for n, d in por_fuente.items()}, round(plazo, 1))
+
+async def busqueda_web_avanzada_async(query: str) -> str:
+    """Versión asíncrona de busqueda_web_avanzada.
+    
+    Las APIs HTTP (respuestas instantáneas, clima) usan el cliente asíncrono; DuckDuckGoSearchRun
+    solo tiene implementación síncrona y se ejecuta en el executor por defecto.
+    """
+    print(f"🔍 Búsqueda web avanzada (async): {query}")
+    comprobar_cancelacion()
+    
+    plazo = plazo_busqueda()
+    fuentes = _fuentes_busqueda(query)
+    por_fuente = {nombre: {'fuente': nombre} for nombre in fuentes}
+    
+    async def medir_async(nombre: str):
+        inicio = time.time()
+        try:
+            por_fuente[nombre]['resultados'] = await _tarea_fuente_async(nombre, query, plazo)
+            por_fuente[nombre]['estado'] = 'ok' if por_fuente[nombre]['resultados'] else 'sin_resultados'
+        except Exception as e:
+            print(f"⚠️ Fuente {nombre} falló: {e}")
+            por_fuente[nombre]['estado'] = 'error'
+        por_fuente[nombre]['segundos'] = round(time.time() - inicio, 2)
+    
+    tareas = [asyncio.create_task(medir_async(nombre)) for nombre in fuentes]
+    _, pendientes = await asyncio.wait(tareas, timeout=plazo)
+    for tarea in pendientes:
+        tarea.cancel()
+    comprobar_cancelacion()
+    
+    return _combinar_fuentes(query, fuentes, por_fuente, round(plazo, 1))
+
 # Crear herramienta personalizada para búsqueda web
 def crear_herramienta_busqueda():
     """Crea una herramienta de búsqueda web personalizada"""
     return Tool(
         name="web_search",
         description="Busca información actual en internet sobre cualquier tema. Útil para noticias, precios, eventos actuales, etc. Input debe ser una consulta de búsqueda específica.",
-        func=busqueda_web_avanzada
+        func=busqueda_web_avanzada,
+        coroutine=busqueda_web_avanzada_async
+    )
+
+def crear_herramienta_duckduckgo():
+    """DuckDuckGo directo (como DuckDuckGoSearchRun) pero compartiendo la caché de búsqueda"""
+    return Tool(
+        name="duckduckgo_search",
+        description=DuckDuckGoSearchRun().description,
+        func=servicio_ddg.buscar
     )
 
 def ejecutar_comando_ollama(command: str) -> str:
@@ -980,7 +3266,7 @@ Quito tiene un clima subtropical de montaña con temperaturas relativamente esta
 # Configurar herramientas para el agente
 herramienta_busqueda = crear_herramienta_busqueda()
 herramienta_ollama = crear_herramienta_ollama()
-tools = [herramienta_busqueda, herramienta_ollama, DuckDuckGoSearchRun()]
+tools = [herramienta_busqueda, herramienta_ollama, crear_herramienta_duckduckgo()]
 
 # Prompt optimizado para búsquedas generales
 agent_prompt = PromptTemplate.from_template("""
@@ -1009,7 +3295,7 @@ COMANDOS OLLAMA DISPONIBLES:
 Formato OBLIGATORIO:
 Question: la pregunta que debes responder
 Thought: necesito buscar información actual sobre [tema específico] O necesito ejecutar comando Ollama [comando]
-Action: duckduckgo_search O web_search O ollama_command
+Action: la herramienta a usar, debe ser una de [{tool_names}]
 Action Input: [términos de búsqueda específicos] O [comando ollama sin 'ollama']
 Observation: [resultados de la búsqueda o comando]
 Thought: ahora tengo información actual y puedo responder
@@ -1019,28 +3305,377 @@ Pregunta: {input}
 Thought:{agent_scratchpad}
 """)
 
-# Crear el agente con manejo de errores y herramientas mejoradas
-agents = {}
-for model_name, model_instance in models.items():
-    if model_instance is not None:
+# Prompt ReAct estándar (hwchase17/react) incluido en la aplicación: no requiere internet
+REACT_PROMPT_TEMPLATE = """Answer the following questions as best you can. You have access to the following tools:
+
+{tools}
+
+Use the following format:
+
+Question: the input question you must answer
+Thought: you should always think about what to do
+Action: the action to take, should be one of [{tool_names}]
+Action Input: the input to the action
+Observation: the result of the action
+... (this Thought/Action/Action Input/Observation can repeat N times)
+Thought: I now know the final answer
+Final Answer: the final answer to the original input question
+
+Begin!
+
+Question: {input}
+Thought:{agent_scratchpad}"""
+
+def _leer_cache_prompt() -> Optional[Dict]:
+    """Lee la copia en disco del último prompt descargado del hub"""
+    try:
+        with open(Config.AGENT_PROMPT_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _descargar_prompt_hub(referencia: str) -> Optional[str]:
+    """Descarga el prompt del hub de LangChain y lo guarda en la caché de disco"""
+    try:
+        prompt = hub.pull(referencia)
+        with open(Config.AGENT_PROMPT_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump({"referencia": referencia, "template": prompt.template, "fecha": datetime.datetime.now().isoformat()}, f, ensure_ascii=False, indent=2)
+        print(f"✅ Prompt '{referencia}' descargado del hub y guardado en caché")
+        return prompt.template
+    except Exception as e:
+        print(f"⚠️ No se pudo descargar el prompt '{referencia}' del hub: {e}")
+        return None
+
+def _template_react() -> str:
+    """Template ReAct: caché de disco si coincide la versión pedida, hub si se pide, o el incluido"""
+    referencia = Config.AGENT_PROMPT_HUB_REF
+    if referencia:
+        cache = _leer_cache_prompt()
+        # La referencia puede fijar un commit (ej: 'hwchase17/react:d15fe3c4'); si cambia se vuelve a descargar
+        if cache and cache.get('referencia') == referencia and cache.get('template'):
+            return cache['template']
+        template = _descargar_prompt_hub(referencia)
+        if template:
+            return template
+        if cache and cache.get('template'):
+            print("⚠️ Usando la copia en caché del prompt ReAct")
+            return cache['template']
+    return REACT_PROMPT_TEMPLATE
+
+@functools.lru_cache(maxsize=None)
+def obtener_prompt_agente(nombre: str = None) -> PromptTemplate:
+    """Prompt compartido por todos los agentes ('react' o 'personalizado'), parseado una sola vez"""
+    nombre = nombre or Config.AGENT_PROMPT
+    if nombre == 'personalizado':
+        return agent_prompt
+    if nombre != 'react':
+        print(f"⚠️ Prompt de agente '{nombre}' desconocido, usando 'react'")
+    return PromptTemplate.from_template(_template_react())
+
+# ================================
+# TRAZAS DEL AGENTE
+# ================================
+
+PATRON_THINK = re.compile(r'<think>(.*?)</think>', re.DOTALL | re.IGNORECASE)
+
+HERRAMIENTAS_BUSQUEDA = ('web_search', 'duckduckgo_search')
+
+def _recortar(texto: str, limite: int) -> str:
+    return texto[:limite] + '...' if len(texto) > limite else texto
+
+def _pensamiento_de_log(log: str, marcador: str) -> str:
+    """Texto de 'Thought:' de un paso ReAct (lo anterior a 'Action:' o 'Final Answer:'), sin bloques <think>"""
+    pensamiento = PATRON_THINK.sub('', log.split(marcador)[0])
+    return pensamiento.replace('Thought:', '').strip()
+
+class TrazaAgente(BaseCallbackHandler):
+    """Traza estructurada de una ejecución del agente; se crea una por petición.
+    
+    Recibe los eventos por callbacks de LangChain: cada llamada al modelo (duración, tokens y
+    bloques <think>), cada acción con su pensamiento y cada herramienta con su entrada, observación
+    y duración. Al ser propia de la petición, las ejecuciones simultáneas no mezclan su salida.
+    
+    Si se indica al_evento(tipo, datos), además se notifica cada evento en cuanto ocurre ('paso',
+    'observacion', 'pensamiento', 'modelo' y 'token' con el texto de la respuesta final).
+    """
+    
+    # Los eventos se procesan en el mismo hilo/event loop del agente, en orden
+    run_inline = True
+    
+    def __init__(self, al_evento: Optional[Callable[[str, Dict], None]] = None):
+        self.inicio = time.time()
+        self.al_evento = al_evento
+        self.pasos: List[Dict] = []
+        self.llamadas_modelo: List[Dict] = []
+        self.pensamientos: List[str] = []
+        self.respuesta_final: Optional[str] = None
+        self._inicios: Dict[Any, float] = {}
+        self._paso_de_herramienta: Dict[Any, Dict] = {}
+        self._accion_pendiente: Optional[Dict] = None
+        self._bloques_think = 0
+        self._textos: Dict[Any, str] = {}
+    
+    def _emitir(self, tipo: str, datos: Dict):
+        if self.al_evento is not None:
+            self.al_evento(tipo, datos)
+    
+    def _pensar(self, texto: str):
+        self.pensamientos.append(texto)
+        self._emitir('pensamiento', {'texto': texto})
+    
+    def _duracion(self, run_id) -> float:
+        return round(time.time() - self._inicios.pop(run_id, time.time()), 3)
+    
+    # Modelo
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._inicios[run_id] = time.time()
+    
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._inicios[run_id] = time.time()
+    
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        """Solo se llama si el modelo transmite (astream_events); emite lo que sigue a 'Final Answer:'"""
+        anterior = self._textos.get(run_id, '')
+        texto = self._textos[run_id] = anterior + (token or '')
+        posicion = texto.find('Final Answer:')
+        if posicion < 0:
+            return
+        nuevo = texto[max(posicion + len('Final Answer:'), len(anterior)):]
+        if len(anterior) <= posicion + len('Final Answer:'):
+            nuevo = nuevo.lstrip()
+        if nuevo:
+            self._emitir('token', {'contenido': nuevo})
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._textos.pop(run_id, None)
+        texto, razonamiento, uso = '', None, None
+        for generaciones in response.generations:
+            for generacion in generaciones:
+                texto += generacion.text or ''
+                mensaje = getattr(generacion, 'message', None)
+                if mensaje is not None:
+                    uso = getattr(mensaje, 'usage_metadata', None) or uso
+                    razonamiento = mensaje.additional_kwargs.get('reasoning_content') or razonamiento
+        uso = uso or (response.llm_output or {}).get('token_usage') or {}
+        tokens = {
+            'input_tokens': uso.get('input_tokens', uso.get('prompt_tokens', 0)) or 0,
+            'output_tokens': uso.get('output_tokens', uso.get('completion_tokens', 0)) or 0
+        }
+        self.llamadas_modelo.append({'duracion': self._duracion(run_id), **tokens})
+        self._emitir('modelo', self.llamadas_modelo[-1])
+        
+        bloques = PATRON_THINK.findall(texto) + ([razonamiento] if razonamiento else [])
+        for bloque in bloques:
+            if bloque.strip():
+                self._bloques_think += 1
+                self._pensar(f"💭 <think> {self._bloques_think}: {bloque.strip()}")
+    
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._textos.pop(run_id, None)
+        self.llamadas_modelo.append({'duracion': self._duracion(run_id), 'error': str(error)})
+    
+    # Agente
+    def on_agent_action(self, action, *, run_id, **kwargs):
+        paso = {
+            'step': len(self.pasos) + 1,
+            'action': action.tool,
+            'action_input': action.tool_input,
+            'observation': '',
+            'thought': _pensamiento_de_log(action.log, 'Action:') or f"Ejecutando {action.tool}",
+            'duracion': None
+        }
+        self.pasos.append(paso)
+        self._accion_pendiente = paso
+        self._emitir('paso', dict(paso))
+        
+        numero = paso['step']
+        if paso['thought'] != f"Ejecutando {action.tool}":
+            self._pensar(f"🧠 Thought {numero}: {paso['thought']}")
+        self._pensar(f"📝 Action Input {numero}: {action.tool_input}")
+        if action.tool in HERRAMIENTAS_BUSQUEDA:
+            self._pensar(f"🔍 Realizando búsqueda: '{action.tool_input}'")
+        self._pensar(f"💭 Paso {numero}: Usando herramienta '{action.tool}' con entrada: '{action.tool_input}'")
+    
+    def on_agent_finish(self, finish, *, run_id, **kwargs):
+        self.respuesta_final = finish.return_values.get('output')
+        pensamiento = _pensamiento_de_log(finish.log, 'Final Answer:')
+        if pensamiento and pensamiento != (self.respuesta_final or '').strip():
+            self._pensar(f"🧠 Thought final: {pensamiento}")
+    
+    # Herramientas
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._inicios[run_id] = time.time()
+        # La herramienta que empieza es la de la última acción del agente
+        if self._accion_pendiente is not None:
+            self._paso_de_herramienta[run_id] = self._accion_pendiente
+            self._accion_pendiente = None
+    
+    def _cerrar_herramienta(self, run_id, observacion: str):
+        duracion = self._duracion(run_id)
+        paso = self._paso_de_herramienta.pop(run_id, None)
+        if paso is None:
+            return
+        paso['observation'] = _recortar(observacion, 500)
+        paso['duracion'] = duracion
+        self._emitir('observacion', {'step': paso['step'], 'observation': _recortar(observacion, 300), 'duracion': duracion})
+        self._pensar(f"📋 Resultado ({duracion}s): {_recortar(observacion, 300)}")
+        if "No good" in observacion:
+            self._pensar("⚠️ Búsqueda sin resultados útiles, intentando método alternativo")
+        elif len(observacion) > 50:
+            self._pensar("✅ Información obtenida, procesando para generar respuesta")
+    
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._cerrar_herramienta(run_id, str(getattr(output, 'content', output)))
+    
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._cerrar_herramienta(run_id, f"Error: {error}")
+    
+    @property
+    def busquedas(self) -> int:
+        return sum(1 for paso in self.pasos if paso['action'] in HERRAMIENTAS_BUSQUEDA)
+    
+    def resumen(self) -> Dict:
+        """Totales de la ejecución: llamadas al modelo, tokens y tiempo en modelo y herramientas"""
+        return {
+            'llamadas_modelo': len(self.llamadas_modelo),
+            'input_tokens': sum(llamada.get('input_tokens', 0) for llamada in self.llamadas_modelo),
+            'output_tokens': sum(llamada.get('output_tokens', 0) for llamada in self.llamadas_modelo),
+            'segundos_modelo': round(sum(llamada['duracion'] for llamada in self.llamadas_modelo), 2),
+            'segundos_herramientas': round(sum(paso['duracion'] or 0 for paso in self.pasos), 2),
+            'pasos': len(self.pasos),
+            'busquedas': self.busquedas,
+            'duracion': round(time.time() - self.inicio, 2)
+        }
+
+class VigilanteCancelacion(BaseCallbackHandler):
+    """Detiene el bucle del agente entre pasos si la petición se canceló o agotó su plazo.
+    
+    Las llamadas HTTP ya respetan el token de la petición; esto corta también lo que no pasa por
+    http_client (p. ej. el cliente de Ollama) y evita empezar otra herramienta.
+    """
+    
+    raise_error = True
+    run_inline = True
+    
+    def on_chain_start(self, serialized, inputs, **kwargs):
+        comprobar_cancelacion()
+    
+    def on_agent_action(self, action, **kwargs):
+        comprobar_cancelacion()
+
+vigilante_cancelacion = VigilanteCancelacion()
+
+class EjecucionAgente:
+    """Ejecución de un agente en su propio hilo y event loop, observable y cancelable.
+    
+    El agente corre con astream_events, de modo que el modelo transmite tokens y la traza los
+    recibe; cada evento de la traza se deja en una cola que consume el endpoint SSE. cancelar()
+    (o cancelar el token de la petición) cancela la tarea asyncio: la petición HTTP en curso al
+    modelo se cierra y el AgentExecutor no ejecuta más pasos (una herramienta síncrona ya en marcha
+    termina en su hilo, pero se descarta). Al agotarse el plazo del token se detiene con un error.
+    """
+    
+    def __init__(self, agente: AgentExecutor, pregunta: str, token: Optional[TokenCancelacion] = None):
+        self.id = uuid.uuid4().hex
+        self.agente = agente
+        self.pregunta = pregunta
+        self.cola = queue.Queue()
+        self.traza = TrazaAgente(al_evento=lambda tipo, datos: self.cola.put((tipo, datos)))
+        self.resultado: Optional[Dict] = None
+        self.error: Optional[Exception] = None
+        self.cancelada = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tarea: Optional[asyncio.Task] = None
+        self._hilo = threading.Thread(target=self._ejecutar, name=f'agente-{self.id[:8]}', daemon=True)
+        self.token = token or TokenCancelacion(Config.REQUEST_DEADLINE)
+    
+    def iniciar(self):
+        self._hilo.start()
+    
+    def _ejecutar(self):
         try:
-            # Usar el prompt estándar de React que funciona
-            react_prompt = hub.pull("hwchase17/react")
-            
-            agent = create_react_agent(model_instance, tools, react_prompt)
-            agents[model_name] = AgentExecutor(
-                agent=agent, 
-                tools=tools, 
-                verbose=True,
-                max_iterations=20,  # Aumentado significativamente para búsquedas extensas
-                max_execution_time=1800,  # 30 minutos para búsquedas completas
-                handle_parsing_errors=True,
-                return_intermediate_steps=True
-            )
-            print(f"✅ Agente {model_name} creado con herramientas avanzadas")
+            asyncio.run(self._principal())
+        finally:
+            # None marca el final de los eventos
+            self.cola.put(None)
+    
+    async def _principal(self):
+        self._tarea = asyncio.current_task()
+        self._loop = asyncio.get_running_loop()
+        if self.cancelada:
+            return
+        quitar_aviso = self.token.al_cancelar(self._cancelar_tarea)
+        try:
+            # El token viaja en el contexto de la tarea: lo ven el modelo, las herramientas y el cliente HTTP
+            with con_cancelacion(self.token):
+                await asyncio.wait_for(self._consumir_eventos(), self.token.restante())
+        except asyncio.CancelledError:
+            self.cancelada = True
+        except asyncio.TimeoutError:
+            self.error = PeticionCanceladaError(PeticionCanceladaError.PLAZO_AGOTADO)
+        except PeticionCanceladaError as e:
+            if e.por_plazo:
+                self.error = e
+            else:
+                self.cancelada = True
         except Exception as e:
-            print(f"⚠️ Error creando agente {model_name}: {e}")
-            agents[model_name] = None
+            self.error = e
+        finally:
+            quitar_aviso()
+    
+    async def _consumir_eventos(self):
+        async for evento in self.agente.astream_events(
+            {"input": self.pregunta}, version='v2', config={'callbacks': [self.traza]}
+        ):
+            # El resultado es el fin de la ejecución raíz (sin padres)
+            if evento['event'] == 'on_chain_end' and not evento.get('parent_ids'):
+                self.resultado = evento['data'].get('output')
+    
+    def _cancelar_tarea(self):
+        if self._loop is not None and self._tarea is not None:
+            with contextlib.suppress(RuntimeError):
+                self._loop.call_soon_threadsafe(self._tarea.cancel)
+    
+    def cancelar(self, motivo: str = 'cancelada por el cliente') -> bool:
+        """Detiene el agente si sigue en marcha; devuelve False si ya había terminado"""
+        if not self._hilo.is_alive():
+            return False
+        self.cancelada = True
+        self.token.cancelar(motivo)
+        return True
+
+# Ejecuciones en curso de /chat/agente/stream, para poder cancelarlas por id
+ejecuciones_agente: Dict[str, EjecucionAgente] = {}
+ejecuciones_agente_lock = threading.Lock()
+
+# Crear el agente con manejo de errores y herramientas mejoradas (en su primer uso)
+def crear_agente(model_name: str) -> Optional[AgentExecutor]:
+    """Fábrica de agentes: crea el AgentExecutor del modelo la primera vez que se necesita"""
+    model_instance = models[model_name]
+    if model_instance is None:
+        return None
+    
+    try:
+        # Todos los agentes comparten el mismo prompt ya parseado
+        agent = create_react_agent(ModeloPlanificado(model_instance, model_name), tools, obtener_prompt_agente())
+        executor = AgentExecutor(
+            agent=agent, 
+            tools=tools, 
+            verbose=Config.LANGCHAIN_VERBOSE,
+            max_iterations=20,  # Aumentado significativamente para búsquedas extensas
+            max_execution_time=1800,  # 30 minutos para búsquedas completas
+            handle_parsing_errors=True,
+            return_intermediate_steps=True,
+            # Plazo y cancelación de cada petición (el límite anterior es el de todo el agente)
+            callbacks=[vigilante_cancelacion]
+        )
+        print(f"✅ Agente {model_name} creado con herramientas avanzadas")
+        return executor
+    except Exception as e:
+        print(f"⚠️ Error creando agente {model_name}: {e}")
+        return None
+
+agents = RegistroPerezoso('agente', modelos_configurados, crear_agente)
 
 # También configurar un chat simple sin agente para preguntas básicas
 simple_chat_prompt = ChatPromptTemplate.from_messages([
@@ -1082,6 +3717,7 @@ FORMATO DE RESPUESTA:
 - Incluye ejemplos de código cuando sea relevante
 - Explica conceptos paso a paso
 - Menciona ventajas y desventajas cuando sea apropiado"""),
+            MessagesPlaceholder("historial", optional=True),
             ("user", "{pregunta}")
         ])
     
@@ -1108,6 +3744,7 @@ FORMATO DE RESPUESTA OBLIGATORIO:
 🔄 **REFLEXIÓN:** [Validación de la respuesta y posibles alternativas]
 
 IMPORTANTE: Siempre usa este formato estructurado para mostrar tu proceso de pensamiento completo."""),
+            MessagesPlaceholder("historial", optional=True),
             ("user", "{pregunta}")
         ])
     
@@ -1133,6 +3770,7 @@ FORMATO DE RESPUESTA:
 📝 **EJEMPLO PRÁCTICO:** [Solo si es relevante y breve]
 
 Mantén las respuestas enfocadas y útiles."""),
+            MessagesPlaceholder("historial", optional=True),
             ("user", "{pregunta}")
         ])
     
@@ -1156,14 +3794,15 @@ Java es un lenguaje de programación orientado a objetos desarrollado por Sun Mi
 Es uno de los lenguajes más populares para desarrollo de software empresarial y aplicaciones Android.
 
 Responde siempre de manera útil y completa."""),
+            MessagesPlaceholder("historial", optional=True),
             ("user", "{pregunta}")
         ])
     
     elif model_name == 'phi3':
         return ChatPromptTemplate.from_messages([
-            ("system", f"""Eres Microsoft Phi-3, un modelo compacto pero potente diseñado para respuestas rápidas y precisas.
+            ("system", """Eres Microsoft Phi-3, un modelo compacto pero potente diseñado para respuestas rápidas y precisas.
 
-FECHA ACTUAL: {time.strftime('%d de %B de %Y')} 
+La FECHA ACTUAL se indica junto a cada pregunta del usuario.
 
 IMPORTANTE: Para preguntas sobre noticias, eventos actuales, precios, clima o información reciente, debes indicar claramente que necesitas búsqueda web en tiempo real, ya que tu conocimiento tiene una fecha de corte y puede estar desactualizado.
 
@@ -1179,8 +3818,11 @@ FORMATO:
 2. Información clave en 2-3 puntos
 3. Ejemplo o aplicación práctica si es relevante
 4. Para noticias/eventos actuales: Recomendar búsqueda web"""),
-            ("user", "{pregunta}")
-        ])
+            MessagesPlaceholder("historial", optional=True),
+            # La fecha va en el último mensaje y no en el system: así el prefijo del prompt no
+            # cambia cada día y el backend puede reutilizar su caché
+            ("user", "FECHA ACTUAL: {fecha_actual}\n\n{pregunta}")
+        ]).partial(fecha_actual=lambda: time.strftime('%d de %B de %Y'))
     
     else:
         # Prompt por defecto para Llama3 y Gemini
@@ -1201,35 +3843,551 @@ EJEMPLOS:
 - Si preguntan "¿qué es HTML?" → Explica que HTML es un lenguaje de marcado
 
 Siempre proporciona información útil y específica."""),
+            MessagesPlaceholder("historial", optional=True),
             ("user", "{pregunta}")
         ])
 
-simple_chains = {}
-for model_name, model_instance in models.items():
-    if model_instance is not None:
-        # Obtener prompt personalizado para cada modelo
-        model_prompt = crear_prompt_para_modelo(model_name)
-        
-        # Configurar chain con temperatura si es posible
-        ollama_models_list = ['llama3', 'deepseek-coder', 'deepseek-r1:8b', 'phi3', 'gemma:2b']
-        lmstudio_models_list = ['lmstudio-gemma', 'lmstudio-mistral', 'lmstudio-deepseek']
-        
-        if model_name in ollama_models_list:
-            # Para modelos de Ollama, configurar directamente sin bind (temperatura no es compatible)
-            simple_chains[model_name] = model_prompt | model_instance | StrOutputParser()
-        elif model_name in lmstudio_models_list:
-            # Para modelos de LM Studio, configurar con temperatura
-            configured_model = model_instance
-            simple_chains[model_name] = model_prompt | configured_model | StrOutputParser()
-        elif model_name == 'gemini-1.5-flash':
-            # Para Gemini, configurar temperatura usando bind
-            configured_model = model_instance.bind(temperature=Config.DEFAULT_TEMPERATURE)
-            simple_chains[model_name] = model_prompt | configured_model | StrOutputParser()
+# chat_chains devuelven el AIMessage completo (reasoning_content, uso de tokens, tiempos);
+# simple_chains añaden StrOutputParser para los endpoints que solo necesitan el texto
+def crear_chat_chain(model_name: str):
+    """Fábrica de chains: prompt personalizado del modelo + modelo configurado"""
+    model_instance = models[model_name]
+    if model_instance is None:
+        return None
+    
+    # Obtener prompt personalizado para cada modelo
+    model_prompt = crear_prompt_para_modelo(model_name)
+    
+    # Configurar chain con temperatura si es posible
+    ollama_models_list = ['llama3', 'deepseek-coder', 'deepseek-r1:8b', 'phi3', 'gemma:2b']
+    lmstudio_models_list = ['lmstudio-gemma', 'lmstudio-mistral', 'lmstudio-deepseek']
+    
+    # Cada generación pasa por el planificador del backend (límite de concurrencia y cola FIFO)
+    if model_name in ollama_models_list:
+        # Para modelos de Ollama, configurar directamente sin bind (temperatura no es compatible)
+        chain = model_prompt | ModeloPlanificado(model_instance, model_name)
+    elif model_name in lmstudio_models_list:
+        # Para modelos de LM Studio, configurar con temperatura
+        configured_model = model_instance
+        chain = model_prompt | ModeloPlanificado(configured_model, model_name)
+    elif model_name == 'gemini-1.5-flash':
+        # Para Gemini, configurar temperatura usando bind
+        configured_model = model_instance.bind(temperature=Config.DEFAULT_TEMPERATURE)
+        chain = model_prompt | ModeloPlanificado(configured_model, model_name)
+    else:
+        # Fallback sin temperatura específica
+        chain = model_prompt | ModeloPlanificado(model_instance, model_name)
+    
+    print(f"✅ Chat simple {model_name} configurado con prompt personalizado")
+    return chain
+
+def crear_simple_chain(model_name: str):
+    chain = chat_chains[model_name]
+    return chain | StrOutputParser() if chain is not None else None
+
+chat_chains = RegistroPerezoso('chain', modelos_configurados, crear_chat_chain, incluir_nulos=False)
+simple_chains = RegistroPerezoso('chain simple', modelos_configurados, crear_simple_chain, incluir_nulos=False)
+
+def precalentar_modelos(incluir_agentes: bool = False):
+    """Construye por adelantado modelos, chains y (opcionalmente) agentes"""
+    tiempo_inicio = time.time()
+    for model_name in list(available_models):
+        if simple_chains.get(model_name) is None:
+            continue
+        if incluir_agentes:
+            agents.get(model_name)
+    print(f"🔥 Precalentamiento de modelos completado en {formatear_duracion(time.time() - tiempo_inicio)}")
+
+def iniciar_precalentamiento():
+    """Lanza el precalentamiento en segundo plano si está habilitado en la configuración"""
+    if Config.WARMUP_ON_START:
+        threading.Thread(
+            target=precalentar_modelos,
+            kwargs={'incluir_agentes': Config.WARMUP_AGENTS},
+            name='precalentamiento-modelos',
+            daemon=True
+        ).start()
+
+iniciar_precalentamiento()
+
+# Aciertos de la caché de prefijo (KV) del backend, según los datos de uso que devuelve el servidor
+estadisticas_prefijo = {'peticiones': 0, 'con_cache': 0, 'tokens_prompt': 0, 'tokens_cacheados': 0}
+estadisticas_prefijo_lock = threading.Lock()
+
+def registrar_cache_prefijo(usage: Dict) -> Optional[Dict]:
+    """Acumula y devuelve los tokens del prompt servidos desde la caché de prefijo del backend"""
+    tokens_cacheados = (usage.get('input_token_details') or {}).get('cache_read')
+    if tokens_cacheados is None:
+        return None
+    tokens_prompt = usage.get('input_tokens', 0)
+    
+    with estadisticas_prefijo_lock:
+        estadisticas_prefijo['peticiones'] += 1
+        estadisticas_prefijo['con_cache'] += 1 if tokens_cacheados else 0
+        estadisticas_prefijo['tokens_prompt'] += tokens_prompt
+        estadisticas_prefijo['tokens_cacheados'] += tokens_cacheados
+    
+    return {
+        'tokens_cacheados': tokens_cacheados,
+        'tokens_prompt': tokens_prompt,
+        'proporcion': round(tokens_cacheados / tokens_prompt, 3) if tokens_prompt else 0.0
+    }
+
+def extraer_info_generacion(mensaje: BaseMessage) -> Dict:
+    """Extrae reasoning_content, uso de tokens y tiempos de un mensaje generado por el modelo"""
+    info = {}
+    
+    reasoning_content = mensaje.additional_kwargs.get('reasoning_content')
+    if reasoning_content:
+        info['reasoning_content'] = reasoning_content
+    
+    usage = getattr(mensaje, 'usage_metadata', None)
+    if usage:
+        info['usage'] = dict(usage)
+        # Una respuesta servida desde la caché de respuestas no ha pasado por el backend
+        cache_prefijo = None if mensaje.response_metadata.get('cache_hit') else registrar_cache_prefijo(info['usage'])
+        if cache_prefijo:
+            info['cache_prefijo'] = cache_prefijo
+    
+    tiempo_generacion = mensaje.response_metadata.get('tiempo_generacion')
+    if tiempo_generacion is not None:
+        info['tiempo_generacion'] = tiempo_generacion
+    
+    if mensaje.response_metadata.get('cache_hit'):
+        info['cache_hit'] = True
+    
+    if mensaje.response_metadata.get('cola'):
+        info['cola'] = mensaje.response_metadata['cola']
+    
+    return info
+
+def invocar_chain_con_metadata(model_name: str, pregunta: str,
+                               historial: Optional[List[BaseMessage]] = None) -> Tuple[str, Dict]:
+    """Invoca el chat del modelo y devuelve el texto junto con la información de la generación.
+    
+    Cada llamada recibe su propio AIMessage, por lo que es segura con peticiones concurrentes.
+    """
+    mensaje = chat_chains[model_name].invoke({"pregunta": pregunta, "historial": historial or []})
+    texto = mensaje.content if isinstance(mensaje.content, str) else str(mensaje.content)
+    return texto, extraer_info_generacion(mensaje)
+
+async def invocar_chain_con_metadata_async(model_name: str, pregunta: str,
+                                     historial: Optional[List[BaseMessage]] = None) -> Tuple[str, Dict]:
+    """Versión asíncrona de invocar_chain_con_metadata"""
+    mensaje = await chat_chains[model_name].ainvoke({"pregunta": pregunta, "historial": historial or []})
+    texto = mensaje.content if isinstance(mensaje.content, str) else str(mensaje.content)
+    return texto, extraer_info_generacion(mensaje)
+
+def invocar_con_enrutado(candidatos: List[str], pregunta: str, historial: Optional[List[BaseMessage]],
+                        enrutado: Dict) -> Tuple[str, Dict]:
+    """Invoca el primer candidato y, si su backend falla, pasa al siguiente equivalente.
+    
+    enrutado['usado'] queda con el modelo que respondió y enrutado['failover'] con los que fallaron.
+    Si fallan todos se propaga el error del primero (p. ej. ColaSaturadaError → 503).
+    """
+    candidatos = [m for m in candidatos if m in chat_chains] or candidatos[:1]
+    primer_error = None
+    for i, model_key in enumerate(candidatos):
+        try:
+            resultado = invocar_chain_con_metadata(model_key, pregunta, historial)
+            enrutado['usado'] = model_key
+            return resultado
+        except PeticionCanceladaError:
+            # El cliente se fue o se agotó el plazo: no gastar otro backend
+            raise
+        except Exception as e:
+            primer_error = primer_error or e
+            if i < len(candidatos) - 1:
+                print(f"🔀 {model_key} falló ({e}); probando con {candidatos[i + 1]}")
+                enrutado.setdefault('failover', []).append(model_key)
+    # Si ninguno respondió, el error relevante es el del modelo elegido
+    raise primer_error
+
+async def invocar_con_enrutado_async(candidatos: List[str], pregunta: str, historial: Optional[List[BaseMessage]],
+                                     enrutado: Dict) -> Tuple[str, Dict]:
+    """Versión asíncrona de invocar_con_enrutado"""
+    candidatos = [m for m in candidatos if m in chat_chains] or candidatos[:1]
+    primer_error = None
+    for i, model_key in enumerate(candidatos):
+        try:
+            resultado = await invocar_chain_con_metadata_async(model_key, pregunta, historial)
+            enrutado['usado'] = model_key
+            return resultado
+        except PeticionCanceladaError:
+            # El cliente se fue o se agotó el plazo: no gastar otro backend
+            raise
+        except Exception as e:
+            primer_error = primer_error or e
+            if i < len(candidatos) - 1:
+                print(f"🔀 {model_key} falló ({e}); probando con {candidatos[i + 1]}")
+                enrutado.setdefault('failover', []).append(model_key)
+    # Si ninguno respondió, el error relevante es el del modelo elegido
+    raise primer_error
+
+def evento_sse(evento: str, datos: Dict) -> str:
+    """Serializa un evento Server-Sent Events"""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+class AcumuladorStream:
+    """Acumula los chunks de un stream de chat y genera los eventos SSE de /chat/stream.
+    
+    Lo comparten el servidor WSGI (stream síncrono) y el ASGI (stream asíncrono).
+    """
+    
+    def __init__(self, pregunta: str, modelo_seleccionado: str, session_id: str, permitir_internet: bool,
+                 omitir_cache: bool = False, memoria: Optional[Dict] = None, enrutado: Optional[Dict] = None):
+        self.pregunta = pregunta
+        self.modelo_seleccionado = modelo_seleccionado
+        self.enrutado = enrutado
+        self.session_id = session_id
+        self.permitir_internet = permitir_internet
+        self.omitir_cache = omitir_cache
+        self.contexto_cache = None
+        self.memoria = memoria
+        self.cache_semantica = None
+        self.cola = None
+        self.tiempo_inicio = time.time()
+        self.tiempo_primer_token = None
+        self.partes_respuesta = []
+        self.partes_reasoning = []
+        self.usage = None
+    
+    def usar_memoria(self, historial: List[BaseMessage], info_memoria: Dict):
+        """Registra el historial cargado: va en los metadatos y en la clave de la caché semántica"""
+        self.memoria = info_memoria
+        self.contexto_cache = huella_historial(historial)
+    
+    def evento_inicio(self) -> str:
+        return evento_sse('inicio', {'modelo': self.modelo_seleccionado, 'session_id': self.session_id})
+    
+    def eventos_desde_cache(self) -> Optional[List[str]]:
+        """Si hay una respuesta reutilizable en la caché semántica, la emite como un único token"""
+        en_cache = buscar_en_cache_semantica(self.modelo_seleccionado, self.pregunta, self.omitir_cache,
+                                             self.contexto_cache)
+        if en_cache is None:
+            return None
+        respuesta, info = en_cache
+        self.cache_semantica = info['cache_semantica']
+        return self.procesar(AIMessageChunk(
+            content=respuesta,
+            additional_kwargs={'reasoning_content': info['reasoning_content']} if info.get('reasoning_content') else {}
+        ))
+    
+    def cambiar_modelo(self, model_key: str) -> bool:
+        """Pasa a otro modelo equivalente; solo es posible si aún no se ha emitido nada"""
+        if self.tiempo_primer_token is not None:
+            return False
+        print(f"🔀 {self.modelo_seleccionado} falló antes del primer token; probando con {model_key}")
+        if self.enrutado is not None:
+            self.enrutado.setdefault('failover', []).append(self.modelo_seleccionado)
+            self.enrutado['usado'] = model_key
+        self.modelo_seleccionado = model_key
+        return True
+    
+    def procesar(self, chunk: BaseMessage) -> List[str]:
+        """Procesa un chunk del modelo y devuelve los eventos SSE a emitir"""
+        eventos = []
+        contenido = chunk.content if isinstance(chunk.content, str) else str(chunk.content)
+        reasoning_delta = chunk.additional_kwargs.get('reasoning_content')
+        
+        if (contenido or reasoning_delta) and self.tiempo_primer_token is None:
+            self.tiempo_primer_token = time.time()
+        
+        if reasoning_delta:
+            self.partes_reasoning.append(reasoning_delta)
+            eventos.append(evento_sse('reasoning', {'contenido': reasoning_delta}))
+        
+        if contenido:
+            self.partes_respuesta.append(contenido)
+            eventos.append(evento_sse('token', {'contenido': contenido}))
+        
+        if getattr(chunk, 'usage_metadata', None):
+            self.usage = dict(chunk.usage_metadata)
+        
+        if chunk.response_metadata.get('cola'):
+            self.cola = chunk.response_metadata['cola']
+        
+        return eventos
+    
+    def evento_error(self, error: Exception) -> str:
+        error_msg = str(error)
+        print(f"❌ Error en chat streaming {self.modelo_seleccionado}: {error_msg}")
+        datos_error = {'error': f'Error al procesar la pregunta: {error_msg}'}
+        if isinstance(error, PeticionCanceladaError):
+            datos_error.update({'cancelada': True, 'motivo': error.motivo})
+            return evento_sse('error', datos_error)
+        if isinstance(error, ColaSaturadaError):
+            datos_error['cola_saturada'] = True
+            return evento_sse('error', datos_error)
+        if isinstance(error, CircuitoAbiertoError):
+            datos_error['circuito_abierto'] = error.circuito
+        if ("ReadTimeout" in error_msg or "timed out" in error_msg
+                or isinstance(error, (httpx.TimeoutException, CircuitoAbiertoError))):
+            datos_error['respuesta_fallback'] = generar_respuesta_fallback(self.pregunta)
+        return evento_sse('error', datos_error)
+    
+    def evento_fin(self) -> str:
+        """Construye la respuesta final, la guarda en el historial y devuelve el evento 'fin'"""
+        tiempo_fin = time.time()
+        duracion = round(tiempo_fin - self.tiempo_inicio, 2)
+        respuesta_final = ''.join(self.partes_respuesta)
+        reasoning_content = ''.join(self.partes_reasoning) or None
+        tiempo_primer_token = round(self.tiempo_primer_token - self.tiempo_inicio, 3) if self.tiempo_primer_token else None
+        
+        respuesta_data = {
+            'respuesta': respuesta_final,
+            'modo': 'simple',
+            'modelo_usado': self.modelo_seleccionado,
+            'pensamientos': [],
+            'session_id': self.session_id,
+            'metadata': {
+                'duracion': duracion,
+                'duracion_formateada': formatear_duracion(duracion),
+                'tiempo_primer_token': tiempo_primer_token,
+                'timestamp': time.time(),
+                'timestamp_inicio': self.tiempo_inicio,
+                'timestamp_fin': tiempo_fin,
+                'internetHabilitado': self.permitir_internet,
+                'iteraciones': 0,
+                'busquedas': 0,
+                'streaming': True,
+                'razonamiento_visible': reasoning_content is not None
+            }
+        }
+        if self.usage:
+            respuesta_data['metadata']['usage'] = self.usage
+            cache_prefijo = registrar_cache_prefijo(self.usage)
+            if cache_prefijo:
+                respuesta_data['metadata']['cache_prefijo'] = cache_prefijo
+        if reasoning_content:
+            respuesta_data['reasoning_content'] = reasoning_content
+            respuesta_data['metadata']['tiene_razonamiento'] = True
+        if self.memoria:
+            respuesta_data['metadata']['memoria'] = self.memoria
+        if self.cola:
+            respuesta_data['metadata']['cola'] = self.cola
+        if self.enrutado:
+            respuesta_data['metadata']['enrutado'] = self.enrutado
+        if self.cache_semantica:
+            respuesta_data['metadata']['cache_semantica'] = self.cache_semantica
         else:
-            # Fallback sin temperatura específica
-            simple_chains[model_name] = model_prompt | model_instance | StrOutputParser()
+            guardar_en_cache_semantica(self.modelo_seleccionado, self.pregunta, respuesta_final,
+                                       {'reasoning_content': reasoning_content}, self.omitir_cache, self.contexto_cache)
         
-        print(f"✅ Chat simple {model_name} configurado con prompt personalizado")
+        print(f"✅ Chat streaming completado en {respuesta_data['metadata']['duracion_formateada']} "
+              f"(primer token: {tiempo_primer_token}s)")
+        
+        # Guardar en historial
+        try:
+            save_conversation(
+                session_id=self.session_id,
+                user_message=self.pregunta,
+                ai_response=respuesta_final,
+                model_used=self.modelo_seleccionado,
+                reasoning_content=reasoning_content,
+                metadata=respuesta_data['metadata']
+            )
+        except Exception as hist_error:
+            print(f"⚠️ Error guardando historial: {hist_error}")
+        
+        return evento_sse('fin', respuesta_data)
+
+def pensamientos_modo_simple(modelo_seleccionado: str, pregunta: str) -> List[str]:
+    """Pensamientos iniciales que se muestran en el modo simple según el modelo"""
+    # Manejo especial para DeepSeek R1 - Generar pensamientos simulados
+    if modelo_seleccionado == 'deepseek-r1:8b':
+        # Simular proceso de razonamiento paso a paso
+        return [
+            f"🔍 Analizando pregunta: '{pregunta}'",
+            "🧠 Identificando conceptos clave y contexto",
+            "📚 Accediendo a conocimiento base sobre el tema",
+            "🔗 Conectando información relevante",
+            "📝 Estructurando respuesta paso a paso",
+            "🔄 Validando coherencia y completitud"
+        ]
+    elif modelo_seleccionado.startswith('lmstudio-'):
+        # Para modelos LM Studio, mostrar proceso de conexión
+        return [
+            f"🔧 Conectando con LM Studio ({modelo_seleccionado})",
+            f"📝 Procesando consulta: '{pregunta}'",
+            "⚡ Generando respuesta técnica especializada"
+        ]
+    return []
+
+def construir_respuesta_simple(pregunta: str, modelo_seleccionado: str, session_id: str, permitir_internet: bool,
+                               respuesta_final: str, info_generacion: Dict, pensamientos_proceso: List[str],
+                               tiempo_inicio: float) -> Dict:
+    """Construye la respuesta JSON del modo simple y la guarda en el historial"""
+    tiempo_fin = time.time()
+    duracion = round(tiempo_fin - tiempo_inicio, 2)
+    duracion_formateada = formatear_duracion(duracion)
+    
+    print(f"✅ Chat simple completado en {duracion_formateada}")
+    
+    # Extraer reasoning_content si está disponible (para modelos de razonamiento)
+    reasoning_content = info_generacion.get('reasoning_content')
+    
+    if reasoning_content:
+        pensamientos_proceso.append("🧠 Proceso de razonamiento capturado del modelo")
+        print(f"📝 Reasoning content encontrado: {len(reasoning_content)} caracteres")
+    
+    # Preparar respuesta con reasoning si está disponible
+    respuesta_data = {
+        'respuesta': respuesta_final,
+        'modo': 'simple',
+        'modelo_usado': modelo_seleccionado,
+        'pensamientos': pensamientos_proceso,
+        'metadata': {
+            'duracion': duracion,
+            'duracion_formateada': duracion_formateada,
+            'timestamp': time.time(),
+            'internetHabilitado': permitir_internet,
+            'iteraciones': 0,
+            'busquedas': 0,
+            'razonamiento_visible': modelo_seleccionado == 'deepseek-r1:8b' or reasoning_content is not None
+        }
+    }
+    
+    # Añadir uso de tokens y tiempo de generación del modelo
+    if 'usage' in info_generacion:
+        respuesta_data['metadata']['usage'] = info_generacion['usage']
+    if 'tiempo_generacion' in info_generacion:
+        respuesta_data['metadata']['tiempo_generacion'] = info_generacion['tiempo_generacion']
+    if info_generacion.get('cache_hit'):
+        respuesta_data['metadata']['cache_hit'] = True
+    if 'cache_semantica' in info_generacion:
+        respuesta_data['metadata']['cache_semantica'] = info_generacion['cache_semantica']
+    if 'memoria' in info_generacion:
+        respuesta_data['metadata']['memoria'] = info_generacion['memoria']
+    if 'cache_prefijo' in info_generacion:
+        respuesta_data['metadata']['cache_prefijo'] = info_generacion['cache_prefijo']
+    if 'cola' in info_generacion:
+        respuesta_data['metadata']['cola'] = info_generacion['cola']
+    if 'enrutado' in info_generacion:
+        respuesta_data['metadata']['enrutado'] = info_generacion['enrutado']
+    
+    # Añadir reasoning_content si está disponible
+    if reasoning_content:
+        respuesta_data['reasoning_content'] = reasoning_content
+        respuesta_data['metadata']['tiene_razonamiento'] = True
+        print(f"📝 Reasoning content capturado ({len(reasoning_content)} caracteres)")
+    
+    # Añadir session_id
+    respuesta_data['session_id'] = session_id
+    
+    # Guardar en historial
+    try:
+        save_conversation(
+            session_id=session_id,
+            user_message=pregunta,
+            ai_response=respuesta_final,
+            model_used=modelo_seleccionado,
+            reasoning_content=reasoning_content,
+            metadata=respuesta_data['metadata']
+        )
+    except Exception as hist_error:
+        print(f"⚠️ Error guardando historial: {hist_error}")
+    
+    return respuesta_data
+
+def respuesta_cola_saturada(error: ColaSaturadaError) -> Dict:
+    """Respuesta 503 cuando no hay turno en el backend dentro del plazo"""
+    print(f"🚦 {error}")
+    return {
+        'error': str(error),
+        'cola_saturada': True,
+        'backend': error.backend,
+        'reintentar_en': Config.SCHEDULER_QUEUE_TIMEOUT
+    }
+
+def respuesta_peticion_cancelada(error: PeticionCanceladaError) -> Tuple[Dict, int]:
+    """Respuesta cuando la petición se cancela: 504 si agotó su plazo, 499 si el cliente se fue"""
+    print(f"⏹️ {error}")
+    return {'error': str(error), 'cancelada': True, 'motivo': error.motivo}, (504 if error.por_plazo else 499)
+
+def plazo_peticion(datos) -> float:
+    """Plazo de la petición en segundos: el que pida el cliente ('plazo'), sin pasar de REQUEST_DEADLINE"""
+    try:
+        plazo = float(datos.get('plazo') or Config.REQUEST_DEADLINE) if isinstance(datos, dict) else Config.REQUEST_DEADLINE
+    except (TypeError, ValueError):
+        plazo = Config.REQUEST_DEADLINE
+    return min(max(plazo, 1.0), Config.REQUEST_DEADLINE)
+
+def es_timeout_lmstudio(error: Exception, modelo_seleccionado: str) -> bool:
+    """Indica si el error es un timeout de un modelo de LM Studio (o su circuito está abierto)"""
+    error_msg = str(error)
+    es_timeout = ("ReadTimeout" in error_msg or "timed out" in error_msg
+                  or isinstance(error, (httpx.TimeoutException, CircuitoAbiertoError)))
+    return es_timeout and modelo_seleccionado.startswith('lmstudio-')
+
+def construir_respuesta_timeout(pregunta: str, modelo_seleccionado: str, permitir_internet: bool,
+                                pensamientos_proceso: List[str], tiempo_inicio: float) -> Dict:
+    """Respuesta de fallback cuando el modelo de LM Studio excede el timeout"""
+    tiempo_fin = time.time()
+    duracion = round(tiempo_fin - tiempo_inicio, 2)
+    duracion_formateada = formatear_duracion(duracion)
+    
+    return {
+        'respuesta': f"""⏰ **Timeout del modelo LM Studio**
+
+El modelo {modelo_seleccionado} está tardando más de lo esperado en responder. Esto puede deberse a:
+
+🔧 **Posibles causas:**
+• El modelo está procesando una respuesta compleja
+• LM Studio está sobrecargado o funcionando lento
+• La consulta requiere mucho tiempo de procesamiento
+
+💡 **Sugerencias:**
+• Intenta con una pregunta más específica
+• Prueba otro modelo disponible
+• Verifica que LM Studio esté funcionando correctamente
+
+⚡ **Respuesta rápida para tu pregunta "{pregunta}":**
+{generar_respuesta_fallback(pregunta)}
+
+*Tiempo transcurrido: {duracion_formateada}*""",
+        'modo': 'timeout_fallback',
+        'modelo_usado': modelo_seleccionado,
+        'pensamientos': pensamientos_proceso + [
+            f"⏰ Timeout después de {duracion_formateada}",
+            "🔄 Generando respuesta de fallback"
+        ],
+        'metadata': {
+            'duracion': duracion,
+            'duracion_formateada': duracion_formateada,
+            'timestamp': time.time(),
+            'internetHabilitado': permitir_internet,
+            'error': 'timeout',
+            'iteraciones': 0,
+            'busquedas': 0
+        }
+    }
+
+def requiere_flujo_completo(pregunta: str, modo: str, permitir_internet: bool) -> bool:
+    """Indica si la consulta necesita el flujo completo de /chat (agente, clima, fallbacks)"""
+    return permitir_internet and (modo != 'simple' or clasificar_intencion(pregunta).necesita_agente)
+
+@app.before_request
+def iniciar_cancelacion_peticion():
+    """Activa el token de cancelación de la petición (cadenas, agente, herramientas y HTTP lo respetan).
+    
+    Si la petición llega por el servidor ASGI ya trae el suyo, que además se cancela cuando el
+    cliente se desconecta.
+    """
+    if request.method != 'POST' or token_actual() is not None:
+        return
+    g.cancelacion_anterior = activar_cancelacion(TokenCancelacion(plazo_peticion(request.get_json(silent=True))))
+
+@app.teardown_request
+def terminar_cancelacion_peticion(error=None):
+    anterior = g.pop('cancelacion_anterior', None)
+    if anterior is not None:
+        desactivar_cancelacion(anterior)
+
+@app.errorhandler(PeticionCanceladaError)
+def manejar_peticion_cancelada(error: PeticionCanceladaError):
+    datos, status = respuesta_peticion_cancelada(error)
+    return jsonify(datos), status
 
 @app.route('/')
 def index() -> str:
@@ -1258,33 +4416,23 @@ def chat() -> Union[Response, Tuple[Response, int]]:
         if not pregunta:
             return jsonify({'error': 'No se proporcionó ninguna pregunta'}), 400
         
-        # Obtener el modelo seleccionado
-        modelo = get_model(modelo_seleccionado)
+        # Elegir entre el modelo pedido y sus equivalentes según salud, latencia y política
+        candidatos, info_enrutado = enrutador.elegir(modelo_seleccionado, data.get('politica'))
+        modelo_seleccionado = candidatos[0]
+        
+        # El enrutador ya eligió: get_model() volvería a enrutar
+        modelo = models.get(modelo_seleccionado)
         print(f"🔍 DEBUG: Modelo obtenido: {modelo}")
         
         if modelo is None:
             return jsonify({'error': 'No hay modelos disponibles'}), 500
 
         # Detección inteligente para forzar modo agente cuando se necesite información actual
-        palabras_actualidad = [
-            'noticias', 'news', 'actualidad', 'hoy', 'today', 'actual', 'reciente', 
-            'precio', 'price', 'cotización', 'último', 'latest', 'breaking',
-            'eventos', 'acontecimiento', 'qué pasó', 'qué está pasando'
-        ]
-        
-        # Detección de comandos Ollama para activar modo agente
-        palabras_ollama = [
-            'ollama ps', 'ollama list', 'ollama serve', 'ollama run', 'ollama stop', 
-            'ollama show', 'ollama pull', 'modelos ollama', 'ver modelos', 
-            'ejecutar modelo', 'detener modelo', 'instalar modelo', 'descargar modelo',
-            'estado ollama', 'servicio ollama', 'gestionar ollama', 'comandos ollama'
-        ]
-        
-        necesita_busqueda_web = any(palabra in pregunta.lower() for palabra in palabras_actualidad)
-        necesita_comando_ollama = any(palabra in pregunta.lower() for palabra in palabras_ollama)
+        intencion = clasificar_intencion(pregunta)
+        print(f"🧭 Intención: {intencion.a_dict()}")
         
-        if (necesita_busqueda_web or necesita_comando_ollama) and permitir_internet and modo == 'simple':
-            if necesita_comando_ollama:
+        if intencion.necesita_agente and permitir_internet and modo == 'simple':
+            if intencion.ollama:
                 print(f"🤖 Detectada consulta de comandos Ollama, cambiando a modo agente")
             else:
                 print(f"🔄 Detectada consulta que requiere información actual, cambiando a modo agente")
@@ -1297,19 +4445,13 @@ def chat() -> Union[Response, Tuple[Response, int]]:
 
         if modo == 'agente' and permitir_internet and modelo_seleccionado in agents and agents[modelo_seleccionado] is not None:
             # Verificar si es una consulta de clima para usar endpoint especializado
-            if any(palabra in pregunta.lower() for palabra in ['clima', 'weather', 'temperatura', 'temp', 'tiempo']):
+            if intencion.clima:
                 print(f"🌤️ Detectada consulta de clima, usando endpoint especializado")
                 try:
                     tiempo_inicio = time.time()
                     
-                    # Extraer ciudad de la pregunta
-                    ciudad = 'Quito'  # Default
-                    if 'quito' in pregunta.lower():
-                        ciudad = 'Quito'
-                    elif 'guayaquil' in pregunta.lower():
-                        ciudad = 'Guayaquil'
-                    elif 'cuenca' in pregunta.lower():
-                        ciudad = 'Cuenca'
+                    # Ciudad de la pregunta (gazetteer) o la ciudad por defecto
+                    ciudad = intencion.ciudad_o_defecto()
                     
                     # Obtener datos del clima directamente
                     clima_data = obtener_clima_api(ciudad)
@@ -1332,20 +4474,12 @@ Los datos actuales del clima en {ciudad} son:
 
 Responde de manera clara y útil con estos datos actuales."""
                             
-                            respuesta_formateada = simple_chains[modelo_seleccionado].invoke({"pregunta": prompt_clima})
+                            respuesta_formateada, info_generacion = invocar_chain_con_metadata(modelo_seleccionado, prompt_clima)
                             
                             # Extraer reasoning_content si está disponible (para modelos como DeepSeek)
-                            reasoning_content = None
-                            if modelo_seleccionado == 'lmstudio-deepseek':
-                                print(f"🔍 DEBUG: Extrayendo reasoning del clima para DeepSeek")
-                                modelo_instance = models[modelo_seleccionado]
-                                if hasattr(modelo_instance, '_last_response') and modelo_instance._last_response:
-                                    last_response = modelo_instance._last_response
-                                    if isinstance(last_response, dict) and "choices" in last_response:
-                                        choice = last_response["choices"][0]
-                                        if "message" in choice and "reasoning_content" in choice["message"]:
-                                            reasoning_content = choice["message"]["reasoning_content"]
-                                            print(f"📝 Reasoning content del clima encontrado: {len(reasoning_content)} caracteres")
+                            reasoning_content = info_generacion.get('reasoning_content')
+                            if reasoning_content:
+                                print(f"📝 Reasoning content del clima encontrado: {len(reasoning_content)} caracteres")
                             
                             respuesta_data = {
                                 'respuesta': respuesta_formateada,
@@ -1370,6 +4504,12 @@ Responde de manera clara y útil con estos datos actuales."""
                                 }
                             }
                             
+                            # Añadir uso de tokens y tiempo de generación del modelo
+                            if 'usage' in info_generacion:
+                                respuesta_data['metadata']['usage'] = info_generacion['usage']
+                            if 'tiempo_generacion' in info_generacion:
+                                respuesta_data['metadata']['tiempo_generacion'] = info_generacion['tiempo_generacion']
+                            
                             # Añadir reasoning_content si está disponible
                             if reasoning_content:
                                 respuesta_data['reasoning_content'] = reasoning_content
@@ -1402,123 +4542,30 @@ Responde de manera clara y útil con estos datos actuales."""
             # Usar el agente para preguntas que puedan requerir búsqueda web
             tiempo_inicio = time.time()  # Mover antes del try para tenerlo disponible en except
             logs_agente = []  # Para capturar logs detallados del agente
+            traza = TrazaAgente()
             
             try:
                 print(f"🤖 Iniciando agente {modelo_seleccionado} para: {pregunta[:50]}...")
                 logs_agente.append("🚀 Iniciando sistema AgentExecutor")
                 logs_agente.append("⚡ > Entering new AgentExecutor chain...")
                 
-                # Configurar captura de logs más detallada para obtener <think> y otros elementos
-                import io
-                import sys
-                import logging
-                from contextlib import redirect_stdout, redirect_stderr
-                
-                # Crear capturadores de salida
-                captured_output = io.StringIO()
-                captured_logs = []
-                
-                # Handler personalizado para capturar logs
-                class LogCapture(logging.Handler):
-                    def emit(self, record):
-                        captured_logs.append(self.format(record))
-                
-                log_capture = LogCapture()
-                logging.getLogger().addHandler(log_capture)
-                
-                try:
-                    # Ejecutar el agente con captura
-                    with redirect_stdout(captured_output):
-                        respuesta_completa = agents[modelo_seleccionado].invoke({"input": pregunta})
-                finally:
-                    # Remover el handler
-                    logging.getLogger().removeHandler(log_capture)
-                
-                # Obtener toda la salida capturada
-                agent_full_output = captured_output.getvalue()
+                # La traza recibe los eventos del agente por callbacks (pasos, herramientas, tokens, <think>)
+                respuesta_completa = agents[modelo_seleccionado].invoke({"input": pregunta}, config={'callbacks': [traza]})
                 
                 tiempo_fin = time.time()
                 duracion = round(tiempo_fin - tiempo_inicio, 2)
                 duracion_formateada = formatear_duracion(duracion)
                 
-                logs_agente.append("🏁 > Finished chain.")
-                logs_agente.append(f"✅ Agente completado en {duracion_formateada}")
-                
                 print(f"✅ Agente completado en {duracion_formateada}")
+                print(f"📊 Traza del agente: {traza.resumen()}")
                 
-                # Procesar la salida capturada para extraer <think> y otros elementos
-                think_content = []
-                if agent_full_output:
-                    # Buscar contenido <think> usando regex
-                    import re
-                    think_matches = re.findall(r'<think>(.*?)</think>', agent_full_output, re.DOTALL | re.IGNORECASE)
-                    for i, think in enumerate(think_matches):
-                        think_content.append(f"💭 <think> {i+1}: {think.strip()}")
-                    
-                    # Buscar otros patrones útiles
-                    thought_matches = re.findall(r'Thought: (.*?)(?=\n(?:Action:|Observation:|Final Answer:)|$)', agent_full_output, re.DOTALL)
-                    for i, thought in enumerate(thought_matches):
-                        if thought.strip():
-                            logs_agente.append(f"🧠 Thought {i+1}: {thought.strip()}")
-                    
-                    # Buscar acciones específicas
-                    action_input_matches = re.findall(r'Action Input: (.*?)(?=\n|$)', agent_full_output)
-                    for i, action_input in enumerate(action_input_matches):
-                        if action_input.strip():
-                            logs_agente.append(f"📝 Action Input {i+1}: {action_input.strip()}")
-                
-                # Agregar logs capturados
-                for log_msg in captured_logs:
-                    if any(keyword in log_msg.lower() for keyword in ['think', 'thought', 'action', 'observation']):
-                        logs_agente.append(f"📋 Log: {log_msg}")
-                
-                # Extraer pasos intermedios si están disponibles
-                pasos_intermedios = []
-                busquedas_count = 0
-                pensamientos = logs_agente.copy()  # Empezar con los logs del agente
-                
-                # Agregar contenido <think> a los pensamientos
-                if think_content:
-                    pensamientos.extend(think_content)
-                    print(f"📝 Capturado {len(think_content)} bloques <think>")
-                
-                if 'intermediate_steps' in respuesta_completa:
-                    print(f"📊 Procesando {len(respuesta_completa['intermediate_steps'])} pasos intermedios...")
-                    
-                    for i, paso in enumerate(respuesta_completa['intermediate_steps']):
-                        if len(paso) >= 2:
-                            accion = paso[0]
-                            observacion = paso[1]
-                            
-                            # Contar búsquedas
-                            if hasattr(accion, 'tool') and accion.tool in ['web_search', 'duckduckgo_search']:
-                                busquedas_count += 1
-                                pensamientos.append(f"🔍 Realizando búsqueda: '{accion.tool_input}'")
-                            
-                            # Agregar información del paso
-                            paso_info = {
-                                'step': i + 1,
-                                'action': accion.tool if hasattr(accion, 'tool') else str(accion),
-                                'action_input': accion.tool_input if hasattr(accion, 'tool_input') else str(accion),
-                                'observation': observacion[:500] + '...' if len(str(observacion)) > 500 else str(observacion),
-                                'thought': f"Ejecutando {accion.tool}" if hasattr(accion, 'tool') else "Procesando información"
-                            }
-                            pasos_intermedios.append(paso_info)
-                            
-                            # Agregar pensamiento formateado más detallado
-                            if hasattr(accion, 'tool'):
-                                pensamientos.append(f"💭 Paso {i+1}: Usando herramienta '{accion.tool}' con entrada: '{accion.tool_input}'")
-                                # Mostrar resultado truncado pero más informativo
-                                resultado_truncado = str(observacion)[:300]
-                                if len(str(observacion)) > 300:
-                                    resultado_truncado += "..."
-                                pensamientos.append(f"📋 Resultado: {resultado_truncado}")
-                            
-                            # Agregar análisis del resultado
-                            if "No good" in str(observacion):
-                                pensamientos.append("⚠️ Búsqueda sin resultados útiles, intentando método alternativo")
-                            elif len(str(observacion)) > 50:
-                                pensamientos.append("✅ Información obtenida, procesando para generar respuesta")
+                pasos_intermedios = traza.pasos
+                busquedas_count = traza.busquedas
+                # Pensamientos en orden: inicio, eventos de la traza y cierre
+                pensamientos = logs_agente + traza.pensamientos + [
+                    "🏁 > Finished chain.",
+                    f"✅ Agente completado en {duracion_formateada}"
+                ]
                 
                 # Si hay pasos pero sin pensamientos detallados, agregar contexto
                 if len(pasos_intermedios) > 0 and len(pensamientos) == 0:
@@ -1529,7 +4576,7 @@ Responde de manera clara y útil con estos datos actuales."""
                 if len(pasos_intermedios) == 0:
                     pensamientos.append("💭 Analizando consulta con conocimiento base")
                     pensamientos.append("🧠 Generando respuesta usando modelo de IA")
-                    if "noticias" in pregunta.lower() or "hoy" in pregunta.lower():
+                    if intencion.noticias:
                         pensamientos.append("📰 Nota: Para noticias actuales se recomienda activar búsqueda web")
                 else:
                     # Agregar pensamiento final
@@ -1542,7 +4589,7 @@ Responde de manera clara y útil con estos datos actuales."""
                     print("⚠️ Búsquedas web fallaron, generando respuesta de fallback inteligente...")
                     
                     # Generar respuesta de fallback específica para noticias
-                    if any(palabra in pregunta.lower() for palabra in ['noticias', 'news', 'hoy', 'actualidad']):
+                    if intencion.noticias:
                         respuesta_completa['output'] = f"""📰 **Información sobre noticias del día**
 
 Lo siento, actualmente estoy experimentando dificultades para acceder a fuentes de noticias en tiempo real. Sin embargo, te puedo sugerir las mejores fuentes para mantenerte informado sobre las noticias de hoy:
@@ -1612,6 +4659,7 @@ Mientras tanto, puedo responder preguntas sobre temas generales, explicaciones c
                         'duracion_formateada': duracion_formateada,
                         'iteraciones': len(pasos_intermedios),
                         'busquedas': busquedas_count,
+                        'traza': traza.resumen(),
                         'timestamp': time.time(),
                         'timestamp_inicio': tiempo_inicio,
                         'timestamp_fin': tiempo_fin,
@@ -1619,6 +4667,9 @@ Mientras tanto, puedo responder preguntas sobre temas generales, explicaciones c
                     }
                 })
             except Exception as e:
+                # Cancelada o sin plazo: no gastar más con el fallback al chat simple
+                if isinstance(e, PeticionCanceladaError):
+                    raise
                 error_msg = str(e)
                 print(f"Error en agente {modelo_seleccionado}: {error_msg}")
                 
@@ -1655,12 +4706,14 @@ Mientras tanto, puedo responder preguntas sobre temas generales, explicaciones c
                             Responde de manera útil y proactiva.
                             """
                             
-                            respuesta_con_contexto = simple_chains[modelo_seleccionado].invoke({"pregunta": prompt_con_contexto})
+                            # Con failover entre equivalentes, como el modo simple
+                            respuesta_con_contexto, _ = invocar_con_enrutado(candidatos, prompt_con_contexto, None,
+                                                                             info_enrutado)
                             
                             return jsonify({
                                 'respuesta': respuesta_con_contexto,
                                 'modo': 'agente_parcial',
-                                'modelo_usado': modelo_seleccionado,
+                                'modelo_usado': info_enrutado['usado'],
                                 'pensamientos': [
                                     "🔍 Búsqueda web iniciada exitosamente",
                                     "📊 Información parcial obtenida de fuentes web",
@@ -1691,11 +4744,11 @@ Mientras tanto, puedo responder preguntas sobre temas generales, explicaciones c
                 
                 # Fallback a chat simple si el agente falla
                 if modelo_seleccionado in simple_chains:
-                    respuesta = simple_chains[modelo_seleccionado].invoke({"pregunta": pregunta})
+                    respuesta, _ = invocar_con_enrutado(candidatos, pregunta, None, info_enrutado)
                     return jsonify({
                         'respuesta': f"{fallback_msg}{respuesta}",
                         'modo': 'simple_fallback',
-                        'modelo_usado': modelo_seleccionado,
+                        'modelo_usado': info_enrutado['usado'],
                         'metadata': {
                             'internetHabilitado': permitir_internet,
                             'iteraciones': 0,
@@ -1711,179 +4764,41 @@ Mientras tanto, puedo responder preguntas sobre temas generales, explicaciones c
                 print(f"🔍 DEBUG: Chain encontrada para {modelo_seleccionado}")
                 tiempo_inicio = time.time()
                 
-                # Manejo especial para DeepSeek R1 - Generar pensamientos simulados
-                pensamientos_proceso = []
-                if modelo_seleccionado == 'deepseek-r1:8b':
-                    # Simular proceso de razonamiento paso a paso
-                    pensamientos_proceso = [
-                        f"🔍 Analizando pregunta: '{pregunta}'",
-                        "🧠 Identificando conceptos clave y contexto",
-                        "📚 Accediendo a conocimiento base sobre el tema",
-                        "🔗 Conectando información relevante",
-                        "📝 Estructurando respuesta paso a paso",
-                        "🔄 Validando coherencia y completitud"
-                    ]
-                elif modelo_seleccionado.startswith('lmstudio-'):
-                    # Para modelos LM Studio, mostrar proceso de conexión
-                    pensamientos_proceso = [
-                        f"🔧 Conectando con LM Studio ({modelo_seleccionado})",
-                        f"📝 Procesando consulta: '{pregunta}'",
-                        "⚡ Generando respuesta técnica especializada"
-                    ]
+                pensamientos_proceso = pensamientos_modo_simple(modelo_seleccionado, pregunta)
+                historial, info_memoria = preparar_memoria(modelo_seleccionado, session_id, data.get('usar_memoria', True))
+                # Con historial la respuesta depende del contexto: la caché semántica lo incluye en la clave
+                omitir_cache = data.get('omitir_cache', False)
+                contexto_cache = huella_historial(historial)
                 
                 try:
-                    resultado_chain = simple_chains[modelo_seleccionado].invoke({"pregunta": pregunta})
-                    tiempo_fin = time.time()
-                    duracion = round(tiempo_fin - tiempo_inicio, 2)
-                    duracion_formateada = formatear_duracion(duracion)
-                    
-                    print(f"✅ Chat simple completado en {duracion_formateada}")
-                    
-                    # Extraer reasoning_content si está disponible (para modelos de razonamiento)
-                    reasoning_content = None
-                    respuesta_final = resultado_chain
-                    
-                    # DEBUG: Añadir logging detallado para depuración
-                    print(f"🔍 DEBUG: Modelo seleccionado: {modelo_seleccionado}")
-                    print(f"🔍 DEBUG: Tipo de resultado_chain: {type(resultado_chain)}")
-                    
-                    # Si el modelo es DeepSeek con LM Studio, intentar extraer reasoning de la respuesta
-                    if modelo_seleccionado == 'lmstudio-deepseek':
-                        print(f"🔍 DEBUG: Procesando modelo DeepSeek para extraer reasoning_content")
-                        
-                        # Acceder al modelo directamente para obtener la última respuesta
-                        modelo_instance = models[modelo_seleccionado]
-                        print(f"🔍 DEBUG: Modelo instance obtenido: {modelo_instance}")
-                        
-                        if hasattr(modelo_instance, '_last_response') and modelo_instance._last_response:
-                            last_response = modelo_instance._last_response
-                            print(f"🔍 DEBUG: _last_response encontrado: {type(last_response)}")
-                            print(f"🔍 DEBUG: _last_response keys: {last_response.keys() if isinstance(last_response, dict) else 'No es dict'}")
-                            
-                            if isinstance(last_response, dict) and "choices" in last_response:
-                                choice = last_response["choices"][0]
-                                print(f"🔍 DEBUG: Choice keys: {choice.keys() if isinstance(choice, dict) else 'No es dict'}")
-                                
-                                if "message" in choice:
-                                    message = choice["message"]
-                                    print(f"🔍 DEBUG: Message keys: {message.keys() if isinstance(message, dict) else 'No es dict'}")
-                                    
-                                    if "reasoning_content" in message:
-                                        reasoning_content = message["reasoning_content"]
-                                        pensamientos_proceso.append("🧠 Proceso de razonamiento capturado del modelo")
-                                        print(f"📝 Reasoning content encontrado: {len(reasoning_content)} caracteres")
-                                        print(f"🔍 DEBUG: Reasoning content preview: {reasoning_content[:200]}...")
-                                    else:
-                                        print(f"⚠️ DEBUG: No se encontró 'reasoning_content' en message")
-                                else:
-                                    print(f"⚠️ DEBUG: No se encontró 'message' en choice")
-                            else:
-                                print(f"⚠️ DEBUG: No se encontró 'choices' en last_response o no es dict")
-                        else:
-                            print(f"⚠️ DEBUG: No se encontró _last_response o está vacío")
-                    
-                    # Si no se encontró reasoning en _last_response, intentar extraerlo del resultado del chain
-                    if not reasoning_content and hasattr(resultado_chain, '__dict__'):
-                        print(f"🔍 DEBUG: Intentando extraer reasoning del resultado del chain")
-                        # Buscar en los metadatos adicionales del mensaje
-                        try:
-                            # El resultado del chain puede contener información adicional
-                            if hasattr(resultado_chain, 'additional_kwargs'):
-                                reasoning_content = resultado_chain.additional_kwargs.get('reasoning_content')
-                                if reasoning_content:
-                                    print(f"📝 DEBUG: Reasoning encontrado en additional_kwargs: {len(reasoning_content)} caracteres")
-                        except Exception as e:
-                            print(f"⚠️ DEBUG: Error extrayendo del chain: {e}")
-                    
-                    if not reasoning_content:
-                        print(f"⚠️ DEBUG: No se pudo extraer reasoning_content de ninguna fuente")
-                    
-                    # Preparar respuesta con reasoning si está disponible
-                    respuesta_data = {
-                        'respuesta': respuesta_final,
-                        'modo': 'simple',
-                        'modelo_usado': modelo_seleccionado,
-                        'pensamientos': pensamientos_proceso,
-                        'metadata': {
-                            'duracion': duracion,
-                            'duracion_formateada': duracion_formateada,
-                            'timestamp': time.time(),
-                            'internetHabilitado': permitir_internet,
-                            'iteraciones': 0,
-                            'busquedas': 0,
-                            'razonamiento_visible': modelo_seleccionado == 'deepseek-r1:8b' or reasoning_content is not None
-                        }
-                    }
-                    
-                    # Añadir reasoning_content si está disponible
-                    if reasoning_content:
-                        respuesta_data['reasoning_content'] = reasoning_content
-                        respuesta_data['metadata']['tiene_razonamiento'] = True
-                        print(f"📝 Reasoning content capturado ({len(reasoning_content)} caracteres)")
-                    
-                    # Añadir session_id
-                    respuesta_data['session_id'] = session_id
-                    
-                    # Guardar en historial
-                    try:
-                        save_conversation(
-                            session_id=session_id,
-                            user_message=pregunta,
-                            ai_response=respuesta_final,
-                            model_used=modelo_seleccionado,
-                            reasoning_content=reasoning_content,
-                            metadata=respuesta_data['metadata']
-                        )
-                    except Exception as hist_error:
-                        print(f"⚠️ Error guardando historial: {hist_error}")
-                    
+                    en_cache = buscar_en_cache_semantica(modelo_seleccionado, pregunta, omitir_cache, contexto_cache)
+                    if en_cache:
+                        resultado_chain, info_generacion = en_cache
+                        pensamientos_proceso.append("⚡ Respuesta reutilizada de una pregunta similar")
+                    else:
+                        resultado_chain, info_generacion = invocar_con_enrutado(candidatos, pregunta, historial, info_enrutado)
+                        modelo_seleccionado = info_enrutado['usado']
+                        guardar_en_cache_semantica(modelo_seleccionado, pregunta, resultado_chain, info_generacion,
+                                                   omitir_cache, contexto_cache)
+                    if info_memoria:
+                        info_generacion['memoria'] = info_memoria
+                    info_generacion['enrutado'] = info_enrutado
+                    respuesta_data = construir_respuesta_simple(
+                        pregunta, modelo_seleccionado, session_id, permitir_internet,
+                        resultado_chain, info_generacion, pensamientos_proceso, tiempo_inicio
+                    )
                     return jsonify(respuesta_data)
                 
                 except Exception as model_error:
-                    tiempo_fin = time.time()
-                    duracion = round(tiempo_fin - tiempo_inicio, 2)
-                    duracion_formateada = formatear_duracion(duracion)
-                    
-                    error_msg = str(model_error)
+                    # Backend saturado: responder ya en lugar de acumular más espera
+                    if isinstance(model_error, ColaSaturadaError):
+                        return jsonify(respuesta_cola_saturada(model_error)), 503
                     
                     # Manejo específico para timeout de LM Studio
-                    if "ReadTimeout" in error_msg or "timed out" in error_msg:
-                        if modelo_seleccionado.startswith('lmstudio-'):
-                            return jsonify({
-                                'respuesta': f"""⏰ **Timeout del modelo LM Studio**
-
-El modelo {modelo_seleccionado} está tardando más de lo esperado en responder. Esto puede deberse a:
-
-🔧 **Posibles causas:**
-• El modelo está procesando una respuesta compleja
-• LM Studio está sobrecargado o funcionando lento
-• La consulta requiere mucho tiempo de procesamiento
-
-💡 **Sugerencias:**
-• Intenta con una pregunta más específica
-• Prueba otro modelo disponible
-• Verifica que LM Studio esté funcionando correctamente
-
-⚡ **Respuesta rápida para tu pregunta "{pregunta}":**
-{generar_respuesta_fallback(pregunta)}
-
-*Tiempo transcurrido: {duracion_formateada}*""",
-                                'modo': 'timeout_fallback',
-                                'modelo_usado': modelo_seleccionado,
-                                'pensamientos': pensamientos_proceso + [
-                                    f"⏰ Timeout después de {duracion_formateada}",
-                                    "🔄 Generando respuesta de fallback"
-                                ],
-                                'metadata': {
-                                    'duracion': duracion,
-                                    'duracion_formateada': duracion_formateada,
-                                    'timestamp': time.time(),
-                                    'internetHabilitado': permitir_internet,
-                                    'error': 'timeout',
-                                    'iteraciones': 0,
-                                    'busquedas': 0
-                                }
-                            })
+                    if es_timeout_lmstudio(model_error, modelo_seleccionado):
+                        return jsonify(construir_respuesta_timeout(
+                            pregunta, modelo_seleccionado, permitir_internet, pensamientos_proceso, tiempo_inicio
+                        ))
                     
                     # Para otros errores, propagar el error
                     raise model_error
@@ -1892,11 +4807,187 @@ El modelo {modelo_seleccionado} está tardando más de lo esperado en responder.
                 return jsonify({'error': f'Modelo {modelo_seleccionado} no disponible'}), 400
             
     except Exception as e:
+        if isinstance(e, PeticionCanceladaError):
+            datos, status = respuesta_peticion_cancelada(e)
+            return jsonify(datos), status
         print(f"❌ DEBUG: Error en función chat: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': f'Error al procesar la pregunta: {str(e)}'}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream() -> Union[Response, Tuple[Response, int]]:
+    """Chat simple con streaming de tokens vía Server-Sent Events.
+    
+    Eventos emitidos: 'inicio', 'token', 'reasoning', 'fin' y 'error'. Las consultas que
+    requieren modo agente se delegan a /chat y se devuelven en un único evento 'completo'.
+    """
+    data = request.get_json() or {}
+    pregunta = data.get('pregunta', '')
+    modo = data.get('modo', 'simple')
+    modelo_seleccionado = data.get('modelo', available_models[0] if available_models else 'llama3')
+    permitir_internet = data.get('permitir_internet', True)
+    session_id = data.get('session_id', str(int(time.time())))
+    
+    if not pregunta:
+        return jsonify({'error': 'No se proporcionó ninguna pregunta'}), 400
+    
+    candidatos, info_enrutado = enrutador.elegir(modelo_seleccionado, data.get('politica'))
+    candidatos = [m for m in candidatos if m in simple_chains] or candidatos[:1]
+    modelo_seleccionado = info_enrutado['usado'] = candidatos[0]
+    
+    def generar_eventos_completos():
+        # Delegar al flujo bloqueante de /chat (agente, clima, fallbacks) y emitir su resultado
+        resultado = chat()
+        respuesta, status = resultado if isinstance(resultado, tuple) else (resultado, 200)
+        if status >= 400:
+            yield evento_sse('error', respuesta.get_json())
+        else:
+            yield evento_sse('completo', respuesta.get_json())
+    
+    def generar_eventos_stream():
+        acumulador = AcumuladorStream(pregunta, modelo_seleccionado, session_id, permitir_internet,
+                                      data.get('omitir_cache', False), enrutado=info_enrutado)
+        # La cabecera 200 ya está enviada: un fallo de la memoria (SQLite, resumen) se emite como evento
+        try:
+            historial, info_memoria = preparar_memoria(modelo_seleccionado, session_id, data.get('usar_memoria', True))
+            acumulador.usar_memoria(historial, info_memoria)
+        except Exception as e:
+            yield acumulador.evento_error(e)
+            return
+        yield acumulador.evento_inicio()
+        
+        eventos_cache = acumulador.eventos_desde_cache()
+        if eventos_cache is not None:
+            yield from eventos_cache
+            yield acumulador.evento_fin()
+            return
+        
+        primer_error = None
+        for i, candidato in enumerate(candidatos):
+            try:
+                for chunk in chat_chains[candidato].stream({"pregunta": pregunta, "historial": historial}):
+                    yield from acumulador.procesar(chunk)
+                break
+            except Exception as e:
+                primer_error = primer_error or e
+                # Failover solo mientras el cliente no haya recibido ningún token (y siga esperando)
+                if acumulador.tiempo_primer_token is not None or isinstance(e, PeticionCanceladaError):
+                    yield acumulador.evento_error(e)
+                    return
+                if i == len(candidatos) - 1:
+                    yield acumulador.evento_error(primer_error)
+                    return
+                acumulador.cambiar_modelo(candidatos[i + 1])
+        
+        yield acumulador.evento_fin()
+    
+    if requiere_flujo_completo(pregunta, modo, permitir_internet) or modelo_seleccionado not in simple_chains:
+        generador = generar_eventos_completos()
+    else:
+        generador = generar_eventos_stream()
+    
+    return Response(
+        stream_with_context(generador),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/chat/agente/stream', methods=['POST'])
+def chat_agente_stream() -> Union[Response, Tuple[Response, int]]:
+    """Modo agente con los pasos en vivo vía Server-Sent Events.
+    
+    Eventos: 'inicio' (con ejecucion_id), 'paso' (herramienta y entrada), 'observacion' (extracto y
+    duración), 'pensamiento', 'modelo' (duración y tokens de cada llamada), 'token' (respuesta final),
+    y para terminar 'fin', 'cancelado' o 'error'. Si el cliente se desconecta, o llama a
+    /chat/agente/cancelar/<ejecucion_id>, el agente se detiene.
+    """
+    data = request.get_json() or {}
+    pregunta = data.get('pregunta', '')
+    modelo_seleccionado = data.get('modelo', available_models[0] if available_models else 'llama3')
+    session_id = data.get('session_id', str(int(time.time())))
+    
+    if not pregunta:
+        return jsonify({'error': 'No se proporcionó ninguna pregunta'}), 400
+    
+    candidatos, info_enrutado = enrutador.elegir(modelo_seleccionado, data.get('politica'))
+    candidatos = [m for m in candidatos if agents.get(m) is not None]
+    if not candidatos:
+        return jsonify({'error': f'No hay agente disponible para {modelo_seleccionado}'}), 500
+    modelo_seleccionado = info_enrutado['usado'] = candidatos[0]
+    
+    ejecucion = EjecucionAgente(agents[modelo_seleccionado], pregunta, token_actual())
+    with ejecuciones_agente_lock:
+        ejecuciones_agente[ejecucion.id] = ejecucion
+    ejecucion.iniciar()
+    print(f"🤖 Agente {modelo_seleccionado} en streaming ({ejecucion.id[:8]}): {pregunta[:50]}...")
+    
+    def generar_eventos():
+        try:
+            yield evento_sse('inicio', {'ejecucion_id': ejecucion.id, 'modelo': modelo_seleccionado, 'enrutado': info_enrutado})
+            while True:
+                try:
+                    evento = ejecucion.cola.get(timeout=Config.AGENT_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    # Comentario SSE: mantiene viva la conexión y detecta si el cliente se fue
+                    yield ': ping\n\n'
+                    continue
+                if evento is None:
+                    break
+                yield evento_sse(*evento)
+            
+            traza = ejecucion.traza
+            metadata = {**traza.resumen(), 'enrutado': info_enrutado, 'iteraciones': len(traza.pasos)}
+            if ejecucion.cancelada:
+                print(f"⏹️ Agente {ejecucion.id[:8]} cancelado tras {metadata['duracion']}s")
+                yield evento_sse('cancelado', {'pasos_intermedios': traza.pasos, 'metadata': metadata})
+            elif ejecucion.error is not None or not ejecucion.resultado:
+                error = ejecucion.error or RuntimeError('El agente terminó sin respuesta')
+                print(f"❌ Error en agente streaming {modelo_seleccionado}: {error}")
+                yield evento_sse('error', {'error': str(error), 'pasos_intermedios': traza.pasos, 'metadata': metadata})
+            else:
+                respuesta = ejecucion.resultado.get('output', '')
+                try:
+                    save_conversation(
+                        session_id=session_id,
+                        user_message=pregunta,
+                        ai_response=respuesta,
+                        model_used=modelo_seleccionado,
+                        metadata={'modo': 'agente', 'streaming': True, 'iteraciones': len(traza.pasos),
+                                  'busquedas': traza.busquedas, 'duracion': metadata['duracion']}
+                    )
+                except Exception as hist_error:
+                    print(f"⚠️ Error guardando historial: {hist_error}")
+                yield evento_sse('fin', {
+                    'respuesta': respuesta,
+                    'modo': 'agente',
+                    'modelo_usado': modelo_seleccionado,
+                    'pasos_intermedios': traza.pasos,
+                    'pensamientos': traza.pensamientos,
+                    'session_id': session_id,
+                    'metadata': {**metadata, 'busquedas': traza.busquedas, 'duracion_formateada': formatear_duracion(metadata['duracion'])}
+                })
+        finally:
+            # Cliente desconectado (GeneratorExit) o fin normal: no dejar el agente trabajando
+            ejecucion.cancelar()
+            with ejecuciones_agente_lock:
+                ejecuciones_agente.pop(ejecucion.id, None)
+    
+    return Response(
+        stream_with_context(generar_eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/chat/agente/cancelar/<ejecucion_id>', methods=['POST'])
+def cancelar_agente(ejecucion_id: str) -> Union[Response, Tuple[Response, int]]:
+    """Cancela una ejecución de /chat/agente/stream en curso"""
+    with ejecuciones_agente_lock:
+        ejecucion = ejecuciones_agente.get(ejecucion_id)
+    if ejecucion is None:
+        return jsonify({'error': 'Ejecución no encontrada o ya terminada'}), 404
+    return jsonify({'success': True, 'cancelada': ejecucion.cancelar()})
+
 @app.route('/ejemplo-agente', methods=['POST'])
 def ejemplo_agente() -> Union[Response, Tuple[Response, int]]:
     """Endpoint específico para demostrar capacidades del agente"""
@@ -1948,37 +5039,36 @@ def busqueda_rapida() -> Union[Response, Tuple[Response, int]]:
         if not pregunta:
             return jsonify({'error': 'No se proporcionó ninguna pregunta'}), 400
         
-        # Búsqueda directa con DuckDuckGo sin agente complejo
-        search_tool = DuckDuckGoSearchRun()
+        # Búsqueda directa con DuckDuckGo sin agente complejo (servicio_ddg, con caché)
         
         # Mejorar términos de búsqueda según el tipo de pregunta
         def mejorar_consulta_busqueda(pregunta_original):
-            pregunta_lower = pregunta_original.lower()
-            if 'precio' in pregunta_lower and 'bitcoin' in pregunta_lower:
+            intencion = clasificar_intencion(pregunta_original)
+            if intencion.tiene('precio') and intencion.tiene('bitcoin'):
                 return [
                     "Bitcoin price USD current today",
                     "precio Bitcoin actual dólares",
                     "BTC price now current value"
                 ]
-            elif 'noticias' in pregunta_lower:
+            elif intencion.noticias:
                 return [
                     f"noticias {pregunta_original} hoy",
                     f"latest news {pregunta_original} today",
                     f"breaking news {pregunta_original} 2025"
                 ]
-            elif 'openai' in pregunta_lower:
+            elif intencion.tiene('openai'):
                 return [
                     "OpenAI news latest updates",
                     "noticias OpenAI ChatGPT",
                     "OpenAI developments 2025"
                 ]
-            elif 'champions' in pregunta_lower or 'deportes' in pregunta_lower:
+            elif intencion.tiene('deportes'):
                 return [
                     "Champions League final winner",
                     "latest sports news football",
                     "resultados deportivos recientes"
                 ]
-            elif 'petróleo' in pregunta_lower or 'oil' in pregunta_lower:
+            elif intencion.tiene('petroleo'):
                 return [
                     "oil price current USD barrel",
                     "precio petróleo actual",
@@ -1993,38 +5083,11 @@ def busqueda_rapida() -> Union[Response, Tuple[Response, int]]:
             search_results = None
             consulta_exitosa = None
             
-            # Intentar múltiples consultas hasta obtener resultados útiles
-            for consulta in consultas:
-                try:
-                    print(f"🔍 Buscando: {consulta}")
-                    resultado = search_tool.invoke(consulta)
-                    
-                    # Verificar si el resultado tiene contenido útil
-                    if resultado and len(resultado.strip()) > 50:
-                        # Verificaciones adicionales para detectar resultados irrelevantes
-                        resultado_lower = resultado.lower()
-                        palabras_irrelevantes = [
-                            "no se encontraron resultados",
-                            "página no encontrada", 
-                            "error 404",
-                            "no hay resultados",
-                            "try again later"
-                        ]
-                        
-                        # Verificar que no tenga palabras irrelevantes
-                        es_irrelevante = any(palabra in resultado_lower for palabra in palabras_irrelevantes)
-                        
-                        if not es_irrelevante:
-                            search_results = resultado
-                            consulta_exitosa = consulta
-                            print(f"✅ Búsqueda exitosa con: {consulta}")
-                            break
-                        else:
-                            print(f"⚠️ Resultado irrelevante con: {consulta}")
-                
-                except Exception as e:
-                    print(f"⚠️ Error en búsqueda '{consulta}': {e}")
-                    continue
+            # Todas las variantes a la vez: gana la primera con resultados útiles
+            print(f"🔍 Buscando {len(consultas)} variantes: {consultas}")
+            encontrada = servicio_ddg.primera_util(consultas)
+            if encontrada:
+                consulta_exitosa, search_results = encontrada
             
             if not search_results:
                 # Fallback inteligente para cualquier consulta
@@ -2176,21 +5239,7 @@ def clima_actual() -> Union[Response, Tuple[Response, int]]:
             return jsonify({'error': 'No se proporcionó ninguna pregunta'}), 400
         
         # Extraer ciudad de la pregunta
-        ciudad = 'Quito'  # Default
-        pregunta_lower = pregunta.lower()
-        
-        if 'quito' in pregunta_lower:
-            ciudad = 'Quito'
-        elif 'guayaquil' in pregunta_lower:
-            ciudad = 'Guayaquil'
-        elif 'cuenca' in pregunta_lower:
-            ciudad = 'Cuenca'
-        elif 'new york' in pregunta_lower or 'nueva york' in pregunta_lower:
-            ciudad = 'New York'
-        elif 'madrid' in pregunta_lower:
-            ciudad = 'Madrid'
-        elif 'london' in pregunta_lower or 'londres' in pregunta_lower:
-            ciudad = 'London'
+        ciudad = clasificar_intencion(pregunta).ciudad_o_defecto()
         
         print(f"🌤️ Consulta rápida de clima para {ciudad}")
         tiempo_inicio = time.time()
@@ -2278,15 +5327,9 @@ def clima_api() -> Union[Response, Tuple[Response, int]]:
         data = request.get_json()
         pregunta = data.get('pregunta', '')
         modelo_seleccionado = data.get('modelo', available_models[0] if available_models else 'gemini-1.5-flash')
-        ciudad = data.get('ciudad', 'Quito')
         
-        # Extraer ciudad de la pregunta si está presente
-        if 'quito' in pregunta.lower():
-            ciudad = 'Quito'
-        elif 'guayaquil' in pregunta.lower():
-            ciudad = 'Guayaquil'
-        elif 'cuenca' in pregunta.lower():
-            ciudad = 'Cuenca'
+        # Ciudad de la pregunta si está presente; si no, la indicada en la petición
+        ciudad = clasificar_intencion(pregunta).ciudad or data.get('ciudad', Config.INTENT_DEFAULT_CITY)
         
         print(f"🌤️ Solicitando clima para {ciudad}...")
         
@@ -2394,64 +5437,163 @@ def agente_general() -> Union[Response, Tuple[Response, int]]:
     except Exception as e:
         return jsonify({'error': f'Error en agente general: {str(e)}'}), 500
 
-@app.route('/api/models/status', methods=['GET'])
-def get_models_status():
-    """Obtener el estado actual de todos los modelos"""
-    try:
-        import requests
+def estado_modelos(inventario: Dict) -> Dict:
+    """Estado de los backends (a partir del inventario del monitor) más colas, circuitos y enrutador"""
+    model_status = {
+        'ollama': {
+            'available': inventario['ollama']['available'],
+            'models': [
+                {
+                    'name': model['name'],
+                    'size': model.get('size', 'Unknown'),
+                    'modified': model.get('modified_at', 'Unknown')
+                }
+                for model in inventario['ollama']['models']
+            ]
+        },
+        'lmstudio': {
+            'available': inventario['lmstudio']['available'],
+            'models': [
+                {
+                    'id': model['id'],
+                    'object': model.get('object', 'model')
+                }
+                for model in inventario['lmstudio']['models']
+            ]
+        },
+        'gemini': {
+            'available': inventario['gemini']['available']
+        }
+    }
+    
+    # Estado de las colas de cada backend
+    for backend, planificador in planificadores.items():
+        model_status[backend]['cola'] = planificador.resumen()
+    
+    # Salud, latencias (p50/p95) y tasa de error por modelo según el enrutador. Va antes que los
+    # circuitos: al consultar la salud se registran los circuitos que aún no existían
+    model_status['enrutador'] = {
+        'politica': Config.ROUTER_POLICY,
+        'modelos': enrutador.resumen()
+    }
+    
+    # Circuit breakers por endpoint (estado, latencias y timeout adaptativo)
+    model_status['circuitos'] = estado_circuitos()
+    
+    model_status['monitor'] = monitor_backends.resumen()
+    return model_status
+
+def ollama_en_ejecucion(inventario: Dict) -> Dict:
+    """Modelos de Ollama instalados, marcando los que están cargados en memoria"""
+    if not inventario['ollama']['available']:
+        return {
+            'ollama_available': False,
+            'models': [],
+            'running_count': 0
+        }
+    
+    running_models = inventario['ollama']['running']
+    models_status = []
+    for model in inventario['ollama']['models']:
+        model_name = model['name']
+        running_info = next((rm for rm in running_models if rm['name'] == model_name), None)
         
-        model_status = {
-            'ollama': {
-                'available': False,
-                'models': []
-            },
-            'lmstudio': {
-                'available': False,
-                'models': []
-            },
-            'gemini': {
-                'available': bool(Config.GOOGLE_API_KEY)
-            }
+        model_info = {
+            'name': model_name,
+            'is_running': running_info is not None,
+            'size': model.get('size', 'Unknown'),
+            'modified': model.get('modified_at', 'Unknown'),
+            'digest': model.get('digest', '')[:12] if model.get('digest') else ''
         }
         
-        # Verificar Ollama
-        try:
-            response = requests.get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=5)
-            if response.status_code == 200:
-                model_status['ollama']['available'] = True
-                ollama_models_data = response.json().get('models', [])
-                model_status['ollama']['models'] = [
-                    {
-                        'name': model['name'],
-                        'size': model.get('size', 'Unknown'),
-                        'modified': model.get('modified_at', 'Unknown')
-                    }
-                    for model in ollama_models_data
-                ]
-        except:
-            pass
-            
-        # Verificar LM Studio
-        try:
-            response = requests.get(f"{Config.LMSTUDIO_BASE_URL}/v1/models", timeout=5)
-            if response.status_code == 200:
-                model_status['lmstudio']['available'] = True
-                lm_models_data = response.json().get('data', [])
-                model_status['lmstudio']['models'] = [
-                    {
-                        'id': model['id'],
-                        'object': model.get('object', 'model')
-                    }
-                    for model in lm_models_data
-                ]
-        except:
-            pass
-            
-        return jsonify(model_status)
+        # Si está ejecutándose, añadir información adicional
+        if running_info:
+            model_info.update({
+                'vram_usage': running_info.get('size_vram', 0),
+                'expires_at': running_info.get('expires_at', ''),
+            })
         
+        models_status.append(model_info)
+    
+    return {
+        'ollama_available': True,
+        'models': models_status,
+        'running_count': len(running_models)
+    }
+
+def huella_estado(estado: Dict) -> str:
+    """Huella de lo que significa el estado (inventario, circuitos, salud y ocupación de las colas).
+    
+    Deja fuera contadores y latencias, que cambian en cada sondeo: dos estados con la misma
+    huella son equivalentes para el cliente (ETag débil).
+    """
+    significativo = {
+        'monitor': estado['monitor']['version'],
+        'backends': {b: estado[b]['available'] for b in ('ollama', 'lmstudio', 'gemini')},
+        'colas': {b: (estado[b]['cola']['en_vuelo'], estado[b]['cola']['en_cola']) for b in planificadores},
+        'circuitos': {nombre: datos['estado'] for nombre, datos in estado['circuitos'].items()},
+        'sanos': {m: datos['sano'] for m, datos in estado['enrutador']['modelos'].items()}
+    }
+    return hashlib.sha1(json.dumps(significativo, sort_keys=True).encode('utf-8')).hexdigest()
+
+def respuesta_con_etag(datos: Dict, huella: Optional[str] = None) -> Response:
+    """JSON con ETag: si el cliente ya tiene esta versión recibe un 304 sin cuerpo"""
+    respuesta = jsonify(datos)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    if huella is not None:
+        respuesta.set_etag(huella, weak=True)
+    else:
+        respuesta.add_etag()
+    return respuesta.make_conditional(request)
+
+@app.route('/api/models/status', methods=['GET'])
+def get_models_status():
+    """Obtener el estado actual de todos los modelos (instantánea del monitor, sin sondear)"""
+    try:
+        estado = estado_modelos(monitor_backends.instantanea())
+        return respuesta_con_etag(estado, huella_estado(estado))
     except Exception as e:
         return jsonify({'error': f'Error al obtener estado de modelos: {str(e)}'}), 500
 
+def evento_estado_modelos(huella_enviada: Optional[str]) -> Tuple[str, str]:
+    """(huella, evento SSE) del estado actual: 'estado' si cambió respecto a `huella_enviada`, si no un ping"""
+    inventario = monitor_backends.instantanea()
+    estado = estado_modelos(inventario)
+    huella = huella_estado(estado)
+    if huella == huella_enviada:
+        # Comentario SSE: mantiene viva la conexión a través de proxies
+        return huella, ': ping\n\n'
+    return huella, evento_sse('estado', {
+        'estado': estado,
+        'ollama_running': ollama_en_ejecucion(inventario)
+    })
+
+@app.route('/api/models/status/eventos', methods=['GET'])
+def eventos_estado_modelos():
+    """Canal SSE: emite 'estado' (estado + modelos de Ollama en ejecución) cada vez que cambia.
+    
+    Se despierta con cada cambio de inventario del monitor y, como mínimo, cada
+    HEALTH_MONITOR_HEARTBEAT segundos para detectar cambios de circuitos, salud o colas.
+    Bajo asgi.py el canal se sirve en el event loop (estado_modelos_stream_async) y no llega aquí.
+    """
+    if not monitor_backends.activo():
+        return jsonify({'error': 'El monitor de backends está desactivado (HEALTH_MONITOR_ENABLED)'}), 503
+    
+    def generar_eventos():
+        version = -1
+        huella_enviada = None
+        while True:
+            monitor_backends.esperar_cambio(version, Config.HEALTH_MONITOR_HEARTBEAT)
+            version = monitor_backends.version
+            huella_enviada, evento = evento_estado_modelos(huella_enviada)
+            yield evento
+    
+    return Response(
+        stream_with_context(generar_eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/models/ollama/<action>', methods=['POST'])
 def control_ollama(action):
     """Controlar modelos de Ollama"""
@@ -2465,6 +5607,7 @@ def control_ollama(action):
                     ['ollama', 'serve'],
                     creationflags=subprocess.CREATE_NEW_CONSOLE if os.name == 'nt' else 0
                 )
+                monitor_backends.refrescar()
                 return jsonify({'message': 'Ollama iniciado en background', 'status': 'started'})
             except Exception as e:
                 return jsonify({'error': f'Error al iniciar Ollama: {str(e)}'}), 500
@@ -2476,6 +5619,7 @@ def control_ollama(action):
                     subprocess.run(['taskkill', '/F', '/IM', 'ollama.exe'], check=False)
                 else:
                     subprocess.run(['pkill', 'ollama'], check=False)
+                monitor_backends.refrescar()
                 return jsonify({'message': 'Ollama detenido', 'status': 'stopped'})
             except Exception as e:
                 return jsonify({'error': f'Error al detener Ollama: {str(e)}'}), 500
@@ -2523,14 +5667,13 @@ def control_ollama_individual(model_name, action):
     """Controlar modelos individuales de Ollama"""
     try:
         import subprocess
-        import requests
         
         if action == 'run':
             # Ejecutar modelo específico
             try:
                 # Primero verificar si Ollama está ejecutándose
                 try:
-                    requests.get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=3)
+                    http_get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=3)
                 except:
                     # Si Ollama no está ejecutándose, iniciarlo primero
                     subprocess.Popen(
@@ -2547,6 +5690,7 @@ def control_ollama_individual(model_name, action):
                     creationflags=subprocess.CREATE_NEW_CONSOLE if os.name == 'nt' else 0
                 )
                 
+                monitor_backends.refrescar()
                 return jsonify({
                     'message': f'Modelo {model_name} cargado exitosamente',
                     'model': model_name,
@@ -2559,6 +5703,7 @@ def control_ollama_individual(model_name, action):
             # Detener modelo específico
             try:
                 subprocess.run(['ollama', 'stop', model_name], check=True, timeout=10)
+                monitor_backends.refrescar()
                 return jsonify({
                     'message': f'Modelo {model_name} detenido exitosamente',
                     'model': model_name,
@@ -2577,66 +5722,9 @@ def control_ollama_individual(model_name, action):
 
 @app.route('/api/models/ollama/running', methods=['GET'])
 def get_running_ollama_models():
-    """Obtener modelos de Ollama que están ejecutándose actualmente"""
+    """Obtener modelos de Ollama que están ejecutándose actualmente (instantánea del monitor)"""
     try:
-        import requests
-        
-        # Verificar si Ollama está ejecutándose
-        try:
-            # Intentar obtener información de modelos en ejecución
-            response = requests.get(f"{Config.OLLAMA_BASE_URL}/api/ps", timeout=5)
-            if response.status_code == 200:
-                running_models = response.json().get('models', [])
-                
-                # También obtener todos los modelos disponibles
-                tags_response = requests.get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=5)
-                all_models = []
-                if tags_response.status_code == 200:
-                    all_models = tags_response.json().get('models', [])
-                
-                # Crear estructura de respuesta con estado de cada modelo
-                models_status = []
-                for model in all_models:
-                    model_name = model['name']
-                    is_running = any(rm['name'] == model_name for rm in running_models)
-                    
-                    model_info = {
-                        'name': model_name,
-                        'is_running': is_running,
-                        'size': model.get('size', 'Unknown'),
-                        'modified': model.get('modified_at', 'Unknown'),
-                        'digest': model.get('digest', '')[:12] if model.get('digest') else ''
-                    }
-                    
-                    # Si está ejecutándose, añadir información adicional
-                    if is_running:
-                        running_info = next((rm for rm in running_models if rm['name'] == model_name), None)
-                        if running_info:
-                            model_info.update({
-                                'vram_usage': running_info.get('size_vram', 0),
-                                'expires_at': running_info.get('expires_at', ''),
-                            })
-                    
-                    models_status.append(model_info)
-                
-                return jsonify({
-                    'ollama_available': True,
-                    'models': models_status,
-                    'running_count': len(running_models)
-                })
-            else:
-                return jsonify({
-                    'ollama_available': False,
-                    'models': [],
-                    'running_count': 0
-                })
-        except:
-            return jsonify({
-                'ollama_available': False,
-                'models': [],
-                'running_count': 0
-            })
-            
+        return respuesta_con_etag(ollama_en_ejecucion(monitor_backends.instantanea()))
     except Exception as e:
         return jsonify({'error': f'Error al obtener modelos en ejecución: {str(e)}'}), 500
 
@@ -2739,22 +5827,16 @@ def ollama_console_command():
 def get_ollama_models_for_actions():
     """Obtener lista de modelos para acciones (run/stop)"""
     try:
-        import requests
         import subprocess
         
-        # Intentar obtener modelos via API REST
-        try:
-            response = requests.get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                models = [model['name'] for model in data.get('models', [])]
-                return jsonify({
-                    'models': models,
-                    'source': 'api',
-                    'available': True
-                })
-        except:
-            pass
+        # Inventario de la API REST que mantiene el monitor de backends
+        inventario = monitor_backends.instantanea()
+        if inventario['ollama']['available']:
+            return jsonify({
+                'models': [model['name'] for model in inventario['ollama']['models']],
+                'source': 'api',
+                'available': True
+            })
         
         # Si falla la API, intentar con comando
         try:
@@ -2919,48 +6001,109 @@ def subir_archivo_endpoint():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def leer_limite(por_defecto: int) -> int:
+    """Lee ?limit= acotado a [1, MAX_LIMITE_PAGINA]"""
+    return max(1, min(request.args.get('limit', por_defecto, type=int), MAX_LIMITE_PAGINA))
+
 @app.route('/api/historial/<session_id>', methods=['GET'])
 def obtener_historial_endpoint(session_id):
-    """Endpoint para obtener historial de conversaciones"""
+    """Endpoint para obtener historial de conversaciones (paginado con ?cursor= y ?campos=)"""
     try:
-        limit = request.args.get('limit', 50, type=int)
-        historial = get_conversation_history(session_id, limit)
+        limit = leer_limite(50)
+        historial, siguiente_cursor = get_conversation_page(
+            session_id, limit, request.args.get('cursor'), parsear_campos(request.args.get('campos'))
+        )
         
         return jsonify({
             'session_id': session_id,
             'conversaciones': historial,
-            'total': len(historial)
+            'total': len(historial),
+            'siguiente_cursor': siguiente_cursor
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/sesiones', methods=['GET'])
-def obtener_sesiones_endpoint():
-    """Endpoint para obtener lista de sesiones"""
+@app.route('/api/historial/<session_id>/exportar', methods=['GET'])
+def exportar_historial_endpoint(session_id):
+    """Exporta el historial completo de una sesión en streaming (?formato=ndjson|csv, ?campos=)"""
     try:
-        conn = sqlite3.connect('chat_history.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT session_id, title, created_at, last_activity
-            FROM sessions 
-            ORDER BY last_activity DESC 
-            LIMIT 100
-        ''')
+        formato = request.args.get('formato', 'ndjson')
+        campos = parsear_campos(request.args.get('campos'))
+        if formato not in ('ndjson', 'csv'):
+            raise ValueError("Formato no válido: usa 'ndjson' o 'csv'")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def generar_ndjson():
+        for conversacion in iterar_conversaciones(session_id, campos):
+            yield json.dumps(conversacion, ensure_ascii=False) + '\n'
+    
+    def generar_csv():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(campos)
+        # En CSV la metadata se exporta tal cual está guardada (texto JSON), sin parsearla
+        for conversacion in iterar_conversaciones(session_id, campos, parsear_metadata=False):
+            escritor.writerow([conversacion[campo] for campo in campos])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+    
+    if formato == 'csv':
+        generador, mimetype = generar_csv(), 'text/csv; charset=utf-8'
+    else:
+        generador, mimetype = generar_ndjson(), 'application/x-ndjson; charset=utf-8'
+    
+    nombre_archivo = f"historial_{secure_filename(session_id) or 'sesion'}.{formato}"
+    return Response(
+        stream_with_context(generador),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{nombre_archivo}"'}
+    )
+
+@app.route('/api/historial/buscar', methods=['GET'])
+def buscar_historial_endpoint():
+    """Búsqueda de texto completo en el historial (?q=, ?modelo=, ?desde=, ?hasta=, ?pagina=, ?limit=)"""
+    try:
+        texto = request.args.get('q', '').strip()
+        if not texto:
+            return jsonify({'error': 'No se proporcionó ningún texto de búsqueda (?q=)'}), 400
         
-        rows = cursor.fetchall()
-        conn.close()
+        limit = leer_limite(20)
+        pagina = max(1, request.args.get('pagina', 1, type=int))
+        resultados = buscar_conversaciones(
+            texto, limit, pagina,
+            modelo=request.args.get('modelo'),
+            desde=request.args.get('desde'),
+            hasta=request.args.get('hasta')
+        )
         
-        sesiones = [{
-            'session_id': row[0],
-            'title': row[1],
-            'created_at': row[2],
-            'last_activity': row[3]
-        } for row in rows]
+        return jsonify({
+            'q': texto,
+            'resultados': resultados,
+            'total': len(resultados),
+            'pagina': pagina,
+            'siguiente_pagina': pagina + 1 if len(resultados) == limit else None
+        })
         
-        return jsonify({'sesiones': sesiones})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/sesiones', methods=['GET'])
+def obtener_sesiones_endpoint():
+    """Endpoint para obtener lista de sesiones (paginado con ?cursor=)"""
+    try:
+        sesiones, siguiente_cursor = get_sessions_page(leer_limite(100), request.args.get('cursor'))
+        return jsonify({'sesiones': sesiones, 'siguiente_cursor': siguiente_cursor})
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -2999,21 +6142,13 @@ def chat_with_enhanced_reasoning():
             prompt_especial = pregunta
         
         # Ejecutar consulta
-        resultado = simple_chains[modelo_seleccionado].invoke({"pregunta": prompt_especial})
+        resultado, info_generacion = invocar_chain_con_metadata(modelo_seleccionado, prompt_especial)
         
         tiempo_fin = time.time()
         duracion = round(tiempo_fin - tiempo_inicio, 2)
         
         # Extraer reasoning si está disponible
-        reasoning_content = None
-        if modelo_seleccionado == 'lmstudio-deepseek':
-            modelo_instance = models[modelo_seleccionado]
-            if hasattr(modelo_instance, '_last_response') and modelo_instance._last_response:
-                last_response = modelo_instance._last_response
-                if isinstance(last_response, dict) and "choices" in last_response:
-                    choice = last_response["choices"][0]
-                    if "message" in choice and "reasoning_content" in choice["message"]:
-                        reasoning_content = choice["message"]["reasoning_content"]
+        reasoning_content = info_generacion.get('reasoning_content')
         
         # Guardar en historial
         save_conversation(
@@ -3035,7 +6170,9 @@ def chat_with_enhanced_reasoning():
             'duracion': duracion,
             'session_id': session_id,
             'timestamp': datetime.datetime.now().isoformat(),
-            'enhanced_mode': True
+            'enhanced_mode': True,
+            'usage': info_generacion.get('usage'),
+            'tiempo_generacion': info_generacion.get('tiempo_generacion')
         }
         
         return jsonify(respuesta_data)
@@ -3043,6 +6180,51 @@ def chat_with_enhanced_reasoning():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/cache/estadisticas', methods=['GET'])
+def obtener_estadisticas_cache():
+    """Endpoint con los contadores de las cachés de respuestas, semántica y de herramientas"""
+    try:
+        estadisticas = {
+            'respuestas': {'habilitada': almacen_respuestas is not None},
+            'semantica': {'habilitada': cache_semantica is not None},
+            'busqueda': cache_busqueda.resumen(),
+            'clima': cache_clima.resumen()
+        }
+        if almacen_respuestas is not None:
+            estadisticas['respuestas'].update(almacen_respuestas.resumen())
+            estadisticas['respuestas']['modelos_con_cache'] = [
+                model_key for model_key in available_models
+                if models.construido(model_key) and isinstance(getattr(models[model_key], 'cache', None), CacheRespuestas)
+            ]
+        if cache_semantica is not None:
+            estadisticas['semantica'].update(cache_semantica.resumen())
+        with estadisticas_prefijo_lock:
+            estadisticas['prefijo'] = dict(estadisticas_prefijo)
+        if estadisticas['prefijo']['tokens_prompt']:
+            estadisticas['prefijo']['proporcion_cacheada'] = round(
+                estadisticas['prefijo']['tokens_cacheados'] / estadisticas['prefijo']['tokens_prompt'], 3
+            )
+        
+        return jsonify(estadisticas)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/cache/limpiar', methods=['POST'])
+def limpiar_cache_endpoint():
+    """Endpoint para vaciar las cachés de respuestas, semántica y de herramientas"""
+    try:
+        if almacen_respuestas is not None:
+            almacen_respuestas.limpiar()
+        if cache_semantica is not None:
+            cache_semantica.limpiar()
+        cache_busqueda.limpiar()
+        cache_clima.limpiar()
+        return jsonify({'success': True})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/workspace/tools', methods=['GET'])
 def obtener_herramientas_disponibles():
     """Endpoint para obtener lista de herramientas disponibles"""
@@ -3075,8 +6257,9 @@ def obtener_herramientas_disponibles():
             'historial': {
                 'nombre': 'Historial Persistente',
                 'descripcion': 'Gestión de conversaciones y sesiones',
-                'funciones': ['guardar', 'recuperar', 'buscar'],
-                'endpoint': '/api/historial'
+                'funciones': ['guardar', 'recuperar', 'buscar', 'exportar'],
+                'endpoint': '/api/historial',
+                'endpoint_busqueda': '/api/historial/buscar'
             },
             'reasoning_enhanced': {
                 'nombre': 'Chat con Reasoning Avanzado',
@@ -3122,6 +6305,9 @@ if __name__ == '__main__':
     print("  /api/subir-archivo        - Procesamiento de archivos")
     print("  /api/historial/<session>  - Gestión de historial")
     print("  /api/reasoning-enhanced   - Chat con reasoning mejorado")
+    print("  /chat/stream              - Chat con streaming de tokens (SSE)")
+    print("  /chat/agente/stream       - Agente con pasos en vivo (SSE, cancelable)")
     print("")
+    print("⚡ Modo asíncrono (ASGI): python asgi.py  o  uvicorn asgi:application --port 5000")
     print("🚀 ¡Aplicación lista! Usa /enhanced para la versión completa")
     app.run(debug=True, host='127.0.0.1', port=5000)
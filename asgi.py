@@ -0,0 +1,325 @@
+# Servidor ASGI: rutas de chat asíncronas + resto de la aplicación Flask
+#
+# Las rutas /chat (modo simple) y /chat/stream se atienden con corutinas sobre el cliente
+# HTTP asíncrono, de modo que cientos de generaciones en espera no ocupan un hilo cada una.
+# Todo lo demás (agente, clima, historial, herramientas) se delega a la app Flask, que atiende
+# cada petición en un hilo de un pool acotado (ASGI_WSGI_THREADS). El canal SSE de estado de los
+# modelos también se sirve aquí: es una conexión larga que en Flask ocuparía un hilo entero.
+#
+# Las rutas de chat se atienden con un token de cancelación (plazo de la petición) que se cancela
+# si el cliente se desconecta: las generaciones en curso se cortan en lugar de seguir ocupando el
+# servidor de inferencia.
+#
+# Uso:
+#     uvicorn asgi:application --host 127.0.0.1 --port 5000
+#     python asgi.py
+import asyncio
+import contextlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from config import Config
+from http_client import PeticionCanceladaError, TokenCancelacion, con_cancelacion
+
+from app import (
+    app,
+    available_models,
+    chat_chains,
+    simple_chains,
+    AcumuladorStream,
+    ColaSaturadaError,
+    construir_respuesta_simple,
+    construir_respuesta_timeout,
+    enrutador,
+    evento_estado_modelos,
+    monitor_backends,
+    buscar_en_cache_semantica,
+    es_timeout_lmstudio,
+    guardar_en_cache_semantica,
+    huella_historial,
+    invocar_con_enrutado_async,
+    pensamientos_modo_simple,
+    plazo_peticion,
+    preparar_memoria,
+    respuesta_cola_saturada,
+    respuesta_peticion_cancelada,
+    requiere_flujo_completo,
+)
+
+# WsgiToAsgi ejecuta la app WSGI con thread_sensitive=True: todas las peticiones delegadas
+# comparten un único hilo y una lenta (o un stream SSE) bloquea a las demás
+ejecutor_wsgi = ThreadPoolExecutor(max_workers=Config.ASGI_WSGI_THREADS, thread_name_prefix='flask')
+
+class InstanciaWsgiEnPool(WsgiToAsgiInstance):
+    """WsgiToAsgiInstance que ejecuta la app WSGI en `ejecutor_wsgi` (asgiref copia el contexto)"""
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False,
+                                 executor=ejecutor_wsgi)
+
+class WsgiToAsgiEnPool(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await InstanciaWsgiEnPool(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+flask_asgi = WsgiToAsgiEnPool(app)
+
+RUTAS_ASYNC = {'/chat', '/chat/stream'}
+# Rutas que se cancelan si el cliente se desconecta (las que no son asíncronas las atiende Flask)
+RUTAS_CANCELABLES = RUTAS_ASYNC | {'/chat/agente/stream'}
+RUTA_ESTADO_EVENTOS = '/api/models/status/eventos'
+
+async def leer_cuerpo(receive) -> bytes:
+    """Lee el cuerpo completo de la petición HTTP"""
+    cuerpo = b''
+    while True:
+        mensaje = await receive()
+        cuerpo += mensaje.get('body', b'')
+        if not mensaje.get('more_body', False):
+            return cuerpo
+
+def receive_con_cuerpo(cuerpo: bytes, receive):
+    """Devuelve un 'receive' que vuelve a entregar el cuerpo ya leído (para delegar a Flask)"""
+    entregado = False
+
+    async def _receive():
+        nonlocal entregado
+        if not entregado:
+            entregado = True
+            return {'type': 'http.request', 'body': cuerpo, 'more_body': False}
+        return await receive()
+
+    return _receive
+
+async def esperar_desconexion(receive):
+    """Vuelve cuando el cliente cierra la conexión (el cuerpo ya se ha leído)"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def ejecutar_cancelable(corutina, receive, token: TokenCancelacion, en_hilo: bool):
+    """Atiende la petición con `token` activo y lo cancela si el cliente se desconecta.
+
+    El token llega por contextvars a las corutinas y al hilo de Flask (asgiref copia el contexto),
+    y al cancelarlo se cortan las llamadas en curso a los backends. Una corutina propia además se
+    cancela como tarea; el hilo de Flask no se puede interrumpir y se espera a que termine.
+    """
+    with con_cancelacion(token):
+        tarea = asyncio.ensure_future(corutina)
+    desconexion = asyncio.ensure_future(esperar_desconexion(receive))
+    try:
+        await asyncio.wait({tarea, desconexion}, return_when=asyncio.FIRST_COMPLETED)
+        if not tarea.done():
+            print("🔌 Cliente desconectado: cancelando la petición")
+            token.cancelar('cliente desconectado')
+            if not en_hilo:
+                tarea.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await tarea
+    finally:
+        desconexion.cancel()
+
+async def enviar_json(send, datos: Dict, status: int = 200):
+    cuerpo = json.dumps(datos, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(cuerpo)).encode())
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': cuerpo})
+
+def leer_parametros(datos: Dict) -> Tuple[str, str, str, bool, str]:
+    """Extrae los parámetros de chat con los mismos valores por defecto que /chat"""
+    pregunta = datos.get('pregunta', '')
+    modo = datos.get('modo', 'simple')
+    modelo_seleccionado = datos.get('modelo', available_models[0] if available_models else 'llama3')
+    permitir_internet = datos.get('permitir_internet', True)
+    session_id = datos.get('session_id', str(int(time.time())))
+    return pregunta, modo, modelo_seleccionado, permitir_internet, session_id
+
+async def chat_async(send, datos: Dict, candidatos: List[str], enrutado: Dict):
+    """Versión asíncrona del modo simple de /chat"""
+    pregunta, modo, _, permitir_internet, session_id = leer_parametros(datos)
+    modelo_seleccionado = enrutado['usado']
+
+    tiempo_inicio = time.time()
+    pensamientos_proceso = pensamientos_modo_simple(modelo_seleccionado, pregunta)
+
+    try:
+        # La memoria lee SQLite (y puede resumir con el modelo): fuera del event loop
+        historial, info_memoria = await asyncio.to_thread(
+            preparar_memoria, modelo_seleccionado, session_id, datos.get('usar_memoria', True)
+        )
+        omitir_cache = datos.get('omitir_cache', False)
+        contexto_cache = huella_historial(historial)
+
+        en_cache = buscar_en_cache_semantica(modelo_seleccionado, pregunta, omitir_cache, contexto_cache)
+        if en_cache:
+            resultado, info_generacion = en_cache
+            pensamientos_proceso.append("⚡ Respuesta reutilizada de una pregunta similar")
+        else:
+            resultado, info_generacion = await invocar_con_enrutado_async(candidatos, pregunta, historial, enrutado)
+            modelo_seleccionado = enrutado['usado']
+            guardar_en_cache_semantica(modelo_seleccionado, pregunta, resultado, info_generacion,
+                                       omitir_cache, contexto_cache)
+        if info_memoria:
+            info_generacion['memoria'] = info_memoria
+        info_generacion['enrutado'] = enrutado
+        # El guardado en SQLite es bloqueante: se hace fuera del event loop
+        respuesta_data = await asyncio.to_thread(
+            construir_respuesta_simple,
+            pregunta, modelo_seleccionado, session_id, permitir_internet,
+            resultado, info_generacion, pensamientos_proceso, tiempo_inicio
+        )
+        await enviar_json(send, respuesta_data)
+    except Exception as e:
+        if isinstance(e, ColaSaturadaError):
+            await enviar_json(send, respuesta_cola_saturada(e), 503)
+            return
+        if isinstance(e, PeticionCanceladaError):
+            await enviar_json(send, *respuesta_peticion_cancelada(e))
+            return
+        if es_timeout_lmstudio(e, modelo_seleccionado):
+            await enviar_json(send, construir_respuesta_timeout(
+                pregunta, modelo_seleccionado, permitir_internet, pensamientos_proceso, tiempo_inicio
+            ))
+            return
+        print(f"❌ Error en chat asíncrono: {e}")
+        await enviar_json(send, {'error': f'Error al procesar la pregunta: {str(e)}'}, 500)
+
+async def chat_stream_async(send, datos: Dict, candidatos: List[str], enrutado: Dict):
+    """Versión asíncrona de /chat/stream"""
+    pregunta, modo, _, permitir_internet, session_id = leer_parametros(datos)
+    modelo_seleccionado = enrutado['usado']
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+
+    async def enviar_evento(evento: str):
+        await send({'type': 'http.response.body', 'body': evento.encode('utf-8'), 'more_body': True})
+
+    acumulador = AcumuladorStream(pregunta, modelo_seleccionado, session_id, permitir_internet,
+                                  datos.get('omitir_cache', False), enrutado=enrutado)
+
+    try:
+        # Dentro del try: la cabecera ya está enviada y un fallo de la memoria debe llegar como evento
+        historial, info_memoria = await asyncio.to_thread(
+            preparar_memoria, modelo_seleccionado, session_id, datos.get('usar_memoria', True)
+        )
+        acumulador.usar_memoria(historial, info_memoria)
+        await enviar_evento(acumulador.evento_inicio())
+
+        eventos_cache = acumulador.eventos_desde_cache()
+        if eventos_cache is not None:
+            for evento in eventos_cache:
+                await enviar_evento(evento)
+        else:
+            primer_error = None
+            for i, candidato in enumerate(candidatos):
+                try:
+                    async for chunk in chat_chains[candidato].astream({"pregunta": pregunta, "historial": historial}):
+                        for evento in acumulador.procesar(chunk):
+                            await enviar_evento(evento)
+                    break
+                except Exception as e:
+                    primer_error = primer_error or e
+                    # Failover solo mientras el cliente no haya recibido ningún token (y siga esperando)
+                    if acumulador.tiempo_primer_token is not None or isinstance(e, PeticionCanceladaError):
+                        raise
+                    if i == len(candidatos) - 1:
+                        raise primer_error
+                    acumulador.cambiar_modelo(candidatos[i + 1])
+        await enviar_evento(await asyncio.to_thread(acumulador.evento_fin))
+    except Exception as e:
+        await enviar_evento(acumulador.evento_error(e))
+
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+async def estado_modelos_stream_async(receive, send):
+    """Versión asíncrona de /api/models/status/eventos: espera los cambios del monitor en el event loop"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+
+    async def emitir_eventos():
+        version = -1
+        huella_enviada = None
+        while True:
+            await monitor_backends.esperar_cambio_async(version, Config.HEALTH_MONITOR_HEARTBEAT)
+            version = monitor_backends.version
+            # estado_modelos() consulta enrutador y circuitos con locks: fuera del event loop
+            huella_enviada, evento = await asyncio.to_thread(evento_estado_modelos, huella_enviada)
+            await send({'type': 'http.response.body', 'body': evento.encode('utf-8'), 'more_body': True})
+
+    emisor = asyncio.ensure_future(emitir_eventos())
+    desconexion = asyncio.ensure_future(esperar_desconexion(receive))
+    try:
+        await asyncio.wait({emisor, desconexion}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        emisor.cancel()
+        desconexion.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await emisor
+
+async def application(scope, receive, send):
+    """Punto de entrada ASGI"""
+    if (scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == RUTA_ESTADO_EVENTOS
+            and monitor_backends.activo()):
+        # Con el monitor desactivado Flask responde el 503
+        await estado_modelos_stream_async(receive, send)
+        return
+    if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in RUTAS_CANCELABLES:
+        await flask_asgi(scope, receive, send)
+        return
+
+    cuerpo = await leer_cuerpo(receive)
+    try:
+        datos = json.loads(cuerpo or b'{}')
+    except json.JSONDecodeError:
+        datos = {}
+
+    pregunta, modo, modelo_seleccionado, permitir_internet, _ = leer_parametros(datos)
+
+    if not pregunta:
+        await enviar_json(send, {'error': 'No se proporcionó ninguna pregunta'}, 400)
+        return
+
+    token = TokenCancelacion(plazo_peticion(datos))
+
+    # Agente, clima y modelos sin chat simple siguen el flujo completo de Flask (en un hilo)
+    candidatos = []
+    if scope['path'] in RUTAS_ASYNC and not requiere_flujo_completo(pregunta, modo, permitir_internet):
+        # El enrutador puede construir modelos (y comprobar LM Studio) en su primer uso: fuera del event loop
+        candidatos, enrutado = await asyncio.to_thread(enrutador.elegir, modelo_seleccionado, datos.get('politica'))
+        candidatos = [m for m in candidatos if m in simple_chains]
+
+    if not candidatos:
+        delegada = flask_asgi(scope, receive_con_cuerpo(cuerpo, receive), send)
+        await ejecutar_cancelable(delegada, receive, token, en_hilo=True)
+        return
+    enrutado['usado'] = candidatos[0]
+
+    if scope['path'] == '/chat/stream':
+        await ejecutar_cancelable(chat_stream_async(send, datos, candidatos, enrutado), receive, token, en_hilo=False)
+    else:
+        await ejecutar_cancelable(chat_async(send, datos, candidatos, enrutado), receive, token, en_hilo=False)
+
+if __name__ == '__main__':
+    import uvicorn
+    print("⚡ Iniciando servidor ASGI (chat asíncrono) en http://127.0.0.1:5000")
+    uvicorn.run(application, host='127.0.0.1', port=5000)
@@ -23,21 +23,173 @@ class Config:
     LMSTUDIO_MODEL = "google/gemma-3-12b"
     LMSTUDIO_MODEL_MISTRAL = "mistral-7b-instruct-v0.3"
     LMSTUDIO_MODEL_DEEPSEEK = "deepseek-coder-6.7b-instruct"
+    # Rol 'system' nativo: prefijo de prompt estable para la caché KV del servidor.
+    # Desactivar para modelos cuya plantilla no admita mensajes de sistema.
+    LMSTUDIO_NATIVE_SYSTEM_ROLE = os.environ.get('LMSTUDIO_NATIVE_SYSTEM_ROLE', 'true').lower() == 'true'
+    # Cada cuánto se vuelve a comprobar si LM Studio responde (detecta que se arrancó después de la app)
+    LMSTUDIO_CHECK_INTERVAL = float(os.environ.get('LMSTUDIO_CHECK_INTERVAL', 30))
+    
+    # Carga diferida de modelos: precalentar en segundo plano al iniciar (opcional)
+    WARMUP_ON_START = os.environ.get('WARMUP_ON_START', 'false').lower() == 'true'
+    WARMUP_AGENTS = os.environ.get('WARMUP_AGENTS', 'false').lower() == 'true'
+    
+    # Prompt de los agentes: 'react' (hwchase17/react incluido) o 'personalizado' (agent_prompt en español)
+    AGENT_PROMPT = os.environ.get('AGENT_PROMPT', 'react')
+    AGENT_PROMPT_HUB_REF = os.environ.get('AGENT_PROMPT_HUB_REF', '')  # Ej: 'hwchase17/react' para descargarlo del hub
+    AGENT_PROMPT_CACHE_PATH = os.environ.get('AGENT_PROMPT_CACHE_PATH', 'agent_prompt_cache.json')
     
     # LangChain settings
-    LANGCHAIN_VERBOSE = True
+    LANGCHAIN_VERBOSE = os.environ.get('LANGCHAIN_VERBOSE', 'true').lower() == 'true'  # Salida verbose del AgentExecutor en consola
     LANGCHAIN_MAX_ITERATIONS = 3
     
     # Chat settings
     DEFAULT_TEMPERATURE = 0.7
     MAX_TOKENS = 1000
     
+    # Base de datos (historial y cachés persistentes)
+    DATABASE_PATH = os.environ.get('DATABASE_PATH', 'chat_history.db')
+    DATABASE_SYNCHRONOUS = os.environ.get('DATABASE_SYNCHRONOUS', 'NORMAL')  # OFF, NORMAL o FULL
+    DATABASE_BUSY_TIMEOUT = int(os.environ.get('DATABASE_BUSY_TIMEOUT', 5000))  # Milisegundos esperando un lock
+    HISTORY_ASYNC_WRITES = os.environ.get('HISTORY_ASYNC_WRITES', 'false').lower() == 'true'  # Guardar historial en segundo plano
+    DATABASE_BATCH_SIZE = int(os.environ.get('DATABASE_BATCH_SIZE', 50))  # Filas máximas por transacción
+    DATABASE_BATCH_INTERVAL = float(os.environ.get('DATABASE_BATCH_INTERVAL', 0.05))  # Segundos esperando más filas
+    
+    # Memoria de conversación (turnos previos de la sesión en el prompt)
+    MEMORY_ENABLED = os.environ.get('MEMORY_ENABLED', 'true').lower() == 'true'
+    MEMORY_MAX_TURNS = int(os.environ.get('MEMORY_MAX_TURNS', 20))  # Turnos recientes que se consideran
+    MEMORY_TOKEN_BUDGET = int(os.environ.get('MEMORY_TOKEN_BUDGET', 1500))  # Tokens (estimados) para historial + resumen
+    # Presupuestos por modelo, ej: 'lmstudio-deepseek=800,gemini-1.5-flash=4000'
+    MEMORY_TOKEN_BUDGETS = {
+        par.split('=')[0].strip(): int(par.split('=')[1])
+        for par in os.environ.get('MEMORY_TOKEN_BUDGETS', '').split(',') if '=' in par
+    }
+    MEMORY_SUMMARY_TOKENS = int(os.environ.get('MEMORY_SUMMARY_TOKENS', 300))  # Tamaño máximo del resumen de turnos antiguos
+    MEMORY_SUMMARY_MODE = os.environ.get('MEMORY_SUMMARY_MODE', 'extractivo')  # 'extractivo' (sin LLM) o 'modelo'
+    
+    # Caché de respuestas (opcional): LRU en memoria + SQLite con TTL
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get('RESPONSE_CACHE_MAX_TEMPERATURE', 0.3))  # Solo modelos (casi) deterministas
+    RESPONSE_CACHE_MEMORY_SIZE = int(os.environ.get('RESPONSE_CACHE_MEMORY_SIZE', 256))  # Entradas en memoria (LRU)
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 86400))  # Segundos
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 5000))  # Filas en SQLite
+    
+    # Caché semántica (opcional): reutiliza respuestas de preguntas parecidas en el modo simple
+    SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+    SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.9))  # Similitud coseno mínima
+    # Umbrales por modelo, ej: 'lmstudio-deepseek=0.85,llama3=0.92'
+    SEMANTIC_CACHE_THRESHOLDS = {
+        par.split('=')[0].strip(): float(par.split('=')[1])
+        for par in os.environ.get('SEMANTIC_CACHE_THRESHOLDS', '').split(',') if '=' in par
+    }
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', 500))  # Por modelo
+    SEMANTIC_CACHE_TTL = int(os.environ.get('SEMANTIC_CACHE_TTL', 3600))  # Segundos
+    SEMANTIC_CACHE_DIMENSION = int(os.environ.get('SEMANTIC_CACHE_DIMENSION', 1024))
+    
+    # Planificador por backend: generaciones simultáneas y espera máxima en la cola
+    # Ej: SCHEDULER_MAX_IN_FLIGHT='lmstudio=2,ollama=1' (subir si el servidor tiene varios slots paralelos)
+    SCHEDULER_MAX_IN_FLIGHT = {
+        'lmstudio': 1,
+        'ollama': 1,
+        'gemini': 8,
+        **{
+            par.split('=')[0].strip(): int(par.split('=')[1])
+            for par in os.environ.get('SCHEDULER_MAX_IN_FLIGHT', '').split(',') if '=' in par
+        }
+    }
+    SCHEDULER_QUEUE_TIMEOUT = float(os.environ.get('SCHEDULER_QUEUE_TIMEOUT', 120))  # Segundos esperando turno
+    SCHEDULER_COALESCE = os.environ.get('SCHEDULER_COALESCE', 'true').lower() == 'true'  # Agrupar peticiones idénticas simultáneas
+    
+    # Enrutador de modelos: política por defecto y modelos intercambiables entre backends
+    # Políticas: 'preferido' (el pedido si está sano), 'rapido' (menor p50 sano), 'barato' (menor coste sano), 'fijo' (sin failover)
+    ROUTER_POLICY = os.environ.get('ROUTER_POLICY', 'preferido')
+    # Ej: ROUTER_EQUIVALENTS='deepseek=lmstudio-deepseek|deepseek-coder,gemma=lmstudio-gemma|gemma3:4b'
+    ROUTER_EQUIVALENTS = {
+        grupo.split('=')[0].strip(): [modelo.strip() for modelo in grupo.split('=')[1].split('|')]
+        for grupo in os.environ.get(
+            'ROUTER_EQUIVALENTS',
+            'deepseek=lmstudio-deepseek|deepseek-coder,gemma=lmstudio-gemma|gemma3:4b|gemma:2b,general=llama3|lmstudio-mistral|phi3|gemini-1.5-flash'
+        ).split(',') if '=' in grupo
+    }
+    # Coste relativo por generación (los locales según tamaño; Gemini es una API de pago)
+    ROUTER_COSTS = {
+        'gemma:2b': 0.2, 'phi3': 0.4, 'gemma3:4b': 0.4, 'deepseek-coder': 0.7, 'llama3': 0.8,
+        'lmstudio-mistral': 0.7, 'lmstudio-deepseek': 0.7, 'lmstudio-gemma': 1.2, 'gemini-1.5-flash': 2.0,
+        **{
+            par.split('=')[0].strip(): float(par.split('=')[1])
+            for par in os.environ.get('ROUTER_COSTS', '').split(',') if '=' in par
+        }
+    }
+    ROUTER_WINDOW = int(os.environ.get('ROUTER_WINDOW', 50))  # Generaciones recientes para p50/p95 y tasa de error
+    ROUTER_MAX_FAILURES = int(os.environ.get('ROUTER_MAX_FAILURES', 3))  # Fallos seguidos para dar un modelo por caído
+    ROUTER_MAX_ERROR_RATE = float(os.environ.get('ROUTER_MAX_ERROR_RATE', 0.5))
+    ROUTER_MIN_SAMPLES = int(os.environ.get('ROUTER_MIN_SAMPLES', 5))  # Muestras mínimas antes de juzgar la tasa de error
+    ROUTER_COOLDOWN = float(os.environ.get('ROUTER_COOLDOWN', 30))  # Segundos antes de volver a probar un modelo caído
+    
+    # Circuit breakers por endpoint y timeouts adaptativos (p95 reciente × factor, con el timeout original como tope)
+    CIRCUIT_ENABLED = os.environ.get('CIRCUIT_ENABLED', 'true').lower() == 'true'
+    CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 3))  # Fallos seguidos para abrir
+    CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 15))  # Segundos abierto antes de la llamada de prueba
+    CIRCUIT_MAX_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_MAX_RESET_TIMEOUT', 300))
+    CIRCUIT_ADAPTIVE_TIMEOUTS = os.environ.get('CIRCUIT_ADAPTIVE_TIMEOUTS', 'true').lower() == 'true'
+    CIRCUIT_WINDOW = int(os.environ.get('CIRCUIT_WINDOW', 50))  # Latencias recientes consideradas
+    CIRCUIT_MIN_SAMPLES = int(os.environ.get('CIRCUIT_MIN_SAMPLES', 5))  # Muestras antes de adaptar el timeout
+    CIRCUIT_TIMEOUT_FACTOR = float(os.environ.get('CIRCUIT_TIMEOUT_FACTOR', 4.0))
+    CIRCUIT_MIN_TIMEOUT = float(os.environ.get('CIRCUIT_MIN_TIMEOUT', 2.0))  # Segundos
+    LMSTUDIO_TIMEOUT = float(os.environ.get('LMSTUDIO_TIMEOUT', 300))  # Tope para generaciones lentas
+    LMSTUDIO_MIN_TIMEOUT = float(os.environ.get('LMSTUDIO_MIN_TIMEOUT', 60))  # La longitud de la respuesta varía mucho
+    
+    # Monitor de backends: sondea Ollama y LM Studio en segundo plano y los endpoints de estado sirven la instantánea
+    HEALTH_MONITOR_ENABLED = os.environ.get('HEALTH_MONITOR_ENABLED', 'true').lower() == 'true'
+    HEALTH_MONITOR_INTERVAL = float(os.environ.get('HEALTH_MONITOR_INTERVAL', 15))  # Segundos entre sondeos
+    HEALTH_MONITOR_JITTER = float(os.environ.get('HEALTH_MONITOR_JITTER', 0.2))  # ±20% para no sincronizar sondeos
+    HEALTH_MONITOR_HEARTBEAT = float(os.environ.get('HEALTH_MONITOR_HEARTBEAT', 20))  # Keep-alive del canal SSE
+    
+    # Búsqueda web: las fuentes se consultan en paralelo con un plazo global
+    SEARCH_MAX_WORKERS = int(os.environ.get('SEARCH_MAX_WORKERS', 8))  # Hilos compartidos por todas las búsquedas
+    SEARCH_MAX_PER_REQUEST = int(os.environ.get('SEARCH_MAX_PER_REQUEST', 4))  # Tareas de una misma búsqueda a la vez en esos hilos
+    SEARCH_DEADLINE = float(os.environ.get('SEARCH_DEADLINE', 8))  # Segundos; lo que no termine se descarta
+
+    # Caché de resultados de herramientas (búsqueda web y clima): memoria + SQLite opcional
+    TOOL_CACHE_ENABLED = os.environ.get('TOOL_CACHE_ENABLED', 'true').lower() == 'true'
+    TOOL_CACHE_PERSIST = os.environ.get('TOOL_CACHE_PERSIST', 'true').lower() == 'true'  # false = solo memoria
+    TOOL_CACHE_MEMORY_SIZE = int(os.environ.get('TOOL_CACHE_MEMORY_SIZE', 256))  # Entradas en memoria por fuente
+    TOOL_CACHE_MAX_ENTRIES = int(os.environ.get('TOOL_CACHE_MAX_ENTRIES', 2000))  # Filas en SQLite por fuente
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 3600))  # Segundos que un resultado de búsqueda es fresco
+    SEARCH_CACHE_STALE_TTL = int(os.environ.get('SEARCH_CACHE_STALE_TTL', 3600))  # Se sirve obsoleto mientras se revalida
+    WEATHER_CACHE_TTL = int(os.environ.get('WEATHER_CACHE_TTL', 600))
+    WEATHER_CACHE_STALE_TTL = int(os.environ.get('WEATHER_CACHE_STALE_TTL', 600))
+
+    # Clasificación de intención: gazetteer de ciudades y clasificador local opcional
+    # Ej: INTENT_CITIES='Riobamba=riobamba,Puerto Ayora=puerto ayora|galapagos|galápagos'
+    INTENT_CITIES = {
+        ciudad.split('=')[0].strip(): [alias.strip().lower() for alias in ciudad.split('=')[1].split('|')]
+        for ciudad in os.environ.get('INTENT_CITIES', '').split(',') if '=' in ciudad
+    }
+    INTENT_DEFAULT_CITY = os.environ.get('INTENT_DEFAULT_CITY', 'Quito')  # Si la pregunta no nombra ninguna
+    INTENT_MODEL_PATH = os.environ.get('INTENT_MODEL_PATH', '')  # JSON {etiqueta: [ejemplos]}; vacío = solo reglas
+    INTENT_MODEL_THRESHOLD = float(os.environ.get('INTENT_MODEL_THRESHOLD', 0.6))  # Similitud mínima del modelo local
+    
+    # Streaming del agente: intervalo del keep-alive SSE (también detecta clientes desconectados)
+    AGENT_STREAM_HEARTBEAT = float(os.environ.get('AGENT_STREAM_HEARTBEAT', 5))
+
+    # Plazo por petición: llega a cadenas, agente, herramientas y llamadas HTTP a los backends.
+    # El cliente puede pedir uno menor con 'plazo' (segundos) en el cuerpo de la petición.
+    REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 1800))
+    
+    # HTTP settings (pool de conexiones compartido para LM Studio, Ollama y APIs web)
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 10))  # Número de hosts con pool propio
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 20))  # Conexiones keep-alive por host
+    HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))  # Reintentos de conexión (solo GET)
+    HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.3))
+    HTTP_ASYNC_MAX_CONNECTIONS = int(os.environ.get('HTTP_ASYNC_MAX_CONNECTIONS', 200))  # Conexiones totales del cliente asíncrono
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))  # Hilos para las rutas que asgi.py delega a Flask
+    
     @staticmethod
     def validate_ollama():
         """Validar que Ollama esté disponible"""
-        import requests
+        from http_client import http_get
         try:
-            response = requests.get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=5)
+            response = http_get(f"{Config.OLLAMA_BASE_URL}/api/tags", timeout=5)
             if response.status_code == 200:
                 models = response.json().get('models', [])
                 llama_available = any('llama3' in model.get('name', '') for model in models)
@@ -55,10 +207,10 @@ class Config:
     @staticmethod
     def validate_lmstudio():
         """Validar que LM Studio esté disponible"""
-        import requests
+        from http_client import http_get
         try:
             # Intentar conectar a la API de LM Studio
-            response = requests.get(f"{Config.LMSTUDIO_BASE_URL}/v1/models", timeout=5)
+            response = http_get(f"{Config.LMSTUDIO_BASE_URL}/v1/models", timeout=5)
             return response.status_code == 200
         except Exception as e:
             return False
@@ -0,0 +1,278 @@
+# Capa de persistencia SQLite compartida (historial, cachés)
+import atexit
+import contextlib
+import queue
+import sqlite3
+import threading
+from typing import Callable, Iterator, List, Optional
+from config import Config
+
+# Una conexión por hilo: sqlite3 no permite compartir conexiones entre hilos sin bloqueo externo
+_local = threading.local()
+
+def crear_conexion(db_path: Optional[str] = None) -> sqlite3.Connection:
+    """Abre una conexión con WAL y los pragmas de rendimiento configurados"""
+    conn = sqlite3.connect(db_path or Config.DATABASE_PATH, timeout=Config.DATABASE_BUSY_TIMEOUT / 1000)
+    # WAL permite lectores concurrentes mientras hay un escritor activo
+    conn.execute('PRAGMA journal_mode=WAL')
+    # NORMAL en WAL solo hace fsync en los checkpoints, no en cada commit
+    conn.execute(f'PRAGMA synchronous={Config.DATABASE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout={Config.DATABASE_BUSY_TIMEOUT}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Obtiene la conexión del hilo actual (se crea una única vez por hilo)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = crear_conexion()
+        _local.conn = conn
+    return conn
+
+def cerrar_conexion():
+    """Cierra la conexión del hilo actual"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextlib.contextmanager
+def transaccion() -> Iterator[sqlite3.Connection]:
+    """Ejecuta un bloque en una transacción: commit al salir, rollback si hay error"""
+    conn = get_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# ================================
+# MIGRACIONES DEL ESQUEMA
+# ================================
+
+# Cada migración se aplica una sola vez; la versión actual se guarda en PRAGMA user_version.
+# Las nuevas migraciones se añaden siempre al final con el siguiente número de versión.
+MIGRACIONES = [
+    (1, 'Tablas de conversaciones y sesiones', [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            user_message TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            reasoning_content TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            metadata TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            title TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_activity DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+    (2, 'Índices para historial por sesión y sesiones recientes', [
+        'CREATE INDEX IF NOT EXISTS idx_conversations_session_timestamp ON conversations(session_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions(last_activity)'
+    ]),
+    (3, 'Índice de sesiones con desempate por session_id (paginación por cursor)', [
+        'DROP INDEX IF EXISTS idx_sessions_last_activity',
+        'CREATE INDEX idx_sessions_last_activity ON sessions(last_activity, session_id)'
+    ]),
+    (4, 'Búsqueda de texto completo (FTS5) sobre el historial', [
+        # Tabla FTS de contenido externo: indexa conversations sin duplicar el texto
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            user_message, ai_response, reasoning_content,
+            content='conversations', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        # Triggers que mantienen el índice sincronizado con conversations
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts(rowid, user_message, ai_response, reasoning_content)
+            VALUES (new.id, new.user_message, new.ai_response, new.reasoning_content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, user_message, ai_response, reasoning_content)
+            VALUES ('delete', old.id, old.user_message, old.ai_response, old.reasoning_content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, user_message, ai_response, reasoning_content)
+            VALUES ('delete', old.id, old.user_message, old.ai_response, old.reasoning_content);
+            INSERT INTO conversations_fts(rowid, user_message, ai_response, reasoning_content)
+            VALUES (new.id, new.user_message, new.ai_response, new.reasoning_content);
+        END
+        ''',
+        # Indexar las conversaciones que ya existían
+        "INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')"
+    ]),
+    (5, 'Resúmenes cacheados de la memoria de conversación', [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            session_id TEXT PRIMARY KEY,
+            limite_id INTEGER NOT NULL,
+            resumen TEXT NOT NULL,
+            actualizado DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+]
+
+# Columnas que se pueden pedir al historial (proyección de campos)
+CAMPOS_CONVERSACION = ('id', 'user_message', 'ai_response', 'model_used', 'reasoning_content', 'timestamp', 'metadata')
+
+# Consultas principales del historial (las usan los endpoints y las pruebas de planes de consulta).
+# La paginación es por cursor (keyset) sobre (timestamp, id) / (last_activity, session_id), de modo
+# que cada página cuesta lo mismo sin importar cuántas filas haya antes.
+def sql_historial_sesion(campos=CAMPOS_CONVERSACION, con_cursor: bool = False) -> str:
+    """SELECT del historial de una sesión, del más reciente al más antiguo"""
+    columnas = ', '.join(c for c in campos if c in CAMPOS_CONVERSACION)
+    filtro_cursor = 'AND (timestamp, id) < (?, ?)' if con_cursor else ''
+    return f'''
+    SELECT {columnas}
+    FROM conversations 
+    WHERE session_id = ? {filtro_cursor}
+    ORDER BY timestamp DESC, id DESC 
+    LIMIT ?
+'''
+
+def sql_sesiones_recientes(con_cursor: bool = False) -> str:
+    """SELECT de las sesiones, de la más activa recientemente a la menos"""
+    filtro_cursor = 'WHERE (last_activity, session_id) < (?, ?)' if con_cursor else ''
+    return f'''
+    SELECT session_id, title, created_at, last_activity
+    FROM sessions {filtro_cursor}
+    ORDER BY last_activity DESC, session_id DESC 
+    LIMIT ?
+'''
+
+def sql_busqueda_historial(filtrar_modelo: bool = False, filtrar_desde: bool = False, filtrar_hasta: bool = False) -> str:
+    """Búsqueda FTS5 ordenada por relevancia (bm25) con fragmentos resaltados"""
+    filtros = ''.join([
+        ' AND c.model_used = ?' if filtrar_modelo else '',
+        ' AND c.timestamp >= ?' if filtrar_desde else '',
+        ' AND c.timestamp <= ?' if filtrar_hasta else ''
+    ])
+    return f'''
+    SELECT c.id, c.session_id, c.model_used, c.timestamp,
+           snippet(conversations_fts, 0, '<mark>', '</mark>', '…', 16),
+           snippet(conversations_fts, 1, '<mark>', '</mark>', '…', 24),
+           snippet(conversations_fts, 2, '<mark>', '</mark>', '…', 16),
+           conversations_fts.rank
+    FROM conversations_fts
+    JOIN conversations c ON c.id = conversations_fts.rowid
+    WHERE conversations_fts MATCH ?{filtros}
+    ORDER BY conversations_fts.rank
+    LIMIT ? OFFSET ?
+'''
+
+# Memoria de conversación: resumen guardado (cubre los turnos con id < limite_id) y turnos por rango
+SQL_RESUMEN_SESION = 'SELECT limite_id, resumen FROM conversation_summaries WHERE session_id = ?'
+
+SQL_TURNOS_RANGO = '''
+    SELECT id, user_message, ai_response
+    FROM conversations
+    WHERE session_id = ? AND id >= ? AND id < ?
+    ORDER BY id
+'''
+
+SQL_GUARDAR_RESUMEN = '''
+    INSERT OR REPLACE INTO conversation_summaries (session_id, limite_id, resumen, actualizado)
+    VALUES (?, ?, ?, ?)
+'''
+
+SQL_HISTORIAL_SESION = sql_historial_sesion()
+SQL_SESIONES_RECIENTES = sql_sesiones_recientes()
+
+def version_esquema(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def aplicar_migraciones(conn: sqlite3.Connection) -> int:
+    """Aplica en orden las migraciones pendientes y devuelve la versión final del esquema"""
+    version_actual = version_esquema(conn)
+    for version, descripcion, sentencias in MIGRACIONES:
+        if version <= version_actual:
+            continue
+        try:
+            # BEGIN explícito: sqlite3 no abre transacción para DDL y la migración debe ser atómica
+            if not conn.in_transaction:
+                conn.execute('BEGIN')
+            for sentencia in sentencias:
+                conn.execute(sentencia)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"🗄️ Migración {version} aplicada: {descripcion}")
+        version_actual = version
+    return version_actual
+
+class EscritorEnLotes:
+    """Hilo de fondo que agrupa escrituras en una única transacción.
+
+    Las peticiones solo encolan la fila; el hilo espera hasta `intervalo` segundos para reunir
+    hasta `max_lote` filas y las escribe juntas, de modo que el fsync no bloquea la respuesta.
+    """
+
+    def __init__(self, nombre: str, escribir_lote: Callable[[sqlite3.Connection, List], None],
+                 max_lote: int, intervalo: float):
+        self.nombre = nombre
+        self.escribir_lote = escribir_lote
+        self.max_lote = max_lote
+        self.intervalo = intervalo
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._bucle, name=f'escritor-{nombre}', daemon=True)
+        self._hilo.start()
+
+    def encolar(self, fila):
+        self._cola.put(fila)
+
+    def pendientes(self) -> int:
+        return self._cola.qsize()
+
+    def _bucle(self):
+        while True:
+            lote = [self._cola.get()]
+            try:
+                while len(lote) < self.max_lote:
+                    lote.append(self._cola.get(timeout=self.intervalo))
+            except queue.Empty:
+                pass
+
+            try:
+                with transaccion() as conn:
+                    self.escribir_lote(conn, lote)
+            except Exception as e:
+                print(f"⚠️ Error escribiendo lote de {self.nombre} ({len(lote)} filas): {e}")
+            finally:
+                for _ in lote:
+                    self._cola.task_done()
+
+    def vaciar(self):
+        """Bloquea hasta que todas las filas encoladas se hayan escrito"""
+        self._cola.join()
+
+_escritores = []
+
+def crear_escritor(nombre: str, escribir_lote: Callable[[sqlite3.Connection, List], None]) -> EscritorEnLotes:
+    """Crea un escritor en lotes con la configuración global y lo vacía al salir del proceso"""
+    escritor = EscritorEnLotes(nombre, escribir_lote, Config.DATABASE_BATCH_SIZE, Config.DATABASE_BATCH_INTERVAL)
+    _escritores.append(escritor)
+    return escritor
+
+@atexit.register
+def vaciar_escritores():
+    for escritor in _escritores:
+        escritor.vaciar()
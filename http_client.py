@@ -0,0 +1,639 @@
+# Capa de transporte HTTP compartida para todas las llamadas a backends
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import socket
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Callable, Dict, Optional
+from urllib.parse import urlsplit
+import httpx
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import Config
+
+_session = None
+_session_lock = threading.Lock()
+
+# httpx.AsyncClient está ligado a un event loop: se mantiene un cliente por loop
+_async_clients = weakref.WeakKeyDictionary()
+
+def crear_sesion() -> requests.Session:
+    """Crea una sesión HTTP con pool de conexiones keep-alive por host y reintentos"""
+    # Solo se reintentan métodos idempotentes: un POST de generación no debe repetirse
+    retry = Retry(
+        total=Config.HTTP_MAX_RETRIES,
+        connect=Config.HTTP_MAX_RETRIES,
+        read=0,
+        backoff_factor=Config.HTTP_BACKOFF_FACTOR,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=Config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+def get_session() -> requests.Session:
+    """Obtiene la sesión HTTP compartida (se crea una única vez)"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = crear_sesion()
+    return _session
+
+# ================================
+# CANCELACIÓN Y PLAZOS POR PETICIÓN
+# ================================
+
+class PeticionCanceladaError(Exception):
+    """La petición del cliente se canceló (desconexión o cancelación explícita) o agotó su plazo"""
+    
+    PLAZO_AGOTADO = 'plazo agotado'
+    
+    def __init__(self, motivo: str):
+        super().__init__(f"Petición cancelada: {motivo}")
+        self.motivo = motivo
+    
+    @property
+    def por_plazo(self) -> bool:
+        return self.motivo == self.PLAZO_AGOTADO
+
+class TokenCancelacion:
+    """Plazo y cancelación de una petición del cliente.
+    
+    Viaja en un contextvar (ver con_cancelacion), así llega a cadenas, agente, herramientas y hilos
+    que copian el contexto. Las llamadas HTTP hechas con el token activo acotan su timeout al tiempo
+    restante, y al cancelarlo se ejecutan los callbacks registrados (p. ej. cerrar la conexión de un
+    stream en curso) para que el backend deje de generar.
+    """
+    
+    def __init__(self, plazo: Optional[float] = None):
+        self.limite = time.monotonic() + plazo if plazo else None
+        self._motivo: Optional[str] = None
+        self._callbacks: Dict[int, Callable[[], None]] = {}
+        self._siguiente = 0
+        self._lock = threading.Lock()
+    
+    def restante(self) -> Optional[float]:
+        """Segundos hasta el plazo (None si no tiene)"""
+        return None if self.limite is None else self.limite - time.monotonic()
+    
+    @property
+    def motivo(self) -> Optional[str]:
+        if self._motivo is None and self.limite is not None and time.monotonic() >= self.limite:
+            return PeticionCanceladaError.PLAZO_AGOTADO
+        return self._motivo
+    
+    @property
+    def cancelado(self) -> bool:
+        return self.motivo is not None
+    
+    def comprobar(self):
+        """Lanza PeticionCanceladaError si la petición se canceló o agotó su plazo"""
+        motivo = self.motivo
+        if motivo is not None:
+            raise PeticionCanceladaError(motivo)
+    
+    def cancelar(self, motivo: str = 'cancelada por el cliente') -> bool:
+        """Cancela la petición y ejecuta los callbacks; devuelve False si ya estaba cancelada"""
+        with self._lock:
+            if self._motivo is not None:
+                return False
+            self._motivo = motivo
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Error al cancelar la petición: {e}")
+        return True
+    
+    def al_cancelar(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Registra un callback para cuando se cancele; devuelve la función que lo quita.
+        
+        Si ya estaba cancelada, el callback se ejecuta al momento.
+        """
+        with self._lock:
+            if self._motivo is None:
+                clave = self._siguiente
+                self._siguiente += 1
+                self._callbacks[clave] = callback
+                return lambda: self._quitar(clave)
+        callback()
+        return lambda: None
+    
+    def _quitar(self, clave: int):
+        with self._lock:
+            self._callbacks.pop(clave, None)
+    
+    def acotar(self, segundos: Optional[float]) -> Optional[float]:
+        """El menor entre `segundos` y el tiempo restante (los clientes HTTP no admiten timeouts de 0)"""
+        restante = self.restante()
+        if restante is None:
+            return segundos
+        restante = max(restante, 0.001)
+        return restante if segundos is None else min(segundos, restante)
+    
+    def acotar_timeout(self, timeout):
+        """Acota al tiempo restante un timeout de requests (número o tupla) o de httpx"""
+        if self.limite is None:
+            return timeout
+        if isinstance(timeout, httpx.Timeout):
+            return httpx.Timeout(connect=self.acotar(timeout.connect), read=self.acotar(timeout.read),
+                                 write=self.acotar(timeout.write), pool=self.acotar(timeout.pool))
+        if isinstance(timeout, tuple):
+            return tuple(self.acotar(t) for t in timeout)
+        return self.acotar(timeout)
+
+_token_actual: contextvars.ContextVar[Optional[TokenCancelacion]] = contextvars.ContextVar('token_cancelacion', default=None)
+
+def token_actual() -> Optional[TokenCancelacion]:
+    """Token de cancelación de la petición en curso (None fuera de una petición)"""
+    return _token_actual.get()
+
+def activar_cancelacion(token: Optional[TokenCancelacion]) -> contextvars.Token:
+    """Activa el token en el contexto actual; devuelve el valor para restaurarlo con desactivar_cancelacion"""
+    return _token_actual.set(token)
+
+def desactivar_cancelacion(anterior: contextvars.Token):
+    _token_actual.reset(anterior)
+
+@contextlib.contextmanager
+def con_cancelacion(token: Optional[TokenCancelacion]):
+    """Bloque en el que `token` es el token de cancelación de la petición en curso"""
+    anterior = activar_cancelacion(token)
+    try:
+        yield token
+    finally:
+        desactivar_cancelacion(anterior)
+
+def comprobar_cancelacion():
+    """Lanza PeticionCanceladaError si la petición en curso se canceló o agotó su plazo"""
+    token = token_actual()
+    if token is not None:
+        token.comprobar()
+
+def al_cancelar_peticion(callback: Callable[[], None]) -> Callable[[], None]:
+    """Registra `callback` en el token de la petición en curso (sin token no hace nada)"""
+    token = token_actual()
+    return token.al_cancelar(callback) if token is not None else (lambda: None)
+
+def esperar_resultado(futuro: concurrent.futures.Future):
+    """Resultado de `futuro` (una carga compartida con otra petición) sin esperar más allá del plazo
+    de la petición en curso ni de su cancelación; en ese caso lanza PeticionCanceladaError"""
+    token = token_actual()
+    if token is None:
+        return futuro.result()
+    listo = threading.Event()
+    futuro.add_done_callback(lambda _: listo.set())
+    quitar = token.al_cancelar(listo.set)
+    try:
+        listo.wait(token.restante())
+    finally:
+        quitar()
+    if not futuro.done():
+        token.comprobar()
+        raise PeticionCanceladaError(PeticionCanceladaError.PLAZO_AGOTADO)
+    return futuro.result()
+
+async def esperar_resultado_async(futuro: concurrent.futures.Future):
+    """Versión asíncrona de esperar_resultado; abandonar la espera no cancela `futuro`"""
+    token = token_actual()
+    if token is None:
+        return await asyncio.wrap_future(futuro)
+    bucle = asyncio.get_running_loop()
+    listo = asyncio.Event()
+
+    def despertar(*_):
+        with contextlib.suppress(RuntimeError):  # event loop ya cerrado
+            bucle.call_soon_threadsafe(listo.set)
+
+    futuro.add_done_callback(despertar)
+    quitar = token.al_cancelar(despertar)
+    try:
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(listo.wait(), token.restante())
+    finally:
+        quitar()
+    if not futuro.done():
+        token.comprobar()
+        raise PeticionCanceladaError(PeticionCanceladaError.PLAZO_AGOTADO)
+    return futuro.result()
+
+def abortar_respuesta(response: requests.Response):
+    """Corta la conexión de una respuesta en streaming, aunque otro hilo esté bloqueado leyéndola.
+    
+    shutdown() despierta al lector (que recibe fin de datos) y el servidor ve la desconexión y
+    deja de generar; quien lee cierra la respuesta como siempre.
+    """
+    conexion = getattr(response.raw, 'connection', None)
+    sock = getattr(conexion, 'sock', None)
+    if sock is None:
+        return
+    with contextlib.suppress(OSError):
+        sock.shutdown(socket.SHUT_RDWR)
+
+def _error_si_cancelada(error: BaseException) -> BaseException:
+    """Si el fallo se debe a la cancelación (timeout acotado al plazo, conexión cortada), lo traduce"""
+    token = token_actual()
+    if token is not None and token.cancelado:
+        cancelacion = PeticionCanceladaError(token.motivo)
+        cancelacion.__cause__ = error
+        return cancelacion
+    return error
+
+# ================================
+# CIRCUIT BREAKERS Y TIMEOUTS ADAPTATIVOS
+# ================================
+
+class CircuitoAbiertoError(Exception):
+    """El endpoint ha fallado repetidamente y se rechaza la llamada sin esperar al timeout"""
+    
+    def __init__(self, circuito: str, reintentar_en: float):
+        super().__init__(f"Circuito '{circuito}' abierto: el endpoint no responde (reintento en {reintentar_en:.0f}s)")
+        self.circuito = circuito
+        self.reintentar_en = reintentar_en
+
+class StreamIncompletoError(Exception):
+    """El servidor cerró un stream antes de terminar la respuesta (cuenta como fallo del endpoint)"""
+
+class Circuito:
+    """Circuit breaker de un endpoint (cerrado → abierto → semiabierto) con timeout adaptativo.
+    
+    Tras CIRCUIT_FAILURE_THRESHOLD fallos seguidos (conexión, timeout o HTTP 5xx) el circuito se abre
+    y las llamadas fallan al instante. Pasada la espera deja pasar una única llamada de prueba: si
+    funciona se cierra, si falla se vuelve a abrir con el doble de espera (hasta CIRCUIT_MAX_RESET_TIMEOUT).
+    
+    El timeout de cada llamada es p95 de las latencias recientes × CIRCUIT_TIMEOUT_FACTOR, acotado
+    entre el mínimo del endpoint y el timeout que pide quien llama (que actúa de tope).
+    """
+    
+    CERRADO, ABIERTO, SEMIABIERTO = 'cerrado', 'abierto', 'semiabierto'
+    
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self.estado = self.CERRADO
+        self.fallos_seguidos = 0
+        self.abierto_desde = 0.0
+        self.espera = Config.CIRCUIT_RESET_TIMEOUT
+        self.latencias = deque(maxlen=Config.CIRCUIT_WINDOW)
+        self.ultimo_error = None
+        self.estadisticas = {'exitos': 0, 'fallos': 0, 'rechazadas': 0, 'aperturas': 0}
+        self._sonda_en_curso = False
+        self._lock = threading.Lock()
+    
+    def disponible(self) -> bool:
+        """Indica si una llamada tendría paso ahora (sin reservar la llamada de prueba)"""
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return True
+            if self.estado == self.ABIERTO:
+                return time.time() - self.abierto_desde >= self.espera
+            return not self._sonda_en_curso
+    
+    def permitir(self):
+        """Deja pasar la llamada o lanza CircuitoAbiertoError"""
+        with self._lock:
+            if self.estado == self.CERRADO:
+                return
+            if self.estado == self.ABIERTO:
+                restante = self.espera - (time.time() - self.abierto_desde)
+                if restante > 0:
+                    self.estadisticas['rechazadas'] += 1
+                    raise CircuitoAbiertoError(self.nombre, restante)
+                self.estado = self.SEMIABIERTO
+                print(f"🔌 Circuito '{self.nombre}' semiabierto: probando el endpoint")
+            if self._sonda_en_curso:
+                self.estadisticas['rechazadas'] += 1
+                raise CircuitoAbiertoError(self.nombre, self.espera)
+            self._sonda_en_curso = True
+    
+    def exito(self, latencia: Optional[float] = None):
+        with self._lock:
+            self.estadisticas['exitos'] += 1
+            if latencia is not None:
+                self.latencias.append(latencia)
+            self.fallos_seguidos = 0
+            self._sonda_en_curso = False
+            if self.estado != self.CERRADO:
+                print(f"🔌 Circuito '{self.nombre}' cerrado: el endpoint vuelve a responder")
+                self.estado = self.CERRADO
+                self.espera = Config.CIRCUIT_RESET_TIMEOUT
+    
+    def fallo(self, error=None):
+        with self._lock:
+            self.estadisticas['fallos'] += 1
+            self.fallos_seguidos += 1
+            self.ultimo_error = str(error)[:200] if error is not None else None
+            self._sonda_en_curso = False
+            if self.estado == self.SEMIABIERTO:
+                self.espera = min(self.espera * 2, Config.CIRCUIT_MAX_RESET_TIMEOUT)
+            elif self.estado == self.ABIERTO or self.fallos_seguidos < Config.CIRCUIT_FAILURE_THRESHOLD:
+                return
+            self.estado = self.ABIERTO
+            self.abierto_desde = time.time()
+            self.estadisticas['aperturas'] += 1
+            print(f"🔌 Circuito '{self.nombre}' abierto durante {self.espera:.0f}s: {self.ultimo_error}")
+    
+    def liberar(self):
+        """Termina una llamada sin veredicto (error ajeno al endpoint o cancelación)"""
+        with self._lock:
+            self._sonda_en_curso = False
+    
+    @contextlib.contextmanager
+    def proteger(self):
+        """Protege un bloque arbitrario: cualquier excepción cuenta como fallo del endpoint"""
+        self.permitir()
+        inicio = time.time()
+        try:
+            yield
+        except PeticionCanceladaError:
+            # Abandonada por el cliente: no dice nada de la salud del endpoint
+            self.liberar()
+            raise
+        except Exception as e:
+            self.fallo(e)
+            raise
+        except BaseException:
+            self.liberar()
+            raise
+        self.exito(time.time() - inicio)
+    
+    def timeout_adaptativo(self, tope: float, minimo: Optional[float] = None) -> float:
+        with self._lock:
+            if len(self.latencias) < Config.CIRCUIT_MIN_SAMPLES:
+                return tope
+            p95 = float(np.percentile(self.latencias, 95))
+        return min(tope, max(minimo or Config.CIRCUIT_MIN_TIMEOUT, p95 * Config.CIRCUIT_TIMEOUT_FACTOR))
+    
+    def ajustar_timeout(self, timeout, minimo: Optional[float] = None):
+        """Aplica el timeout adaptativo a la lectura; el de conexión se respeta"""
+        if timeout is None or not Config.CIRCUIT_ADAPTIVE_TIMEOUTS:
+            return timeout
+        if isinstance(timeout, httpx.Timeout):
+            if timeout.read is None:
+                return timeout
+            return httpx.Timeout(self.timeout_adaptativo(timeout.read, minimo), connect=timeout.connect)
+        if isinstance(timeout, tuple):
+            conexion, lectura = timeout
+            return (conexion, self.timeout_adaptativo(lectura, minimo))
+        return self.timeout_adaptativo(timeout, minimo)
+    
+    def resumen(self) -> Dict:
+        with self._lock:
+            latencias = list(self.latencias)
+            restante = self.espera - (time.time() - self.abierto_desde) if self.estado == self.ABIERTO else 0.0
+            datos = {
+                'estado': self.estado,
+                'fallos_seguidos': self.fallos_seguidos,
+                'reintentar_en': round(max(restante, 0.0), 1),
+                'ultimo_error': self.ultimo_error,
+                **self.estadisticas
+            }
+        datos['p50'] = round(float(np.percentile(latencias, 50)), 3) if latencias else None
+        datos['p95'] = round(float(np.percentile(latencias, 95)), 3) if latencias else None
+        # Timeout adaptativo antes de aplicar el tope/mínimo de cada llamada (None: aún sin muestras suficientes)
+        datos['timeout_adaptativo'] = (round(datos['p95'] * Config.CIRCUIT_TIMEOUT_FACTOR, 3)
+                                       if len(latencias) >= Config.CIRCUIT_MIN_SAMPLES else None)
+        return datos
+
+_circuitos: Dict[str, Circuito] = {}
+_circuitos_lock = threading.Lock()
+
+def obtener_circuito(nombre: str) -> Circuito:
+    """Circuito de un endpoint (se crea en su primer uso)"""
+    circuito = _circuitos.get(nombre)
+    if circuito is None:
+        with _circuitos_lock:
+            circuito = _circuitos.setdefault(nombre, Circuito(nombre))
+    return circuito
+
+def estado_circuitos() -> Dict[str, Dict]:
+    return {nombre: circuito.resumen() for nombre, circuito in list(_circuitos.items())}
+
+def _circuito_para(url: str, circuito: Optional[str]) -> Optional[Circuito]:
+    if not Config.CIRCUIT_ENABLED:
+        return None
+    # Por defecto un circuito por host (wttr.in, api.duckduckgo.com, localhost:11434...)
+    return obtener_circuito(circuito or urlsplit(url).netloc)
+
+def _acotar_a_peticion(kwargs: Dict):
+    """Comprueba la cancelación y acota el timeout al plazo de la petición en curso"""
+    token = token_actual()
+    if token is None:
+        return
+    token.comprobar()
+    if token.limite is not None:
+        kwargs['timeout'] = token.acotar_timeout(kwargs.get('timeout'))
+
+def _peticion(metodo: str, url: str, circuito: Optional[str] = None,
+              timeout_minimo: Optional[float] = None, **kwargs) -> requests.Response:
+    circ = _circuito_para(url, circuito)
+    if circ is None:
+        _acotar_a_peticion(kwargs)
+        try:
+            return get_session().request(metodo, url, **kwargs)
+        except requests.RequestException as e:
+            raise _error_si_cancelada(e)
+    
+    circ.permitir()
+    if 'timeout' in kwargs:
+        kwargs['timeout'] = circ.ajustar_timeout(kwargs['timeout'], timeout_minimo)
+    inicio = time.time()
+    try:
+        _acotar_a_peticion(kwargs)
+        response = get_session().request(metodo, url, **kwargs)
+    except requests.RequestException as e:
+        error = _error_si_cancelada(e)
+        if error is e:
+            circ.fallo(e)
+        else:
+            circ.liberar()
+        raise error
+    except BaseException:
+        circ.liberar()
+        raise
+    
+    if response.status_code >= 500:
+        circ.fallo(f"HTTP {response.status_code}")
+    else:
+        # En streaming solo se mide hasta las cabeceras: no es comparable con una respuesta completa
+        circ.exito(None if kwargs.get('stream') else time.time() - inicio)
+    return response
+
+def _veredicto_stream(circ: Optional[Circuito], error: BaseException):
+    """Juzga un stream que terminó con `error` mientras se leía.
+    
+    Solo los fallos de transporte (conexión cortada, timeout entre trozos, stream incompleto) cuentan
+    contra el endpoint; una cancelación o un error de quien consume el stream liberan la llamada
+    sin veredicto.
+    """
+    if circ is None:
+        return
+    if isinstance(error, (requests.RequestException, httpx.HTTPError, StreamIncompletoError)):
+        circ.fallo(error)
+    else:
+        circ.liberar()
+
+@contextlib.contextmanager
+def http_stream(metodo: str, url: str, circuito: Optional[str] = None,
+                timeout_minimo: Optional[float] = None, **kwargs):
+    """Petición en streaming; la respuesta se cierra al salir del bloque.
+    
+    El circuito juzga la respuesta completa: si el bloque termina sin error registra un éxito con la
+    latencia de todo el stream, y si la lectura se corta a mitad cuenta un fallo.
+    """
+    circ = _circuito_para(url, circuito)
+    if circ is not None:
+        circ.permitir()
+        if 'timeout' in kwargs:
+            kwargs['timeout'] = circ.ajustar_timeout(kwargs['timeout'], timeout_minimo)
+    inicio = time.time()
+    
+    try:
+        _acotar_a_peticion(kwargs)
+        with get_session().request(metodo, url, stream=True, **kwargs) as response:
+            if circ is not None and response.status_code >= 400:
+                # Una respuesta de error llega entera con las cabeceras: se juzga ya
+                if response.status_code >= 500:
+                    circ.fallo(f"HTTP {response.status_code}")
+                else:
+                    circ.exito()
+                circ = None
+            yield response
+        if circ is not None:
+            circ.exito(time.time() - inicio)
+    except requests.RequestException as e:
+        error = _error_si_cancelada(e)
+        _veredicto_stream(circ, e if error is e else error)
+        raise error
+    except BaseException as e:
+        _veredicto_stream(circ, e)
+        raise
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """GET usando el pool de conexiones compartido (con circuit breaker por endpoint)"""
+    return _peticion('GET', url, **kwargs)
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """POST usando el pool de conexiones compartido (con circuit breaker por endpoint)"""
+    return _peticion('POST', url, **kwargs)
+
+def cerrar_sesion():
+    """Cierra la sesión compartida y libera las conexiones del pool"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def get_async_client() -> httpx.AsyncClient:
+    """Obtiene el cliente HTTP asíncrono compartido del event loop actual"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=Config.HTTP_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.HTTP_POOL_MAXSIZE
+            ),
+            # Solo reintenta errores de conexión, nunca una generación ya enviada
+            transport=httpx.AsyncHTTPTransport(retries=Config.HTTP_MAX_RETRIES)
+        )
+        _async_clients[loop] = client
+    return client
+
+async def _peticion_async(metodo: str, url: str, circuito: Optional[str] = None,
+                          timeout_minimo: Optional[float] = None, **kwargs) -> httpx.Response:
+    circ = _circuito_para(url, circuito)
+    if circ is None:
+        _acotar_a_peticion(kwargs)
+        try:
+            return await get_async_client().request(metodo, url, **kwargs)
+        except httpx.HTTPError as e:
+            raise _error_si_cancelada(e)
+    
+    circ.permitir()
+    if 'timeout' in kwargs:
+        kwargs['timeout'] = circ.ajustar_timeout(kwargs['timeout'], timeout_minimo)
+    inicio = time.time()
+    try:
+        _acotar_a_peticion(kwargs)
+        response = await get_async_client().request(metodo, url, **kwargs)
+    except httpx.HTTPError as e:
+        error = _error_si_cancelada(e)
+        if error is e:
+            circ.fallo(e)
+        else:
+            circ.liberar()
+        raise error
+    except BaseException:
+        circ.liberar()
+        raise
+    
+    if response.status_code >= 500:
+        circ.fallo(f"HTTP {response.status_code}")
+    else:
+        circ.exito(time.time() - inicio)
+    return response
+
+async def http_get_async(url: str, **kwargs) -> httpx.Response:
+    """GET asíncrono con el cliente compartido (con circuit breaker por endpoint)"""
+    return await _peticion_async('GET', url, **kwargs)
+
+async def http_post_async(url: str, **kwargs) -> httpx.Response:
+    """POST asíncrono con el cliente compartido (con circuit breaker por endpoint)"""
+    return await _peticion_async('POST', url, **kwargs)
+
+@contextlib.asynccontextmanager
+async def http_stream_async(metodo: str, url: str, circuito: Optional[str] = None,
+                            timeout_minimo: Optional[float] = None, **kwargs):
+    """Versión asíncrona de http_stream (el circuito también juzga la respuesta completa)"""
+    circ = _circuito_para(url, circuito)
+    if circ is not None:
+        circ.permitir()
+        if 'timeout' in kwargs:
+            kwargs['timeout'] = circ.ajustar_timeout(kwargs['timeout'], timeout_minimo)
+    inicio = time.time()
+    
+    try:
+        _acotar_a_peticion(kwargs)
+        async with get_async_client().stream(metodo, url, **kwargs) as response:
+            if circ is not None and response.status_code >= 400:
+                if response.status_code >= 500:
+                    circ.fallo(f"HTTP {response.status_code}")
+                else:
+                    circ.exito()
+                circ = None
+            yield response
+        if circ is not None:
+            circ.exito(time.time() - inicio)
+    except httpx.HTTPError as e:
+        error = _error_si_cancelada(e)
+        _veredicto_stream(circ, e if error is e else error)
+        raise error
+    except BaseException as e:
+        _veredicto_stream(circ, e)
+        raise
+
+async def cerrar_cliente_async():
+    """Cierra el cliente asíncrono del event loop actual"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
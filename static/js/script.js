@@ -21,8 +21,12 @@ let currentThinkingContainer = null;
 let agentExecutionTimer = null;
 let agentStartTime = null;
 
+// Ejecución del agente en streaming en curso: { id, controlador, cancelada }
+let ejecucionAgenteActual = null;
+
 // Función para mostrar razonamiento en tiempo real con información del AgentExecutor
-function mostrarRazonamientoTiempoReal(modeloSeleccionado, pregunta) {
+// (con simulado = false solo se crea el contenedor: los pasos llegan del servidor)
+function mostrarRazonamientoTiempoReal(modeloSeleccionado, pregunta, simulado = true) {
     if (!modeloSeleccionado) return;
     
     // Crear contenedor temporal para el razonamiento
@@ -51,6 +55,11 @@ function mostrarRazonamientoTiempoReal(modeloSeleccionado, pregunta) {
     agentStartTime = new Date();
     razonamientoOculto = false; // Reset del estado
     
+    if (!simulado) {
+        agregarPasoRazonamientoTiempoReal(`🔍 Analizando consulta: "${pregunta}"`, "analisis");
+        return;
+    }
+    
     // Agregar primera fase del agente
     setTimeout(() => {
         agregarPasoRazonamientoTiempoReal("� Iniciando sistema de agentes de IA", "inicio");
@@ -639,7 +648,9 @@ async function handleSubmit(e) {
     // Mostrar razonamiento en tiempo real específico para agentes
     const esAgente = (modo === 'agente' || (!permitirInternet && (modo === 'agente' || modo === 'busqueda_rapida')));
     if (esAgente || permitirInternet) {
-        mostrarRazonamientoTiempoReal(modelo, pregunta);
+        // Con el agente en streaming los pasos reales llegan del servidor
+        const pasosEnVivo = elegirEndpoint(pregunta, modo, permitirInternet) === '/chat/agente/stream';
+        mostrarRazonamientoTiempoReal(modelo, pregunta, !pasosEnVivo);
     }
     
     // Limpiar input y deshabilitar botón
@@ -723,10 +734,8 @@ async function handleSubmit(e) {
     }
 }
 
-// Enviar pregunta a la API
-async function enviarPreguntaAPI(pregunta, modo, modelo, permitirInternet = true) {
-    let endpoint = '/chat';
-    
+// Elegir el endpoint según el tipo de consulta
+function elegirEndpoint(pregunta, modo, permitirInternet = true) {
     // Detección inteligente de tipo de consulta
     const preguntaLower = pregunta.toLowerCase();
     
@@ -734,12 +743,28 @@ async function enviarPreguntaAPI(pregunta, modo, modelo, permitirInternet = true
     if ((preguntaLower.includes('clima') || preguntaLower.includes('weather') || 
          preguntaLower.includes('temperatura') || preguntaLower.includes('temp')) && 
         permitirInternet) {
-        endpoint = '/clima-actual';
-        console.log('🌤️ Detectada consulta de clima, usando endpoint optimizado');
+        return '/clima-actual';
     }
     // Búsquedas rápidas
-    else if (modo === 'busqueda_rapida') {
-        endpoint = '/busqueda-rapida';
+    if (modo === 'busqueda_rapida') {
+        return '/busqueda-rapida';
+    }
+    // Chat simple -> streaming de tokens; agente -> streaming de pasos
+    if (modo === 'simple' || !permitirInternet) {
+        return '/chat/stream';
+    }
+    if (modo === 'agente') {
+        return '/chat/agente/stream';
+    }
+    return '/chat';
+}
+
+// Enviar pregunta a la API
+async function enviarPreguntaAPI(pregunta, modo, modelo, permitirInternet = true) {
+    const endpoint = elegirEndpoint(pregunta, modo, permitirInternet);
+    
+    if (endpoint === '/clima-actual') {
+        console.log('🌤️ Detectada consulta de clima, usando endpoint optimizado');
     }
     
     // Forzar modo simple si internet está deshabilitado
@@ -747,6 +772,18 @@ async function enviarPreguntaAPI(pregunta, modo, modelo, permitirInternet = true
         modo = 'simple';
     }
     
+    if (endpoint === '/chat/stream') {
+        return await enviarPreguntaStream(pregunta, modo, modelo, permitirInternet);
+    }
+    if (endpoint === '/chat/agente/stream') {
+        return await enviarPreguntaAgenteStream(pregunta, modo, modelo, permitirInternet);
+    }
+    
+    return await enviarPreguntaJSON(endpoint, pregunta, modo, modelo, permitirInternet);
+}
+
+// Enviar pregunta a un endpoint que responde con un único JSON
+async function enviarPreguntaJSON(endpoint, pregunta, modo, modelo, permitirInternet = true) {
     const response = await fetch(endpoint, {
         method: 'POST',
         headers: {
@@ -767,6 +804,246 @@ async function enviarPreguntaAPI(pregunta, modo, modelo, permitirInternet = true
     return await response.json();
 }
 
+// Leer una respuesta Server-Sent Events y entregar cada evento como (evento, payload)
+async function leerEventosSSE(response, alEvento) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    
+    const procesarBloque = (bloque) => {
+        let evento = 'message';
+        let datos = '';
+        bloque.split('\n').forEach(linea => {
+            if (linea.startsWith('event:')) {
+                evento = linea.slice(6).trim();
+            } else if (linea.startsWith('data:')) {
+                datos += linea.slice(5).trim();
+            }
+        });
+        // Los comentarios (': ping') no traen datos
+        if (!datos) return;
+        alEvento(evento, JSON.parse(datos));
+    };
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let separador;
+        while ((separador = buffer.indexOf('\n\n')) !== -1) {
+            procesarBloque(buffer.slice(0, separador));
+            buffer = buffer.slice(separador + 2);
+        }
+    }
+}
+
+// Mensaje provisional que muestra el texto a medida que llegan los tokens, ocultando el modal de carga
+function crearMensajeParcial() {
+    let mensajeParcial = null;
+    let textoParcial = '';
+    
+    return {
+        agregar(contenido) {
+            if (!mensajeParcial) {
+                clearInterval(loadingTimer);
+                loadingModal.hide();
+                mensajeParcial = document.createElement('div');
+                mensajeParcial.className = 'mensaje-ia mensaje-streaming';
+                mensajeParcial.innerHTML = '<i class="fas fa-robot me-2"></i><span class="texto-streaming"></span>';
+                chatBody.appendChild(mensajeParcial);
+            }
+            textoParcial += contenido;
+            mensajeParcial.querySelector('.texto-streaming').textContent = textoParcial;
+            chatBody.scrollTop = chatBody.scrollHeight;
+        },
+        // El mensaje definitivo se agrega con agregarMensaje()
+        quitar() {
+            if (mensajeParcial) {
+                mensajeParcial.remove();
+            }
+        }
+    };
+}
+
+// Enviar pregunta usando el endpoint de streaming (Server-Sent Events sobre POST)
+async function enviarPreguntaStream(pregunta, modo, modelo, permitirInternet = true) {
+    const response = await fetch('/chat/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            pregunta: pregunta,
+            modo: modo,
+            modelo: modelo,
+            permitir_internet: permitirInternet
+        })
+    });
+    
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    
+    let resultado = null;
+    const parcial = crearMensajeParcial();
+    
+    try {
+        await leerEventosSSE(response, (evento, payload) => {
+            if (evento === 'token') {
+                parcial.agregar(payload.contenido);
+            } else if (evento === 'reasoning') {
+                updateLoadingProgress(50, '🧠 El modelo está razonando...');
+            } else if (evento === 'fin' || evento === 'completo') {
+                resultado = payload;
+            } else if (evento === 'error') {
+                if (payload.respuesta_fallback) {
+                    resultado = {
+                        respuesta: payload.respuesta_fallback,
+                        modo: 'timeout_fallback',
+                        modelo_usado: modelo,
+                        metadata: { error: 'timeout' }
+                    };
+                } else {
+                    throw new Error(payload.error || 'Error en streaming');
+                }
+            }
+        });
+    } finally {
+        parcial.quitar();
+    }
+    
+    if (!resultado) {
+        throw new Error('La conexión de streaming terminó sin respuesta');
+    }
+    
+    return resultado;
+}
+
+// Enviar pregunta al agente mostrando sus pasos reales a medida que ocurren (cancelable)
+async function enviarPreguntaAgenteStream(pregunta, modo, modelo, permitirInternet = true) {
+    const controlador = new AbortController();
+    ejecucionAgenteActual = { id: null, controlador: controlador, cancelada: false };
+    
+    let resultado = null;
+    const parcial = crearMensajeParcial();
+    const respuestaCancelada = (payload = {}) => ({
+        respuesta: '⏹️ Ejecución del agente cancelada por el usuario.',
+        modo: 'agente',
+        modelo_usado: modelo,
+        pasos_intermedios: payload.pasos_intermedios || [],
+        metadata: { ...(payload.metadata || {}), cancelado: true }
+    });
+    
+    try {
+        const response = await fetch('/chat/agente/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                pregunta: pregunta,
+                modo: modo,
+                modelo: modelo,
+                permitir_internet: permitirInternet
+            }),
+            signal: controlador.signal
+        });
+        
+        // Sin agente para el modelo: el /chat clásico decide el fallback
+        if (!response.ok) {
+            return await enviarPreguntaJSON('/chat', pregunta, modo, modelo, permitirInternet);
+        }
+        
+        mostrarBotonCancelar(true);
+        await leerEventosSSE(response, (evento, payload) => {
+            switch (evento) {
+                case 'inicio':
+                    ejecucionAgenteActual.id = payload.ejecucion_id;
+                    updateLoadingProgress(10, `⚡ Agente ${payload.modelo} en marcha...`);
+                    agregarPasoRazonamientoTiempoReal("⚡ > Entering new AgentExecutor chain...", "agente");
+                    break;
+                case 'paso':
+                    updateLoadingProgress(Math.min(20 + payload.step * 15, 85), `🔧 Paso ${payload.step}: ${payload.action}`);
+                    agregarPasoRazonamientoTiempoReal(`🔧 Action: ${payload.action}`, "accion");
+                    agregarPasoRazonamientoTiempoReal(`Action Input: ${escaparHTML(String(payload.action_input))}`, "input");
+                    break;
+                case 'observacion':
+                    agregarPasoRazonamientoTiempoReal(
+                        `📄 Observation (${payload.duracion}s): ${escaparHTML(payload.observation)}`, "resultado"
+                    );
+                    break;
+                case 'pensamiento':
+                    agregarPasoRazonamientoTiempoReal(escaparHTML(payload.texto), "pensamiento");
+                    break;
+                case 'token':
+                    parcial.agregar(payload.contenido);
+                    break;
+                case 'fin':
+                    resultado = payload;
+                    break;
+                case 'cancelado':
+                    resultado = respuestaCancelada(payload);
+                    break;
+                case 'error':
+                    throw new Error(payload.error || 'Error en el agente');
+            }
+        });
+    } catch (error) {
+        // Cancelado antes de recibir el ejecucion_id: se abortó la conexión
+        if (error.name === 'AbortError' && ejecucionAgenteActual && ejecucionAgenteActual.cancelada) {
+            resultado = respuestaCancelada();
+        } else {
+            throw error;
+        }
+    } finally {
+        parcial.quitar();
+        ejecucionAgenteActual = null;
+        mostrarBotonCancelar(false);
+    }
+    
+    if (!resultado) {
+        throw new Error('La conexión de streaming terminó sin respuesta');
+    }
+    
+    return resultado;
+}
+
+// Mostrar u ocultar el botón Cancelar del modal de carga
+function mostrarBotonCancelar(visible) {
+    const boton = document.getElementById('cancelarAgenteBtn');
+    if (boton) {
+        boton.style.display = visible ? 'inline-block' : 'none';
+    }
+}
+
+// Cancelar la ejecución del agente en curso
+async function cancelarAgente() {
+    const ejecucion = ejecucionAgenteActual;
+    if (!ejecucion || ejecucion.cancelada) return;
+    ejecucion.cancelada = true;
+    updateLoadingProgress(100, '⏹️ Cancelando agente...');
+    
+    // Con el id, el servidor detiene el agente y responde 'cancelado' con los pasos hechos;
+    // si aún no hay id (o falla), cerrar la conexión también lo detiene
+    try {
+        if (ejecucion.id) {
+            const response = await fetch(`/chat/agente/cancelar/${ejecucion.id}`, { method: 'POST' });
+            if (response.ok) return;
+        }
+    } catch (error) {
+        console.error('Error cancelando el agente:', error);
+    }
+    ejecucion.controlador.abort();
+}
+
+// Escapar texto externo (resultados de búsqueda, entradas del modelo) antes de insertarlo como HTML
+function escaparHTML(texto) {
+    const div = document.createElement('div');
+    div.textContent = texto || '';
+    return div.innerHTML;
+}
+
 // Agregar mensaje al chat
 function agregarMensaje(texto, tipo, modo = null, modeloUsado = null, pasos = null, metadata = null, pensamientos = null, reasoningContent = null) {
     const mensajeDiv = document.createElement('div');
@@ -1025,9 +1302,8 @@ function setLoading(isLoading, step = null, progress = 0) {
             setTimeout(() => updateLoadingProgress(75, '📝 Estructurando respuesta...'), 4000);
             setTimeout(() => updateLoadingProgress(90, '🔄 Validando coherencia...'), 5000);
         } else if (modo === 'agente' && internetHabilitado) {
-            setTimeout(() => updateLoadingProgress(20, 'Conectando con el agente...'), 500);
-            setTimeout(() => updateLoadingProgress(40, 'Analizando la pregunta...'), 1000);
-            setTimeout(() => updateLoadingProgress(60, 'Ejecutando búsqueda web...'), 2000);
+            // El progreso real llega con los eventos del agente (enviarPreguntaAgenteStream)
+            updateLoadingProgress(5, 'Conectando con el agente...');
         } else if (modo === 'busqueda_rapida' && internetHabilitado) {
             setTimeout(() => updateLoadingProgress(30, 'Preparando búsqueda rápida...'), 500);
             setTimeout(() => updateLoadingProgress(60, 'Consultando fuentes web...'), 1000);
@@ -1713,6 +1989,28 @@ function toggleAutoRefreshUI() {
     }
 }
 
+// Suscribirse a los cambios de estado que publica el monitor de backends (SSE)
+function subscribeModelsStatus() {
+    if (!window.EventSource) return null;
+    
+    const source = new EventSource('/api/models/status/eventos');
+    source.addEventListener('estado', (event) => {
+        if (!autoRefreshEnabled) return;
+        if (!document.getElementById('modelsStatusContainer')) return;
+        
+        const data = JSON.parse(event.data);
+        lastRefreshTime = Date.now();
+        displayModelsStatus(data.estado, data.ollama_running);
+    });
+    source.onerror = () => {
+        // Monitor desactivado: seguir solo con el auto-refresh
+        if (source.readyState === EventSource.CLOSED) {
+            console.warn('Canal de estado de modelos no disponible');
+        }
+    };
+    return source;
+}
+
 // Cargar estado de modelos al inicializar la página
 document.addEventListener('DOMContentLoaded', function() {
     // Cargar estado inicial después de un breve delay
@@ -1720,6 +2018,9 @@ document.addEventListener('DOMContentLoaded', function() {
         refreshModelsStatus();
     }, 1000);
     
+    // Recibir los cambios de estado en cuanto el monitor los detecte
+    subscribeModelsStatus();
+    
     // Iniciar auto-refresh controlado
     startAutoRefresh();
     
@@ -0,0 +1,1038 @@
+#!/usr/bin/env python3
+"""Pruebas de componentes de la aplicación que no necesitan backends reales (sin red)"""
+
+import asyncio
+import copy
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+from config import Config
+
+# app prepara la base de datos al importarse: se apunta a una base temporal en lugar del historial real
+# y sin monitor de backends, que sondearía la red en segundo plano
+_directorio_importacion = tempfile.TemporaryDirectory()
+Config.DATABASE_PATH = os.path.join(_directorio_importacion.name, 'importacion.db')
+Config.HEALTH_MONITOR_ENABLED = False
+
+import httpx
+import pytest
+import requests
+import database
+from database import crear_conexion, aplicar_migraciones
+import http_client
+import app
+import asgi
+from app import (
+    CIRCUITO_LMSTUDIO, CacheResultados, CacheSemantica, ChatLMStudio, ClasificadorReglas, ColaSaturadaError,
+    EnrutadorModelos, ModeloPlanificado, PlanificadorBackend, RegistroPerezoso, TrazaAgente, clasificar_intencion,
+    crear_prompt_para_modelo, huella_historial, obtener_prompt_agente, preparar_memoria, quitar_tildes
+)
+from langchain.agents import AgentExecutor, create_react_agent
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import Tool
+from http_client import (
+    PeticionCanceladaError, StreamIncompletoError, TokenCancelacion, comprobar_cancelacion, con_cancelacion,
+    obtener_circuito, token_actual
+)
+
+@pytest.fixture
+def base_temporal(tmp_path, monkeypatch):
+    """Conexión del hilo actual sobre una base vacía con el esquema migrado"""
+    conn = crear_conexion(str(tmp_path / 'historial_prueba.db'))
+    aplicar_migraciones(conn)
+    monkeypatch.setattr(database._local, 'conn', conn, raising=False)
+    yield conn
+    conn.close()
+
+def insertar_turnos(conn, session_id, cantidad):
+    """Inserta turnos de ~22 tokens estimados cada uno ('Pregunta N.' / 'Respuesta N.' + relleno)"""
+    for i in range(1, cantidad + 1):
+        conn.execute(
+            'INSERT INTO conversations (session_id, user_message, ai_response, model_used, timestamp) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (session_id, f'Pregunta {i}. ' + 'y' * 28, f'Respuesta {i}. ' + 'x' * 27, 'llama3',
+             f'2024-01-01 00:00:{i:02d}')
+        )
+    conn.commit()
+
+# ================================
+# LM STUDIO: STREAMING SSE
+# ================================
+
+class ServidorLMStudio:
+    """LM Studio falso en un puerto local: responde a /v1/chat/completions con `lineas` (SSE, `pausa`
+    segundos antes de cada una) si se pide streaming o con `respuesta` (JSON) si no, y guarda el cuerpo
+    de cada petición en `peticiones`"""
+
+    def __init__(self):
+        self.lineas = []
+        self.pausa = 0
+        self.respuesta = {'choices': [{'message': {'role': 'assistant', 'content': 'hola'}, 'finish_reason': 'stop'}]}
+        self.peticiones = []
+        servidor = self
+
+        class Manejador(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                longitud = int(self.headers.get('Content-Length', 0))
+                cuerpo = json.loads(self.rfile.read(longitud))
+                servidor.peticiones.append(cuerpo)
+                self.send_response(200)
+                if cuerpo.get('stream'):
+                    # HTTP/1.0: la conexión se cierra al terminar, como al acabar un stream
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.end_headers()
+                    try:
+                        for linea in servidor.lineas:
+                            time.sleep(servidor.pausa)
+                            self.wfile.write(linea.encode('utf-8') + b'\n')
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass  # El cliente cortó la conexión (timeout entre trozos)
+                else:
+                    datos = json.dumps(servidor.respuesta).encode('utf-8')
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(datos)))
+                    self.end_headers()
+                    self.wfile.write(datos)
+
+            def log_message(self, *args):
+                pass
+
+        self._http = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Manejador)
+        self.url = f'http://127.0.0.1:{self._http.server_address[1]}'
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+
+    def cerrar(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+@pytest.fixture
+def lmstudio():
+    servidor = ServidorLMStudio()
+    yield servidor
+    servidor.cerrar()
+
+def sse(evento):
+    return 'data: ' + json.dumps(evento)
+
+def test_lmstudio_stream_sse(lmstudio):
+    """Los tokens llegan en orden, se ignoran comentarios y keep-alives y se para en [DONE]"""
+    lmstudio.lineas = [
+        ': keep-alive',
+        '',
+        sse({'choices': [{'delta': {'reasoning_content': 'pienso'}}]}),
+        sse({'choices': [{'delta': {'content': 'Ho'}}]}),
+        'data: {no es json',
+        sse({'choices': [{'delta': {'content': 'la'}, 'finish_reason': 'stop'}]}),
+        sse({'choices': [], 'usage': {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7}}),
+        'data: [DONE]',
+        sse({'choices': [{'delta': {'content': ' de más'}}]})
+    ]
+    modelo = ChatLMStudio(model='prueba', base_url=lmstudio.url)
+
+    trozos = list(modelo.stream('hola'))
+    mensaje = sum(trozos[1:], trozos[0])
+
+    assert [t.content for t in trozos if t.content] == ['Ho', 'la']
+    assert mensaje.content == 'Hola'
+    assert mensaje.additional_kwargs['reasoning_content'] == 'pienso'
+    assert mensaje.usage_metadata['total_tokens'] == 7
+    assert lmstudio.peticiones[0]['stream'] and lmstudio.peticiones[0]['model'] == 'prueba'
+
+def test_lmstudio_envia_secuencias_de_parada(lmstudio):
+    """stop llega al servidor tanto en la generación completa como en streaming"""
+    lmstudio.lineas = [sse({'choices': [{'delta': {'content': 'hola'}}]}), 'data: [DONE]']
+    modelo = ChatLMStudio(model='prueba', base_url=lmstudio.url)
+    parada = ['\nObservation']
+
+    assert modelo.invoke('hola', stop=parada).content == 'hola'
+    with con_cancelacion(TokenCancelacion(60)):
+        assert modelo.invoke('hola', stop=parada).content == 'hola'
+    assert [cuerpo['stop'] for cuerpo in lmstudio.peticiones] == [parada, parada]
+    assert lmstudio.peticiones[1]['stream']
+    modelo.invoke('hola')
+    assert 'stop' not in lmstudio.peticiones[-1]
+
+def test_lmstudio_stream_informa_al_circuito(lmstudio, monkeypatch):
+    """El circuito mide el stream hasta [DONE] y cuenta como fallo un corte a mitad de la lectura"""
+    monkeypatch.setattr(http_client, '_circuitos', {})
+    circuito = obtener_circuito(CIRCUITO_LMSTUDIO)
+    lmstudio.lineas = [sse({'choices': [{'delta': {'content': 'hola'}}]}), 'data: [DONE]']
+    lmstudio.pausa = 0.1
+    modelo = ChatLMStudio(model='prueba', base_url=lmstudio.url)
+
+    async def leer_async():
+        return [trozo async for trozo in modelo.astream('hola')]
+
+    # Con token activo la generación completa también se lee en streaming
+    with con_cancelacion(TokenCancelacion(60)):
+        assert modelo.invoke('hola').content == 'hola'
+    asyncio.run(leer_async())
+    assert len(circuito.latencias) == 2 and min(circuito.latencias) >= 0.2
+
+    # LM Studio deja de enviar tokens: el timeout entre trozos llega al circuito
+    monkeypatch.setattr(Config, 'LMSTUDIO_TIMEOUT', 0.3)
+    lmstudio.pausa = 2
+    with pytest.raises(requests.RequestException):
+        list(modelo.stream('hola'))
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(leer_async())
+    assert circuito.estadisticas['fallos'] == 2 and circuito.fallos_seguidos == 2
+    assert len(circuito.latencias) == 2
+
+def test_lmstudio_stream_sin_done(lmstudio, monkeypatch):
+    """Un stream que se cierra sin [DONE] es un error (y un fallo del circuito), no una respuesta truncada"""
+    monkeypatch.setattr(http_client, '_circuitos', {})
+    lmstudio.lineas = [sse({'choices': [{'delta': {'content': 'a medias'}}]})]
+    modelo = ChatLMStudio(model='prueba', base_url=lmstudio.url)
+
+    async def leer_async():
+        return [trozo async for trozo in modelo.astream('hola')]
+
+    with pytest.raises(StreamIncompletoError):
+        list(modelo.stream('hola'))
+    with pytest.raises(StreamIncompletoError):
+        asyncio.run(leer_async())
+    assert obtener_circuito(CIRCUITO_LMSTUDIO).estadisticas['fallos'] == 2
+
+# ================================
+# MODELOS: CARGA DIFERIDA Y DISPONIBILIDAD
+# ================================
+
+def test_registro_perezoso_reintenta_nulos():
+    """Un valor que no se pudo construir se vuelve a intentar en el siguiente acceso"""
+    disponible = {'valor': False}
+    construidos = []
+
+    def fabrica(clave):
+        construidos.append(clave)
+        return f'modelo {clave}' if disponible['valor'] else None
+
+    registro = RegistroPerezoso('modelo', ['a'], fabrica, incluir_nulos=False)
+    assert 'a' not in registro and registro['a'] is None
+    disponible['valor'] = True
+    assert 'a' in registro and registro['a'] == 'modelo a'
+    registro['a']
+    assert len(construidos) == 3
+
+def test_lmstudio_arrancado_despues(monkeypatch):
+    """Los modelos de LM Studio se retiran mientras no responde y vuelven cuando arranca"""
+    monkeypatch.setattr(Config, 'LMSTUDIO_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(app, 'estado_lmstudio', {'disponible': None, 'comprobado': 0.0})
+    monkeypatch.setattr(app, 'available_models', list(app.modelos_configurados))
+    responde = {'valor': False}
+    monkeypatch.setattr(Config, 'validate_lmstudio', staticmethod(lambda: responde['valor']))
+
+    assert not app.lmstudio_disponible()
+    assert not any(m in app.available_models for m in app.lmstudio_models)
+    responde['valor'] = True
+    assert app.lmstudio_disponible()
+    assert app.available_models == app.modelos_configurados
+
+# ================================
+# HISTORIAL: PAGINACIÓN
+# ================================
+
+def test_historial_paginacion_cursor(base_temporal):
+    """Seguir siguiente_cursor recorre el historial entero sin repetir ni saltar turnos,
+    aunque varios compartan timestamp"""
+    for i in range(7):
+        base_temporal.execute(
+            'INSERT INTO conversations (session_id, user_message, ai_response, model_used, timestamp) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ('sesion', f'Pregunta {i}', f'Respuesta {i}', 'llama3', f'2024-01-01 00:00:0{i // 3}')
+        )
+    base_temporal.commit()
+    cliente = app.app.test_client()
+
+    vistas, paginas, cursor = [], 0, None
+    while True:
+        parametros = {'limit': 3, 'campos': 'id,user_message', **({'cursor': cursor} if cursor else {})}
+        datos = cliente.get('/api/historial/sesion', query_string=parametros).get_json()
+        assert all(set(conversacion) == {'id', 'user_message'} for conversacion in datos['conversaciones'])
+        vistas += [conversacion['user_message'] for conversacion in datos['conversaciones']]
+        paginas += 1
+        cursor = datos['siguiente_cursor']
+        if cursor is None:
+            break
+
+    assert paginas == 3
+    assert vistas == [f'Pregunta {i}' for i in reversed(range(7))]
+    assert cliente.get('/api/historial/sesion', query_string={'cursor': 'no-es-un-cursor'}).status_code == 400
+
+# ================================
+# MEMORIA DE CONVERSACIÓN
+# ================================
+
+def test_memoria_resumen_cubre_turnos_descartados(base_temporal, monkeypatch):
+    """Los turnos que se descartan para hacer sitio al resumen quedan dentro del resumen"""
+    monkeypatch.setattr(Config, 'MEMORY_MAX_TURNS', 20)
+    monkeypatch.setattr(Config, 'MEMORY_TOKEN_BUDGET', 140)
+    monkeypatch.setattr(Config, 'MEMORY_TOKEN_BUDGETS', {})
+    monkeypatch.setattr(Config, 'MEMORY_SUMMARY_TOKENS', 80)
+    monkeypatch.setattr(Config, 'MEMORY_SUMMARY_MODE', 'extractivo')
+    insertar_turnos(base_temporal, 'sesion', 8)
+
+    historial, info = preparar_memoria('llama3', 'sesion')
+
+    assert isinstance(historial[0], SystemMessage)
+    resumen = historial[0].content
+    recientes = [m.content for m in historial[1:] if isinstance(m, HumanMessage)]
+    assert info['resumen'] and info['turnos'] == len(recientes)
+    assert info['tokens_estimados'] <= info['presupuesto']
+    # Sin huecos: el último turno resumido es el anterior al primero que va completo
+    primero = int(recientes[0].split()[1].rstrip('.'))
+    assert f'Pregunta {primero - 1}.' in resumen
+    assert f'Pregunta {primero}.' not in resumen
+    assert recientes[-1].startswith('Pregunta 8.')
+
+def test_memoria_sin_turnos_antiguos(base_temporal, monkeypatch):
+    """Si todo el historial cabe en el presupuesto no se genera resumen"""
+    monkeypatch.setattr(Config, 'MEMORY_MAX_TURNS', 20)
+    monkeypatch.setattr(Config, 'MEMORY_TOKEN_BUDGET', 1000)
+    monkeypatch.setattr(Config, 'MEMORY_TOKEN_BUDGETS', {})
+    insertar_turnos(base_temporal, 'sesion', 3)
+
+    historial, info = preparar_memoria('llama3', 'sesion')
+
+    assert not info['resumen'] and info['turnos'] == 3
+    assert len(historial) == 6 and historial[0].content.startswith('Pregunta 1.')
+
+# ================================
+# CACHÉ SEMÁNTICA
+# ================================
+
+def test_cache_semantica_respeta_contexto():
+    """Una respuesta generada con historial solo se reutiliza con el mismo historial"""
+    cache = CacheSemantica(dimension=256, max_entradas=10, ttl=60, umbral=0.9, umbrales_modelo={})
+    contexto = huella_historial([HumanMessage(content='Me llamo Ana')])
+
+    cache.guardar('llama3', '¿Cómo me llamo?', 'Te llamas Ana', contexto=contexto)
+
+    assert cache.buscar('llama3', '¿Cómo me llamo?') is None
+    assert cache.buscar('llama3', '¿Cómo me llamo?', huella_historial([HumanMessage(content='Soy Luis')])) is None
+    assert cache.buscar('llama3', '¿cómo me llamo', contexto)['respuesta'] == 'Te llamas Ana'
+    assert huella_historial([]) is None
+
+# ================================
+# PREFIJO ESTABLE DEL PROMPT
+# ================================
+
+def test_prefijo_estable_entre_peticiones(monkeypatch):
+    """El mensaje 'system' que abre el prompt es idéntico byte a byte aunque cambien la pregunta,
+    el historial y la fecha, que va en el último mensaje del usuario"""
+    modelo = ChatLMStudio(model='prueba', system_nativo=True)
+    prompt = crear_prompt_para_modelo('phi3')
+
+    primera = modelo._convertir_mensajes(prompt.invoke({'pregunta': '¿Qué es Python?'}).to_messages())
+    monkeypatch.setattr(app.time, 'strftime', lambda formato, *args: '1 de enero de 2030')
+    segunda = modelo._convertir_mensajes(prompt.invoke({
+        'pregunta': '¿Y Java?',
+        'historial': [HumanMessage(content='¿Qué es Python?'), AIMessage(content='Un lenguaje.')]
+    }).to_messages())
+
+    assert [m['role'] for m in segunda] == ['system', 'user', 'assistant', 'user']
+    assert json.dumps(primera[0]).encode('utf-8') == json.dumps(segunda[0]).encode('utf-8')
+    assert '1 de enero de 2030' in segunda[-1]['content'] and '2030' not in segunda[0]['content']
+
+def test_prefijo_tokens_cacheados(lmstudio):
+    """Los tokens del prompt servidos desde la caché KV del servidor llegan a usage_metadata"""
+    uso = {'prompt_tokens': 100, 'completion_tokens': 1, 'total_tokens': 101,
+           'prompt_tokens_details': {'cached_tokens': 80}}
+    lmstudio.lineas = [sse({'choices': [{'delta': {'content': 'ok'}}]}), sse({'choices': [], 'usage': uso}), 'data: [DONE]']
+    trozos = list(ChatLMStudio(model='prueba', base_url=lmstudio.url).stream('hola'))
+
+    assert sum(trozos[1:], trozos[0]).usage_metadata['input_token_details'] == {'cache_read': 80}
+    # llama.cpp informa los tokens reutilizados en timings.cache_n
+    assert ChatLMStudio._crear_usage_metadata({'prompt_tokens': 100}, {'cache_n': 64})['input_token_details'] == {'cache_read': 64}
+    assert 'input_token_details' not in ChatLMStudio._crear_usage_metadata({'prompt_tokens': 100})
+
+# ================================
+# PLANIFICADOR: COLA POR BACKEND
+# ================================
+
+def esperar_a(condicion, segundos=5.0):
+    limite = time.monotonic() + segundos
+    while not condicion():
+        assert time.monotonic() < limite, 'la condición no se cumplió a tiempo'
+        time.sleep(0.005)
+
+def test_planificador_cola_fifo():
+    """Al liberar un turno pasa a la primera petición de la cola, en orden de llegada"""
+    planificador = PlanificadorBackend('prueba', max_en_vuelo=1, espera_maxima=5)
+    orden = []
+
+    def esperar_turno(nombre):
+        with planificador.turno() as turno:
+            orden.append((nombre, turno['posicion']))
+
+    with planificador.turno():
+        hilos = []
+        for nombre in ('primero', 'segundo'):
+            hilos.append(threading.Thread(target=esperar_turno, args=(nombre,)))
+            hilos[-1].start()
+            esperar_a(lambda: planificador.resumen()['en_cola'] == len(hilos))
+    for hilo in hilos:
+        hilo.join(5)
+
+    assert orden == [('primero', 1), ('segundo', 2)]
+    assert planificador.resumen()['en_vuelo'] == 0
+
+def test_planificador_plazo_de_cola():
+    """Sin turno antes del plazo se rechaza con ColaSaturadaError y se sale de la cola"""
+    planificador = PlanificadorBackend('prueba', max_en_vuelo=1, espera_maxima=5)
+    with planificador.turno():
+        with pytest.raises(ColaSaturadaError):
+            with planificador.turno(plazo=0.05):
+                pass
+    resumen = planificador.resumen()
+    assert resumen['en_cola'] == 0 and resumen['rechazadas'] == 1
+
+def test_planificador_cancelacion_despierta_la_espera():
+    """Cancelar la petición termina su espera en la cola al momento"""
+    planificador = PlanificadorBackend('prueba', max_en_vuelo=1, espera_maxima=30)
+    token = TokenCancelacion(60)
+    inicio = time.monotonic()
+    with planificador.turno():
+        threading.Timer(0.05, token.cancelar).start()
+        with con_cancelacion(token):
+            with pytest.raises(PeticionCanceladaError):
+                with planificador.turno():
+                    pass
+    assert time.monotonic() - inicio < 1 and planificador.resumen()['en_cola'] == 0
+
+# ================================
+# PLANIFICADOR: GENERACIONES AGRUPADAS
+# ================================
+
+class ModeloBloqueado:
+    """Modelo falso: la primera llamada espera a `soltar` y termina como indique `al_soltar`"""
+
+    def __init__(self):
+        self.empezo, self.soltar = threading.Event(), threading.Event()
+        self.llamadas = 0
+        self.al_soltar = lambda: AIMessage(content='del lider')
+
+    def invoke(self, entrada, config=None, **kwargs):
+        self.llamadas += 1
+        if self.llamadas > 1:
+            return AIMessage(content='propia')
+        self.empezo.set()
+        self.soltar.wait(5)
+        return self.al_soltar()
+
+def lanzar_lider(modelo_planificado, resultados, token=None):
+    def lider():
+        with con_cancelacion(token):
+            try:
+                resultados['lider'] = modelo_planificado.invoke('hola')
+            except BaseException as e:
+                resultados['lider'] = e
+    hilo = threading.Thread(target=lider)
+    hilo.start()
+    modelo_planificado.modelo.empezo.wait(5)
+    return hilo
+
+@pytest.fixture
+def planificado(monkeypatch):
+    monkeypatch.setattr(Config, 'SCHEDULER_COALESCE', True)
+    return ModeloPlanificado(ModeloBloqueado(), 'lmstudio-deepseek')
+
+def test_planificador_lider_interrumpido(planificado):
+    """Una interrupción del líder (BaseException) no deja colgados a sus seguidores"""
+    def interrumpir():
+        raise KeyboardInterrupt()
+    planificado.modelo.al_soltar = interrumpir
+    resultados = {}
+    hilo = lanzar_lider(planificado, resultados)
+    seguidor = threading.Thread(target=lambda: resultados.setdefault('seguidor', planificado.invoke('hola')))
+    seguidor.start()
+    esperar_a(lambda: planificado._en_curso and seguidor.is_alive())
+    planificado.modelo.soltar.set()
+    hilo.join(5)
+    seguidor.join(5)
+
+    assert isinstance(resultados['lider'], KeyboardInterrupt)
+    assert resultados['seguidor'].content == 'propia'
+
+def test_planificador_lider_cancelado(planificado):
+    """Si se cancela la petición del líder, el seguidor genera por su cuenta"""
+    def cancelada():
+        comprobar_cancelacion()
+        return AIMessage(content='del lider')
+    planificado.modelo.al_soltar = cancelada
+    token, resultados = TokenCancelacion(), {}
+    hilo = lanzar_lider(planificado, resultados, token)
+    seguidor = threading.Thread(target=lambda: resultados.setdefault('seguidor', planificado.invoke('hola')))
+    seguidor.start()
+    time.sleep(0.05)
+    token.cancelar()
+    planificado.modelo.soltar.set()
+    hilo.join(5)
+    seguidor.join(5)
+
+    assert isinstance(resultados['lider'], PeticionCanceladaError)
+    assert resultados['seguidor'].content == 'propia'
+    assert not planificado._en_curso
+
+def test_planificador_seguidor_respeta_su_plazo(planificado):
+    """El seguidor de una generación colgada no pasa de su propio plazo"""
+    resultados = {}
+    hilo = lanzar_lider(planificado, resultados)
+    inicio = time.monotonic()
+    with con_cancelacion(TokenCancelacion(0.2)):
+        with pytest.raises(PeticionCanceladaError) as error:
+            planificado.invoke('hola')
+    assert error.value.por_plazo and time.monotonic() - inicio < 1
+    planificado.modelo.soltar.set()
+    hilo.join(5)
+    assert resultados['lider'].content == 'del lider'
+
+# ================================
+# ENRUTADOR DE MODELOS
+# ================================
+
+@pytest.fixture
+def enrutador(monkeypatch):
+    monkeypatch.setattr(Config, 'ROUTER_MAX_FAILURES', 2)
+    monkeypatch.setattr(Config, 'ROUTER_COOLDOWN', 60)
+    monkeypatch.setattr(app, 'available_models', list(app.modelos_configurados))
+    return EnrutadorModelos({'locales': ['llama3', 'phi3']}, {'llama3': 2.0, 'phi3': 1.0}, ventana=20)
+
+def fallar(enrutador, model_key, error):
+    with pytest.raises(type(error)):
+        with enrutador.medir(model_key):
+            raise error
+
+def test_enrutador_evita_modelo_con_fallos(enrutador):
+    """Tras ROUTER_MAX_FAILURES fallos seguidos el modelo deja de ser candidato"""
+    assert enrutador.candidatos('llama3', 'preferido') == ['llama3', 'phi3']
+    for _ in range(Config.ROUTER_MAX_FAILURES):
+        fallar(enrutador, 'llama3', ConnectionError('sin respuesta'))
+
+    candidatos, enrutado = enrutador.elegir('llama3', 'preferido')
+    assert candidatos == ['phi3'] and enrutado['usado'] == 'phi3'
+    assert enrutador.candidatos('llama3', 'fijo') == ['llama3']
+
+def test_enrutador_ignora_cancelaciones(enrutador):
+    """Las generaciones abandonadas por el cliente no cuentan para la salud del modelo"""
+    for _ in range(Config.ROUTER_MAX_FAILURES):
+        fallar(enrutador, 'llama3', PeticionCanceladaError('cliente desconectado'))
+    assert enrutador.esta_sano('llama3')
+    assert enrutador.resumen()['llama3']['muestras'] == 0
+
+def test_enrutador_politica_barato(enrutador):
+    assert enrutador.candidatos('llama3', 'barato') == ['phi3', 'llama3']
+
+def test_enrutador_latencia_penaliza_la_cola(enrutador, monkeypatch):
+    """La latencia estimada crece con las peticiones que esperan turno en el backend del modelo"""
+    planificador = PlanificadorBackend('ollama', max_en_vuelo=1, espera_maxima=5)
+    monkeypatch.setitem(app.planificadores, 'ollama', planificador)
+    enrutador.registrar('llama3', 2.0, True)
+    assert enrutador.latencia_estimada('llama3') == 2.0
+
+    soltar = threading.Event()
+
+    def ocupar():
+        with planificador.turno():
+            soltar.wait(5)
+
+    def esperar_turno():
+        with planificador.turno():
+            pass
+
+    ocupante, en_espera = threading.Thread(target=ocupar), threading.Thread(target=esperar_turno)
+    ocupante.start()
+    esperar_a(lambda: planificador.resumen()['en_vuelo'] == 1)
+    en_espera.start()
+    esperar_a(lambda: planificador.en_cola() == 1)
+    assert enrutador.latencia_estimada('llama3') == 4.0
+
+    soltar.set()
+    ocupante.join(5)
+    en_espera.join(5)
+    assert enrutador.latencia_estimada('llama3') == 2.0
+
+def test_chat_agente_fallido_usa_failover(monkeypatch):
+    """Si el agente falla, la respuesta simple de /chat pasa al equivalente cuando el modelo elegido también falla"""
+    def sin_conexion(entrada):
+        raise ConnectionError('sin respuesta')
+
+    monkeypatch.setattr(app.enrutador, 'elegir', lambda model_key, politica=None: (
+        ['llama3', 'phi3'], {'solicitado': model_key, 'usado': 'llama3', 'politica': 'preferido'}
+    ))
+    monkeypatch.setattr(app, 'models', {'llama3': object(), 'phi3': object()})
+    monkeypatch.setattr(app, 'agents', {'llama3': RunnableLambda(sin_conexion)})
+    monkeypatch.setattr(app, 'simple_chains', {'llama3': None, 'phi3': None})
+    monkeypatch.setattr(app, 'chat_chains', {
+        'llama3': RunnableLambda(sin_conexion),
+        'phi3': RunnableLambda(lambda entrada: AIMessage(content='respuesta de phi3'))
+    })
+
+    respuesta = app.app.test_client().post('/chat', json={'pregunta': 'Explícame la fotosíntesis',
+                                                          'modo': 'agente', 'modelo': 'llama3'})
+    datos = respuesta.get_json()
+
+    assert datos['modo'] == 'simple_fallback' and datos['modelo_usado'] == 'phi3'
+    assert datos['respuesta'].endswith('respuesta de phi3')
+
+# ================================
+# ESTADO DE LOS MODELOS
+# ================================
+
+def test_estado_modelos_etag(monkeypatch):
+    """/api/models/status responde 304 mientras el estado no cambia y 200 con otro ETag cuando cambia"""
+    inventario = {
+        'ollama': {'available': False, 'models': [], 'running': []},
+        'lmstudio': {'available': False, 'models': []},
+        'gemini': {'available': False}
+    }
+    monkeypatch.setattr(app, 'sondear_backends', lambda: copy.deepcopy(inventario))
+    cliente = app.app.test_client()
+
+    primera = cliente.get('/api/models/status')
+    etag = primera.headers['ETag']
+    assert primera.status_code == 200 and etag.startswith('W/')
+    repetida = cliente.get('/api/models/status', headers={'If-None-Match': etag})
+    assert repetida.status_code == 304 and not repetida.data
+
+    inventario['lmstudio'] = {'available': True, 'models': [{'id': 'deepseek-r1'}]}
+    cambiada = cliente.get('/api/models/status', headers={'If-None-Match': etag})
+    assert cambiada.status_code == 200 and cambiada.headers['ETag'] != etag
+    assert cambiada.get_json()['lmstudio']['models'] == [{'id': 'deepseek-r1', 'object': 'model'}]
+
+# ================================
+# COALESCENCIA DE CARGAS (CACHÉ DE RESULTADOS)
+# ================================
+
+def test_cache_resultados_lider_cancelado():
+    """Si se cancela la petición que carga, quien esperaba la misma clave carga por su cuenta"""
+    cache = CacheResultados('prueba', None)
+    empezo, soltar = threading.Event(), threading.Event()
+    cargas, resultados = [], {}
+    token = TokenCancelacion()
+
+    def cargar_lider():
+        cargas.append('lider')
+        empezo.set()
+        soltar.wait(5)
+        comprobar_cancelacion()
+        return 'del lider'
+
+    def lider():
+        with con_cancelacion(token):
+            try:
+                cache.obtener('clave', cargar_lider)
+            except PeticionCanceladaError as e:
+                resultados['lider'] = e
+
+    def seguidor():
+        resultados['seguidor'] = cache.obtener('clave', lambda: cargas.append('seguidor') or 'propio')
+
+    hilos = [threading.Thread(target=lider), threading.Thread(target=seguidor)]
+    hilos[0].start()
+    empezo.wait(5)
+    hilos[1].start()
+    esperar_a(lambda: cache.resumen()['agrupadas'] == 1)
+    token.cancelar()
+    soltar.set()
+    for hilo in hilos:
+        hilo.join(5)
+
+    assert isinstance(resultados['lider'], PeticionCanceladaError)
+    assert resultados['seguidor'] == 'propio'
+    assert cargas == ['lider', 'seguidor']
+    assert cache.resumen()['errores'] == 0 and cache.resumen()['en_vuelo'] == 0
+
+def test_cache_resultados_lider_falla():
+    """Un fallo real de la carga se comparte con quienes esperaban, sin repetir la consulta"""
+    cache = CacheResultados('prueba', None)
+    empezo, soltar = threading.Event(), threading.Event()
+    errores = []
+
+    def cargar():
+        empezo.set()
+        soltar.wait(5)
+        raise ValueError('fuente caída')
+
+    def consultar(funcion):
+        try:
+            cache.obtener('clave', funcion)
+        except ValueError as e:
+            errores.append(e)
+
+    hilos = [threading.Thread(target=consultar, args=(cargar,)),
+             threading.Thread(target=consultar, args=(lambda: 'no debería cargarse',))]
+    hilos[0].start()
+    empezo.wait(5)
+    hilos[1].start()
+    esperar_a(lambda: cache.resumen()['agrupadas'] == 1)
+    soltar.set()
+    for hilo in hilos:
+        hilo.join(5)
+
+    assert len(errores) == 2 and errores[0] is errores[1]
+    assert cache.resumen()['errores'] == 1
+
+def test_cache_resultados_tarea_cancelada_async():
+    """Cancelar la tarea que carga (desconexión del cliente) no deja colgados a los demás"""
+    cache = CacheResultados('prueba', None)
+
+    async def principal():
+        empezo = asyncio.Event()
+
+        async def cargar_lento():
+            empezo.set()
+            await asyncio.sleep(10)
+            return 'lento'
+
+        async def cargar_rapido():
+            return 'propio'
+
+        lider = asyncio.create_task(cache.obtener_async('clave', cargar_lento))
+        await empezo.wait()
+        seguidor = asyncio.create_task(cache.obtener_async('clave', cargar_rapido))
+        await asyncio.sleep(0.01)
+        lider.cancel()
+        return await asyncio.wait_for(seguidor, 5)
+
+    assert asyncio.run(principal()) == 'propio'
+    assert cache.resumen()['en_vuelo'] == 0
+
+def test_cache_resultados_seguidor_respeta_su_plazo():
+    """Quien espera una carga ajena colgada no pasa de su propio plazo"""
+    cache = CacheResultados('prueba', None)
+    empezo, soltar = threading.Event(), threading.Event()
+
+    def cargar_colgada():
+        empezo.set()
+        soltar.wait(5)
+        return 'tarde'
+
+    hilo = threading.Thread(target=cache.obtener, args=('clave', cargar_colgada))
+    hilo.start()
+    empezo.wait(5)
+    inicio = time.monotonic()
+    with con_cancelacion(TokenCancelacion(0.2)):
+        with pytest.raises(PeticionCanceladaError) as error:
+            cache.obtener('clave', lambda: 'no debería cargarse')
+    assert error.value.por_plazo and time.monotonic() - inicio < 1
+    soltar.set()
+    hilo.join(5)
+
+def test_cache_resultados_revalidacion_sin_token_de_la_peticion(monkeypatch):
+    """La revalidación en segundo plano no hereda el token de la petición que la disparó"""
+    cache = CacheResultados('prueba', None)
+    monkeypatch.setattr(cache, '_buscar', lambda clave: ('obsoleto', False))
+    tokens = []
+
+    async def principal():
+        async def cargar():
+            await asyncio.sleep(0)
+            tokens.append(token_actual())
+            return 'nuevo'
+
+        with con_cancelacion(TokenCancelacion(60)):
+            assert await cache.obtener_async('clave', cargar) == 'obsoleto'
+        await asyncio.gather(*cache._tareas)
+
+    asyncio.run(principal())
+    assert tokens == [None] and cache.resumen()['revalidaciones'] == 1
+
+# ================================
+# INTENCIÓN Y CIUDAD
+# ================================
+
+def test_intencion_palabras_clave():
+    """Las palabras clave se buscan como subcadenas y sin tildes; cada una activa todas sus etiquetas"""
+    intencion = clasificar_intencion('¿Cuál es la COTIZACION actual del bitcoin?')
+    assert intencion.actualidad and intencion.tiene('bitcoin') and intencion.necesita_agente
+    assert {'cotizacion', 'actual'} <= set(intencion.etiquetas['actualidad'])
+    assert not intencion.clima and not intencion.ollama
+    assert clasificar_intencion('¿Qué temperatura hay?').clima
+    assert not clasificar_intencion('Dame un template de correo').clima
+
+def test_intencion_palabras_solapadas():
+    """Una palabra clave que contiene a otra activa también las etiquetas de la más corta"""
+    reglas = ClasificadorReglas({'precio': ['precio'], 'oro': ['precio del oro'], 'ps': ['ps']}, {'Quito': ['quito']})
+    etiquetas = reglas.etiquetar(quitar_tildes('El Precio del oro y los PS'))
+    assert etiquetas == {'oro': ['precio del oro'], 'precio': ['precio del oro'], 'ps': ['ps']}
+
+def test_intencion_ciudad_gazetteer():
+    """Las ciudades se reconocen como palabras completas y respetando las tildes"""
+    assert clasificar_intencion('¿Qué clima hace en Bogotá?').ciudad == 'Bogota'
+    assert clasificar_intencion('temperatura en nueva york mañana').ciudad == 'New York'
+    assert clasificar_intencion('Me quitó el paraguas, ¿lloverá?').ciudad is None
+    assert clasificar_intencion('el tiempo para lijar con limadura').ciudad is None
+    assert clasificar_intencion('¿Va a llover hoy?').ciudad_o_defecto() == Config.INTENT_DEFAULT_CITY
+
+# ================================
+# BÚSQUEDA WEB EN PARALELO
+# ================================
+
+@pytest.fixture
+def fuentes_falsas(monkeypatch):
+    """Fuentes de búsqueda sin red para una consulta de noticias sin ciudad; `pausas` retrasa cada fuente"""
+    pausas = {'duckduckgo': 0, 'api_duckduckgo': 0}
+    consultas_noticias = []
+
+    def duckduckgo(query):
+        time.sleep(pausas['duckduckgo'])
+        return '[DuckDuckGo] resultado web'
+
+    def api(query):
+        time.sleep(pausas['api_duckduckgo'])
+        return ['[API] respuesta instantánea']
+
+    def noticia(consulta):
+        consultas_noticias.append(consulta)
+        return f'[Noticias] {consulta}' if len(consultas_noticias) == 2 else None
+
+    monkeypatch.setattr(app, '_buscar_duckduckgo', duckduckgo)
+    monkeypatch.setattr(app, '_buscar_api_duckduckgo', api)
+    monkeypatch.setattr(app, '_buscar_noticia', noticia)
+    monkeypatch.setattr(app, '_es_consulta_noticias', lambda query: True)
+    monkeypatch.setattr(app, '_ciudad_consulta_clima', lambda query: None)
+    return pausas, consultas_noticias
+
+def test_busqueda_orden_fijo_y_noticias_en_una_tarea(fuentes_falsas):
+    """Los resultados se combinan en el orden de las fuentes aunque lleguen al revés, y las consultas de
+    noticias paran en la primera con resultados"""
+    pausas, consultas_noticias = fuentes_falsas
+    pausas['duckduckgo'] = 0.2
+
+    resultado = app.busqueda_web_avanzada('últimas noticias')
+
+    assert resultado.index('[DuckDuckGo]') < resultado.index('[Noticias]') < resultado.index('[API]')
+    assert consultas_noticias == app.QUERIES_NOTICIAS[:2]
+
+def test_busqueda_plazo_descarta_fuentes_lentas(fuentes_falsas, monkeypatch):
+    """Al agotarse SEARCH_DEADLINE se responde con lo que haya llegado y la fuente lenta queda sin tiempo"""
+    pausas, _ = fuentes_falsas
+    pausas['api_duckduckgo'] = 1
+    monkeypatch.setattr(Config, 'SEARCH_DEADLINE', 0.3)
+
+    inicio = time.monotonic()
+    resultado = app.busqueda_web_avanzada('últimas noticias')
+
+    assert time.monotonic() - inicio < 0.8
+    assert '[DuckDuckGo]' in resultado and '[API]' not in resultado
+    assert 'api_duckduckgo >0.3s (sin_tiempo)' in resultado
+
+def test_busqueda_acotada_por_peticion(monkeypatch):
+    """Una búsqueda con muchas variantes no ocupa más de SEARCH_MAX_PER_REQUEST hilos a la vez"""
+    monkeypatch.setattr(Config, 'SEARCH_MAX_PER_REQUEST', 2)
+    en_curso, maximo = [0], [0]
+    lock = threading.Lock()
+
+    class ClienteLento:
+        def invoke(self, consulta):
+            with lock:
+                en_curso[0] += 1
+                maximo[0] = max(maximo[0], en_curso[0])
+            time.sleep(0.05)
+            with lock:
+                en_curso[0] -= 1
+            return f'Resultado largo y relevante para la consulta {consulta} con detalle suficiente' \
+                if consulta == 'v5' else ''
+
+    servicio = app.ServicioBusquedaDDG(CacheResultados('prueba', None), app.ejecutor_busquedas)
+    monkeypatch.setattr(servicio, '_cliente', ClienteLento)
+    consultas = [f'v{i}' for i in range(6)]
+
+    assert servicio.primera_util(consultas)[0] == 'v5'
+    assert maximo[0] == 2
+    assert servicio.buscar_varias(consultas)['v5'].startswith('Resultado') and maximo[0] == 2
+
+# ================================
+# TRAZA DEL AGENTE
+# ================================
+
+def agente_falso(respuestas, herramienta, **kwargs):
+    """AgentExecutor ReAct con el prompt de la aplicación sobre un modelo de respuestas fijas"""
+    modelo = FakeListChatModel(responses=respuestas, **kwargs)
+    return AgentExecutor(agent=create_react_agent(modelo, [herramienta], obtener_prompt_agente()),
+                         tools=[herramienta], return_intermediate_steps=True)
+
+def respuestas_busqueda(consulta, respuesta):
+    return [
+        f'Thought: Necesito buscar {consulta}\nAction: web_search\nAction Input: {consulta}',
+        f'<think>La búsqueda ya lo dice</think>\nThought: Ya lo sé\nFinal Answer: {respuesta}'
+    ]
+
+def test_traza_agente():
+    """La traza recoge pasos, observaciones, bloques <think> y totales a partir de los callbacks"""
+    buscar = Tool(name='web_search', description='Busca en la web',
+                  func=lambda consulta: f'El oro cotiza a 2000 dólares ({consulta}). ' + 'Más datos. ' * 5)
+    traza = TrazaAgente()
+    resultado = agente_falso(respuestas_busqueda('precio del oro', '2000 dólares'), buscar).invoke(
+        {'input': '¿Precio del oro?'}, config={'callbacks': [traza]}
+    )
+
+    assert resultado['output'] == traza.respuesta_final == '2000 dólares'
+    [paso] = traza.pasos
+    assert paso['action'] == 'web_search' and paso['action_input'] == 'precio del oro'
+    assert paso['thought'] == 'Necesito buscar precio del oro'
+    assert paso['observation'].startswith('El oro cotiza') and paso['duracion'] is not None
+    assert traza.pensamientos[0] == '🧠 Thought 1: Necesito buscar precio del oro'
+    assert '💭 <think> 1: La búsqueda ya lo dice' in traza.pensamientos
+    resumen = traza.resumen()
+    assert (resumen['llamadas_modelo'], resumen['pasos'], resumen['busquedas']) == (2, 1, 1)
+
+def test_traza_agente_ejecuciones_simultaneas():
+    """Dos agentes a la vez no mezclan sus trazas"""
+    juntos = threading.Barrier(2, timeout=5)
+
+    def buscar(consulta):
+        juntos.wait()
+        return f'Resultado de {consulta}'
+
+    trazas = {}
+
+    def ejecutar(consulta):
+        trazas[consulta] = TrazaAgente()
+        agente = agente_falso(respuestas_busqueda(consulta, 'listo'), Tool(name='web_search', func=buscar, description='Busca'))
+        agente.invoke({'input': consulta}, config={'callbacks': [trazas[consulta]]})
+
+    hilos = [threading.Thread(target=ejecutar, args=(consulta,)) for consulta in ('oro', 'plata')]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(10)
+
+    for consulta, traza in trazas.items():
+        assert [(p['action_input'], p['observation']) for p in traza.pasos] == [(consulta, f'Resultado de {consulta}')]
+
+# ================================
+# AGENTE EN STREAMING (SSE)
+# ================================
+
+def usar_agente(monkeypatch, agente):
+    monkeypatch.setattr(app, 'available_models', list(app.modelos_configurados))
+    monkeypatch.setattr(app, 'agents', {model_key: agente for model_key in app.modelos_configurados})
+
+def leer_eventos(respuesta):
+    """Eventos SSE (nombre, datos) de una respuesta en streaming, a medida que llegan"""
+    pendiente = ''
+    for trozo in respuesta.response:
+        pendiente += trozo.decode('utf-8') if isinstance(trozo, bytes) else trozo
+        while '\n\n' in pendiente:
+            bloque, pendiente = pendiente.split('\n\n', 1)
+            campos = dict(linea.split(': ', 1) for linea in bloque.split('\n') if not linea.startswith(':'))
+            if campos:
+                yield campos['event'], json.loads(campos['data'])
+
+def test_agente_stream_secuencia_de_eventos(monkeypatch):
+    """El stream abre con 'inicio', emite pasos, observaciones y tokens de la respuesta y cierra con 'fin'"""
+    buscar = Tool(name='web_search', func=lambda consulta: f'Resultado de {consulta}', description='Busca')
+    usar_agente(monkeypatch, agente_falso(respuestas_busqueda('oro', '2000 dólares'), buscar))
+
+    respuesta = app.app.test_client().post('/chat/agente/stream', json={'pregunta': '¿Precio del oro?'}, buffered=False)
+    eventos = list(leer_eventos(respuesta))
+    nombres = [nombre for nombre, _ in eventos]
+
+    assert nombres[0] == 'inicio' and nombres[-1] == 'fin'
+    assert nombres.index('paso') < nombres.index('observacion') < nombres.index('token')
+    assert ''.join(datos['contenido'] for nombre, datos in eventos if nombre == 'token') == '2000 dólares'
+    fin = eventos[-1][1]
+    assert fin['respuesta'] == '2000 dólares'
+    assert fin['pasos_intermedios'][0]['observation'] == 'Resultado de oro'
+
+def test_agente_stream_cancelar(monkeypatch):
+    """Cancelar por id detiene al agente a mitad de la generación y el stream termina con 'cancelado'"""
+    buscar = Tool(name='web_search', func=lambda consulta: 'sin usar', description='Busca')
+    usar_agente(monkeypatch, agente_falso(['Thought: ' + 'pensando despacio ' * 200 + '\nFinal Answer: tarde'],
+                                          buscar, sleep=0.01))
+    cliente = app.app.test_client()
+
+    eventos = leer_eventos(cliente.post('/chat/agente/stream', json={'pregunta': 'Piensa'}, buffered=False))
+    nombre, inicio = next(eventos)
+    assert nombre == 'inicio'
+    antes = time.monotonic()
+    assert cliente.post(f"/chat/agente/cancelar/{inicio['ejecucion_id']}").get_json()['cancelada']
+
+    nombres = [nombre for nombre, _ in eventos]
+    assert nombres[-1] == 'cancelado' and 'token' not in nombres
+    assert time.monotonic() - antes < 2
+    assert cliente.post(f"/chat/agente/cancelar/{inicio['ejecucion_id']}").status_code == 404
+
+# ================================
+# SERVIDOR ASGI
+# ================================
+
+def test_asgi_delegadas_en_paralelo(monkeypatch):
+    """Las peticiones que asgi.py delega a Flask se atienden a la vez en hilos distintos"""
+    ambas_dentro = threading.Barrier(2, timeout=5)
+
+    def sesiones_lentas():
+        ambas_dentro.wait()  # Solo pasa si la otra petición está dentro al mismo tiempo
+        return app.jsonify({'hilo': threading.current_thread().name})
+
+    monkeypatch.setitem(app.app.view_functions, 'obtener_sesiones_endpoint', sesiones_lentas)
+
+    async def dos_peticiones():
+        transporte = httpx.ASGITransport(app=asgi.application)
+        async with httpx.AsyncClient(transport=transporte, base_url='http://asgi') as cliente:
+            return await asyncio.gather(cliente.get('/api/sesiones'), cliente.get('/api/sesiones'))
+
+    respuestas = asyncio.run(dos_peticiones())
+    assert [respuesta.status_code for respuesta in respuestas] == [200, 200]
+    assert len({respuesta.json()['hilo'] for respuesta in respuestas}) == 2
+
+def test_asgi_eventos_estado_en_el_event_loop(monkeypatch):
+    """El canal SSE de estado no pasa por Flask, no retiene otras peticiones y avisa en cuanto cambia el inventario"""
+    inventario = {
+        'ollama': {'available': False, 'models': [], 'running': []},
+        'lmstudio': {'available': False, 'models': []},
+        'gemini': {'available': False}
+    }
+    monkeypatch.setattr(app, 'sondear_backends', lambda: copy.deepcopy(inventario))
+    monitor = app.MonitorBackends(60, 0)
+    monitor._hilo = threading.current_thread()  # Activo, pero los sondeos los lanza la prueba
+    monitor.actualizar()
+    monkeypatch.setattr(app, 'monitor_backends', monitor)
+    monkeypatch.setattr(asgi, 'monitor_backends', monitor)
+    monkeypatch.setitem(app.app.view_functions, 'eventos_estado_modelos', lambda: pytest.fail('delegado a Flask'))
+
+    async def probar():
+        enviados = asyncio.Queue()
+        desconectar = asyncio.Event()
+        recibidos = []
+
+        async def receive():
+            recibidos.append(True)
+            if len(recibidos) > 1:
+                await desconectar.wait()
+                return {'type': 'http.disconnect'}
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def siguiente_evento():
+            return (await asyncio.wait_for(enviados.get(), 5))['body'].decode('utf-8')
+
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'path': '/api/models/status/eventos',
+                 'headers': [], 'query_string': b''}
+        canal = asyncio.ensure_future(asgi.application(scope, receive, enviados.put))
+        assert (await asyncio.wait_for(enviados.get(), 5))['status'] == 200
+        assert (await siguiente_evento()).startswith('event: estado')
+
+        transporte = httpx.ASGITransport(app=asgi.application)
+        async with httpx.AsyncClient(transport=transporte, base_url='http://asgi') as cliente:
+            respuesta = await asyncio.wait_for(cliente.get('/api/sesiones'), 5)
+        assert respuesta.status_code == 200 and not canal.done()
+
+        # El keep-alive es de HEALTH_MONITOR_HEARTBEAT segundos: el evento llega por el aviso del monitor
+        inventario['lmstudio'] = {'available': True, 'models': [{'id': 'deepseek-r1'}]}
+        await asyncio.to_thread(monitor.actualizar)
+        assert 'deepseek-r1' in await siguiente_evento()
+
+        desconectar.set()
+        await asyncio.wait_for(canal, 5)
+
+    asyncio.run(probar())
+
+if __name__ == "__main__":
+    pytest.main([__file__, '-q'])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Pruebas de la base de datos del historial: migraciones y planes de consulta (sin red)"""
+
+import pytest
+from database import (
+    crear_conexion, aplicar_migraciones, version_esquema, MIGRACIONES,
+    SQL_HISTORIAL_SESION, SQL_SESIONES_RECIENTES, sql_historial_sesion, sql_sesiones_recientes,
+    sql_busqueda_historial
+)
+
+@pytest.fixture
+def conn(tmp_path):
+    """Base de datos vacía con el esquema migrado (pytest borra el directorio temporal)"""
+    conexion = crear_conexion(str(tmp_path / 'historial_prueba.db'))
+    aplicar_migraciones(conexion)
+    yield conexion
+    conexion.close()
+
+def plan_de_consulta(conn, sql, parametros):
+    """Devuelve el detalle de EXPLAIN QUERY PLAN como una sola cadena"""
+    filas = conn.execute(f'EXPLAIN QUERY PLAN {sql}', parametros).fetchall()
+    return ' | '.join(fila[-1] for fila in filas)
+
+def test_migraciones(conn):
+    """Las migraciones dejan el esquema en la última versión y son idempotentes"""
+    ultima_version = MIGRACIONES[-1][0]
+    
+    assert version_esquema(conn) == ultima_version
+    assert aplicar_migraciones(conn) == ultima_version
+    
+    indices = {fila[0] for fila in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert 'idx_conversations_session_timestamp' in indices
+    assert 'idx_sessions_last_activity' in indices
+    print(f"✅ Esquema migrado a la versión {ultima_version}")
+
+def test_plan_historial_sesion(conn):
+    """El historial de una sesión usa el índice (session_id, timestamp) sin ordenar en memoria"""
+    plan = plan_de_consulta(conn, SQL_HISTORIAL_SESION, ('sesion', 50))
+    print(f"   Plan: {plan}")
+    
+    assert 'idx_conversations_session_timestamp' in plan
+    assert 'TEMP B-TREE' not in plan
+    print("✅ Historial por sesión usa índice")
+
+def test_plan_sesiones_recientes(conn):
+    """El listado de sesiones recientes recorre el índice de last_activity"""
+    plan = plan_de_consulta(conn, SQL_SESIONES_RECIENTES, (100,))
+    print(f"   Plan: {plan}")
+    
+    assert 'idx_sessions_last_activity' in plan
+    assert 'TEMP B-TREE' not in plan
+    print("✅ Sesiones recientes usan índice")
+
+def test_plan_paginacion_cursor(conn):
+    """Las páginas siguientes (keyset) buscan por rango en el índice en lugar de recorrer la tabla"""
+    
+    plan = plan_de_consulta(conn, sql_historial_sesion(('user_message', 'id', 'timestamp'), con_cursor=True),
+                            ('sesion', '2024-01-01 00:00:00', 10, 50))
+    print(f"   Plan: {plan}")
+    assert 'idx_conversations_session_timestamp' in plan
+    assert 'TEMP B-TREE' not in plan
+    
+    plan = plan_de_consulta(conn, sql_sesiones_recientes(con_cursor=True), ('2024-01-01 00:00:00', 'sesion', 100))
+    print(f"   Plan: {plan}")
+    assert 'idx_sessions_last_activity' in plan
+    assert 'TEMP B-TREE' not in plan
+    print("✅ Paginación por cursor usa índices")
+
+def test_busqueda_texto_completo(conn):
+    """El índice FTS5 se mantiene sincronizado y la búsqueda no recorre la tabla de conversaciones"""
+    conn.execute('''
+        INSERT INTO conversations (session_id, user_message, ai_response, model_used)
+        VALUES ('s1', '¿Qué es Python?', 'Python es un lenguaje de programación', 'llama3')
+    ''')
+    conn.commit()
+    
+    sql = sql_busqueda_historial(filtrar_modelo=True)
+    resultados = conn.execute(sql, ('"programacion"', 'llama3', 10, 0)).fetchall()
+    assert len(resultados) == 1
+    assert '<mark>programación</mark>' in resultados[0][5]
+    
+    plan = plan_de_consulta(conn, sql, ('"programacion"', 'llama3', 10, 0))
+    print(f"   Plan: {plan}")
+    assert 'VIRTUAL TABLE INDEX' in plan
+    assert 'SEARCH c USING INTEGER PRIMARY KEY' in plan
+    
+    conn.execute("UPDATE conversations SET ai_response = 'Otra respuesta'")
+    assert conn.execute(sql, ('"programacion"', 'llama3', 10, 0)).fetchall() == []
+    conn.execute("DELETE FROM conversations")
+    assert conn.execute("SELECT COUNT(*) FROM conversations_fts WHERE conversations_fts MATCH '\"python\"'").fetchone()[0] == 0
+    print("✅ Búsqueda de texto completo indexada y sincronizada")
+
+if __name__ == "__main__":
+    pytest.main([__file__, '-q'])
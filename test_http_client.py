@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Pruebas de la capa HTTP: circuit breaker y tokens de cancelación (sin red)"""
+
+import concurrent.futures
+import threading
+import time
+import pytest
+from config import Config
+from http_client import (
+    Circuito, CircuitoAbiertoError, PeticionCanceladaError, TokenCancelacion, con_cancelacion,
+    esperar_resultado
+)
+
+@pytest.fixture
+def circuito(monkeypatch):
+    monkeypatch.setattr(Config, 'CIRCUIT_FAILURE_THRESHOLD', 3)
+    monkeypatch.setattr(Config, 'CIRCUIT_RESET_TIMEOUT', 10)
+    monkeypatch.setattr(Config, 'CIRCUIT_MAX_RESET_TIMEOUT', 30)
+    return Circuito('prueba')
+
+def abrir(circuito):
+    for _ in range(Config.CIRCUIT_FAILURE_THRESHOLD):
+        circuito.permitir()
+        circuito.fallo(ConnectionError('sin respuesta'))
+
+def agotar_espera(circuito):
+    """Simula que ya pasó la espera del circuito abierto"""
+    circuito.abierto_desde -= circuito.espera
+
+# ================================
+# CIRCUIT BREAKER
+# ================================
+
+def test_circuito_se_abre_tras_fallos_seguidos(circuito):
+    """Con CIRCUIT_FAILURE_THRESHOLD fallos seguidos se abre y rechaza al instante"""
+    circuito.fallo()
+    circuito.exito()
+    circuito.fallo()
+    circuito.fallo()
+    assert circuito.estado == Circuito.CERRADO
+
+    circuito.fallo()
+    assert circuito.estado == Circuito.ABIERTO and not circuito.disponible()
+    with pytest.raises(CircuitoAbiertoError):
+        circuito.permitir()
+    assert circuito.estadisticas['aperturas'] == 1 and circuito.estadisticas['rechazadas'] == 1
+
+def test_circuito_semiabierto_deja_una_sola_prueba(circuito):
+    """Pasada la espera solo pasa una llamada de prueba; si funciona, el circuito se cierra"""
+    abrir(circuito)
+    agotar_espera(circuito)
+    assert circuito.disponible()
+
+    circuito.permitir()
+    assert circuito.estado == Circuito.SEMIABIERTO
+    with pytest.raises(CircuitoAbiertoError):
+        circuito.permitir()
+
+    circuito.exito(0.1)
+    assert circuito.estado == Circuito.CERRADO and circuito.espera == Config.CIRCUIT_RESET_TIMEOUT
+    circuito.permitir()
+
+def test_circuito_prueba_fallida_duplica_la_espera(circuito):
+    """Si la llamada de prueba falla vuelve a abrirse con el doble de espera (con tope)"""
+    abrir(circuito)
+    for espera in (20, 30, 30):
+        agotar_espera(circuito)
+        circuito.permitir()
+        circuito.fallo()
+        assert circuito.estado == Circuito.ABIERTO and circuito.espera == espera
+
+def test_circuito_cancelacion_no_cuenta(circuito):
+    """Una petición cancelada libera la llamada de prueba sin contar como fallo"""
+    abrir(circuito)
+    agotar_espera(circuito)
+    with pytest.raises(PeticionCanceladaError):
+        with circuito.proteger():
+            raise PeticionCanceladaError('cliente desconectado')
+
+    assert circuito.estado == Circuito.SEMIABIERTO and circuito.estadisticas['fallos'] == 3
+    with circuito.proteger():
+        pass
+    assert circuito.estado == Circuito.CERRADO
+
+def test_timeout_adaptativo(circuito, monkeypatch):
+    """Con muestras suficientes la lectura espera un múltiplo del p95 observado, entre el mínimo y el tope"""
+    monkeypatch.setattr(Config, 'CIRCUIT_ADAPTIVE_TIMEOUTS', True)
+    monkeypatch.setattr(Config, 'CIRCUIT_MIN_SAMPLES', 5)
+    monkeypatch.setattr(Config, 'CIRCUIT_TIMEOUT_FACTOR', 3)
+    monkeypatch.setattr(Config, 'CIRCUIT_MIN_TIMEOUT', 2)
+    assert circuito.ajustar_timeout((5, 300)) == (5, 300)
+
+    for _ in range(5):
+        circuito.exito(4.0)
+    assert circuito.ajustar_timeout((5, 300)) == (5, 12.0)
+    assert circuito.timeout_adaptativo(10) == 10
+
+    rapido = Circuito('rapido')
+    for _ in range(5):
+        rapido.exito(0.1)
+    assert rapido.timeout_adaptativo(300) == 2
+
+# ================================
+# TOKENS DE CANCELACIÓN
+# ================================
+
+def test_token_plazo_y_cancelacion():
+    """El plazo acota los timeouts y al cancelar se ejecutan los callbacks una sola vez"""
+    token = TokenCancelacion(5)
+    assert token.acotar(60) <= 5 and token.acotar(1) == 1
+    assert token.acotar_timeout((10, 300))[1] <= 5
+
+    avisos = []
+    quitar = token.al_cancelar(lambda: avisos.append('quitado'))
+    token.al_cancelar(lambda: avisos.append('aviso'))
+    quitar()
+    assert token.cancelar('cliente desconectado')
+    assert not token.cancelar()
+    assert avisos == ['aviso'] and token.motivo == 'cliente desconectado'
+    with pytest.raises(PeticionCanceladaError):
+        token.comprobar()
+
+    token.al_cancelar(lambda: avisos.append('tarde'))
+    assert avisos[-1] == 'tarde'
+
+def test_token_plazo_agotado():
+    token = TokenCancelacion(0.01)
+    time.sleep(0.02)
+    with pytest.raises(PeticionCanceladaError) as error:
+        token.comprobar()
+    assert error.value.por_plazo
+
+def test_esperar_resultado_despierta_al_cancelar():
+    """Esperar una carga ajena termina en cuanto se cancela la petición propia"""
+    futuro = concurrent.futures.Future()
+    token = TokenCancelacion(60)
+    threading.Timer(0.05, token.cancelar).start()
+    inicio = time.monotonic()
+    with con_cancelacion(token):
+        with pytest.raises(PeticionCanceladaError) as error:
+            esperar_resultado(futuro)
+    assert not error.value.por_plazo and time.monotonic() - inicio < 1
+    assert not futuro.cancelled()
+
+    futuro.set_result('listo')
+    with con_cancelacion(TokenCancelacion(60)):
+        assert esperar_resultado(futuro) == 'listo'
+
+if __name__ == "__main__":
+    pytest.main([__file__, '-q'])